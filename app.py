@@ -1,12 +1,11 @@
 from werkzeug.utils import secure_filename  # ADD THIS AT TOP OF FILE
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response
 import os
 from PIL import Image
 import uuid
 from flask_cors import CORS
 import subprocess
 import shutil
-import h5py
 from PIL import Image, ImageOps
 import numpy as np
 import zipfile
@@ -15,109 +14,100 @@ import gc  # Garbage collector
 import time  # For delays
 from flask import session
 from datetime import timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
 import datetime
 import atexit
-from tensorflow.python.summary.summary_iterator import summary_iterator
 import glob
-import tensorflow as tf
-from ultralytics import YOLO
+import json
 from scripts.normalization import normalize_image
+from scripts.tiling import format_yolo_annotations
+from scripts.detection_cache import detect_cached, invalidate_image
+from scripts.image_source import ImageSource, open_image
+from scripts.scaled_variants import scaled_variant, exported_variant, link_variant
+from scripts.tile_pyramid import start_pyramid, cancel_pyramid, wait_for_level, pending_info
+from scripts.preview import save_preview, save_full_resolution
+from scripts.upload_cache import (get_source, get_rendition, remember_array,
+                                  invalidate as invalidate_upload)
+from scripts.tfevents import read_scalars
+from scripts.zipstream import stream_zip, file_entry, data_entry
+from scripts.sessions import ensure_session_dirs, touch_session, flush_activity, forget_session
+from scripts.batch_pipeline import (run_cpu, submit_cpu, run_inference, map_images, prepare_detection_image,
+                                    write_scaled_copy)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Gets directory where app.py is
 from PIL import Image
 # Disable decompression bomb protection for large TIFF files
 Image.MAX_IMAGE_PIXELS = None
 
-def batch_process_image_yolo(user_id, image_path, detection_type, threshold, model_path=None, cell_diameter=34):
+def run_tiled_detection(image_path, model_path, threshold, output_path=None, stats=None, progress=None,
+                        image=None, variant=None):
+    """
+    Split -> detect -> merge entirely in-process:
+      - decode the image once into an array
+      - feed tile views straight to the model (background / duplicate tiles are skipped)
+      - merge boxes in memory and return YOLO text normalized to the image size
+    Raw detections are cached per image/model content (scripts/detection_cache.py), so
+    re-running with a different threshold only filters and re-merges the cached boxes.
+    Optionally writes the merged annotations to output_path; tile counts go into stats and
+    progress(done, total) is called as tiles complete. image/variant pass already decoded
+    pixels of image_path (see detect_cached).
+    """
+    boxes, scores, classes, image_width, image_height = detect_cached(
+        image_path, model_path, threshold, stats=stats, progress=progress, image=image, variant=variant)
+    annotations = format_yolo_annotations(boxes, classes, image_width, image_height)
+
+    if output_path:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, 'w') as f:
+            f.write(annotations)
+
+    return annotations, image_width, image_height
+
+
+def batch_process_image_yolo(user_id, image_path, detection_type, threshold, model_path=None, cell_diameter=34,
+                             progress=None):
     """
     Minimal-safe batch processing:
       - normalize (for detection only) -> detection image (PNG)
-      - run split -> detect -> merge using the detection image dimensions
+      - run in-process split -> detect -> merge using the detection image dimensions
       - create a scaled copy of the ORIGINAL TIFF (no normalization applied) sized to detection dims
       - save merged .txt next to the scaled TIFF
       - return paths to scaled TIFF and matching TXT
+    The CPU stages run in the batch worker processes and detection on the shared inference
+    executor (see scripts/batch_pipeline.py), so several images can be processed at once.
     """
     try:
         # --- per-user directories ---
-        upload_dir = os.path.join('users', user_id, 'uploads')
         final_dir = os.path.join('users', user_id, 'finaloutput')
-        tiles_dir = os.path.join('users', user_id, 'images', 'tiles')
-        output_txt_dir = os.path.join('users', user_id, 'images', 'tiles_output')
-
-        # Ensure directories exist and are clean for this run
-        for d in [tiles_dir, output_txt_dir]:
-            shutil.rmtree(d, ignore_errors=True)
-            os.makedirs(d, exist_ok=True)
+        scaled_dir = os.path.join('users', user_id, 'scaled')
         os.makedirs(final_dir, exist_ok=True)
 
         original_tiff_path = image_path
         base_name = os.path.splitext(os.path.basename(image_path))[0]
 
-        # --- 1) Create a normalized PNG (detection-only). Use unique name to avoid collisions ---
-        norm_uuid = uuid.uuid4().hex[:8]
-        normalized_basename = f"normalized_{norm_uuid}_{base_name}.png"
-        normalized_path = os.path.join(upload_dir, normalized_basename)
-        normalize_image(image_path, normalized_path)  # this is detection-only
-
-        # --- 2) Optionally scale the normalized PNG for detection ---
-        scaling_factor = 1.0
-        target_diameter = 20.0 if detection_type == 'CD3' else 34.0
-        if float(cell_diameter) != target_diameter:
-            scaling_factor = target_diameter / float(cell_diameter)
-            with Image.open(normalized_path) as img:
-                w, h = img.size
-                det_w = max(1, int(round(w * scaling_factor)))
-                det_h = max(1, int(round(h * scaling_factor)))
-                scaled_norm_name = f"scaled_norm_{norm_uuid}_{base_name}.png"
-                scaled_norm_path = os.path.join(upload_dir, scaled_norm_name)
-                scaled_img = img.resize((det_w, det_h), Image.Resampling.LANCZOS)
-                # Save PNG (for detection)
-                scaled_img.save(scaled_norm_path, format='PNG')
-                detection_path = scaled_norm_path
-        else:
-            with Image.open(normalized_path) as img:
-                det_w, det_h = img.size
-            detection_path = normalized_path
-
-        # --- 3) Select model ---
-        model_map = {
-            'SGN': 'snapshots/SGN_best.pt',
-            'MADM': 'snapshots/MADM_v3.pt',
-            'CD3': 'snapshots/cd3_v3.pt'
-        }
-        model_path = model_path or model_map.get(detection_type)
+        # --- 1) Select model ---
+        model_path = model_path or BATCH_MODELS.get(detection_type)
         if not model_path:
             return {'success': False, 'error': 'Invalid model configuration (no model found)'}
 
-        # --- 4) Split detection image into tiles, detect, then merge using detection dims ---
-        subprocess.run(['python3', 'scripts/split_image.py', '--image', detection_path, '--output', tiles_dir], check=True)
-        detect_tiles_in_batch(tiles_dir, output_txt_dir, model_path, threshold)
-
-        # Ensure we have detection dimensions (defensive)
-        with Image.open(detection_path) as dimg:
-            det_w, det_h = dimg.size
+        # --- 2) Normalized (and optionally scaled) image for detection, in a worker process ---
+        detection_path, det_w, det_h, scaling_factor = run_cpu(
+            prepare_detection_image, image_path, scaled_dir, detection_type, cell_diameter)
 
         # merged txt filename unique + paired with scaled tiff base
         out_uuid = uuid.uuid4().hex[:8]
         out_base = f"{base_name}_scaled_{int(round(float(cell_diameter)))}_{out_uuid}"
         merged_txt_path = os.path.join(final_dir, out_base + ".txt")
+        scaled_tiff_path = os.path.join(final_dir, out_base + ".tiff")
 
-        # merge_annotations must write the YOLO-format annotations normalized for det_w/det_h
-        subprocess.run([
-            'python3', 'scripts/merge_annotations.py',
-            '--tiles', output_txt_dir,
-            '--output', merged_txt_path,
-            '--image_width', str(det_w),
-            '--image_height', str(det_h)
-        ], check=True)
+        # --- 3) SCALED COPY of the ORIGINAL TIFF in a worker process, overlapping detection ---
+        scaled_copy = submit_cpu(write_scaled_copy, original_tiff_path, scaled_tiff_path, det_w, det_h, scaled_dir)
 
-        # --- 5) Create a SCALED COPY of the ORIGINAL TIFF (preserve mode/bitdepth) ---
-        scaled_tiff_path = os.path.join(final_dir, out_base + ".tiff")
-        with Image.open(original_tiff_path) as orig_img:
-            # Resize but DO NOT convert mode — this preserves the original "look" (e.g. pitch black)
-            scaled_orig = orig_img.resize((det_w, det_h), Image.Resampling.LANCZOS)
-            # Save as TIFF without forcing RGB conversion
-            scaled_orig.save(scaled_tiff_path, format='TIFF')
+        # --- 4) Tile, detect and merge; annotations are normalized for det_w/det_h ---
+        tile_stats = {}
+        try:
+            run_inference(run_tiled_detection, detection_path, model_path, threshold, output_path=merged_txt_path,
+                          stats=tile_stats, progress=progress)
+        finally:
+            scaled_copy.result()
 
         # Done — return paired paths
         return {
@@ -126,7 +116,8 @@ def batch_process_image_yolo(user_id, image_path, detection_type, threshold, mod
             'txt_path': merged_txt_path,
             'det_width': det_w,
             'det_height': det_h,
-            'scaling_factor': scaling_factor
+            'scaling_factor': scaling_factor,
+            'tiles': tile_stats
         }
 
     except Exception as e:
@@ -135,7 +126,7 @@ def batch_process_image_yolo(user_id, image_path, detection_type, threshold, mod
 
 
 
-def detect_with_tiling(user_id, model_path, threshold=0.5): #Helper function for fine tuning testing on singular image
+def detect_with_tiling(user_id, model_path, threshold=0.5, stats=None): #Helper function for fine tuning testing on singular image
     """Tiling detection with normalization matching SGN/CD3 pipeline"""
     try:
         # Find uploaded image
@@ -147,64 +138,22 @@ def detect_with_tiling(user_id, model_path, threshold=0.5): #Helper function for
         
         image_path = os.path.join(upload_dir, image_files[0])
         
-        # Create normalized version of FULL IMAGE
-        normalized_path = os.path.join(upload_dir, 'normalized_temp.png')
-        normalize_image(image_path, normalized_path)
+        # Normalized version of FULL IMAGE, from the per-upload cache (built once per upload);
+        # non-integer images are converted with PIL, which closes the file again
+        normalized = get_rendition(user_id, image_path)
         
-        # Set up directories
-        tiles_dir = os.path.join('users', user_id, 'images', 'tiles')
-        output_txt_dir = os.path.join('users', user_id, 'images', 'tiles_output')
         merged_output_path = os.path.join('users', user_id, 'finaloutput', 'merged_detections.txt')
-        
-        os.makedirs(tiles_dir, exist_ok=True)
-        os.makedirs(output_txt_dir, exist_ok=True)
-        os.makedirs(os.path.dirname(merged_output_path), exist_ok=True)
-        
+
         # Get original image dimensions
-        with Image.open(image_path) as img:
-            orig_width, orig_height = img.size
-        
-        # Split into tiles - using the same script as SGN/CD3
-        subprocess.run([
-            'python3', 'scripts/split_image.py',
-            '--image', normalized_path,
-            '--output', tiles_dir
-        ], check=True)
-        
-        # Detect all tiles using GPU-efficient function
-        detect_tiles_in_batch(tiles_dir, output_txt_dir, model_path, threshold)
-        
-        # Merge annotations - using the same script as SGN/CD3
-        subprocess.run([
-            'python3', 'scripts/merge_annotations.py',
-            '--tiles', output_txt_dir,
-            '--output', merged_output_path,
-            '--image_width', str(orig_width),
-            '--image_height', str(orig_height)
-        ], check=True)
-        
-        # Read results
-        with open(merged_output_path, 'r') as f:
-            annotations = f.read()
-        
-        # Cleanup temporary files
-        try:
-            os.remove(normalized_path)
-            shutil.rmtree(tiles_dir)
-            shutil.rmtree(output_txt_dir)
-        except:
-            pass
+        orig_height, orig_width = get_source(user_id, image_path).shape[:2]
+
+        # Tile, detect and merge in-process - same engine as SGN/CD3
+        annotations, _, _ = run_tiled_detection(image_path, model_path, threshold, output_path=merged_output_path,
+                                               stats=stats, image=normalized, variant='normalized')
         
         return annotations, orig_width, orig_height, None
         
     except Exception as e:
-        # Cleanup on error
-        try:
-            os.remove(normalized_path)
-            shutil.rmtree(tiles_dir, ignore_errors=True)
-            shutil.rmtree(output_txt_dir, ignore_errors=True)
-        except:
-            pass
         return None, None, None, str(e)
 
 
@@ -216,18 +165,6 @@ def sanitize_box(x1, y1, x2, y2):
     new_y2 = max(y1, y2)
     return new_x1, new_y1, new_x2, new_y2
 
-def get_scalar_value(v):
-    if hasattr(v, 'simple_value') and v.simple_value != 0.0:
-        return v.simple_value
-    elif hasattr(v, 'tensor'):
-        try:
-            t = tf.make_ndarray(v.tensor)
-            return float(t)
-        except Exception as e:
-            print(f"[Error extracting tensor value for {v.tag}]: {e}")
-            return None
-    return None
-
 app = Flask(__name__)
 CORS(app, supports_credentials=True)  # This will allow all domains to access your API
 
@@ -236,32 +173,27 @@ app.secret_key = 'test'  # Replace with a real secret key
 
 @app.before_request
 def set_user_session():
+    # Health probes carry no cookie; they must not create sessions and user directories
+    if request.endpoint in ('healthz', 'readyz'):
+        return
     if 'user_id' not in session:
         session.permanent = True
         session['user_id'] = str(uuid.uuid4())
-    
-    # Always update directory modification time on any request
-    user_id = session['user_id']
-    user_dir = os.path.join('users', user_id)
-    if os.path.exists(user_dir):
-        os.utime(user_dir, None)  # Update mtime on every request
-    # Create user directories if they don't exist
+
+    # Directories are created once per process and the last activity (the user directory's
+    # mtime, read by delete_expired_sessions) is written in batches, see scripts/sessions.py
     user_id = session['user_id']
-    user_dirs = [
-        os.path.join('users', user_id, 'uploads'),
-        os.path.join('users', user_id, 'converted'),
-        os.path.join('users', user_id, 'saved_data'),
-        os.path.join('users', user_id, 'saved_annotations'),
-        os.path.join('users', user_id, 'finaloutput'),
-        os.path.join('users', user_id, 'ft_upload'),
-        os.path.join('users', user_id, 'images'),
-        os.path.join('users', user_id, 'input'),
-        os.path.join('users', user_id, 'output'),
-        os.path.join('users', user_id, 'output/output_csv'),
-        os.path.join('users', user_id, 'snapshots')
-    ]
-    for dir_path in user_dirs:
-        os.makedirs(dir_path, exist_ok=True)
+    ensure_session_dirs(user_id)
+    touch_session(user_id)
+
+
+@app.after_request
+def check_storage_after_write(response):
+    # Requests that may have written files get the user's quota checked in the background;
+    # the upload size keeps the usage estimate of check_quota current until then
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and session.get('user_id'):
+        schedule_check(session['user_id'], request.content_length or 0)
+    return response
 
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)  # Session expires after 24 hours
 
@@ -271,6 +203,13 @@ def cleanup_files():
         user_id = session.get('user_id')
         if user_id:
             user_dir = os.path.join('users', user_id)
+            prune_jobs(user_id)
+            active = active_training_job(user_id)
+            if active is not None:
+                cancel_training_job(active['id'], user_id)
+            prune_training_jobs(user_id)
+            forget_session(user_id)
+            forget_user(user_id)
             if os.path.exists(user_dir):
                 shutil.rmtree(user_dir)
                 print(f"Cleaned up directory for user: {user_id}")
@@ -296,17 +235,132 @@ def clear_folder(folder):
 
 
 def clear_uploaded_images():
-    """Delete all files in the current user's upload folder"""
+    """Delete all files in the current user's upload folder (and kept pre-crop originals)"""
     user_id = session.get('user_id', 'default')  # Handle unauthenticated edge case
-    user_upload_dir = os.path.join('users', user_id, 'uploads')
-    for filename in os.listdir(user_upload_dir):
-        file_path = os.path.join(user_upload_dir, filename)
-        if os.path.isfile(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                print(f"Error deleting {file_path}: {e}")
+    invalidate_upload(user_id)
+    session.pop('crop_box', None)
+    for folder in ('uploads', 'originals'):
+        user_folder = os.path.join('users', user_id, folder)
+        if not os.path.isdir(user_folder):
+            continue
+        for filename in os.listdir(user_folder):
+            file_path = os.path.join(user_folder, filename)
+            if os.path.isfile(file_path):
+                try:
+                    os.remove(file_path)
+                except Exception as e:
+                    print(f"Error deleting {file_path}: {e}")
+
+
+def user_upload_path(user_id, filename):
+    """Path of an upload named by the client, or None if the name does not stay inside users/<id>/uploads"""
+    upload_dir = os.path.realpath(os.path.join('users', user_id, 'uploads'))
+    path = os.path.realpath(os.path.join(upload_dir, filename))
+    if not filename or os.path.dirname(path) != upload_dir:
+        return None
+    return os.path.join('users', user_id, 'uploads', filename)
+
+
+def uncropped_original_path(user_id, filename):
+    """Where the full-resolution upload is kept while a crop of it is the working image"""
+    return os.path.join('users', user_id, 'originals', secure_filename(filename))
+
 
+def replace_upload(upload_path, image):
+    """Write image over upload_path through a temporary file, so the old file (or a link to
+    it) is never truncated while another request may still be reading it"""
+    tmp_path = f'{upload_path}.{uuid.uuid4().hex}.tmp'
+    image.save(tmp_path, format='TIFF', compression='tiff_deflate')
+    os.replace(tmp_path, upload_path)
+
+
+VIEW_PYRAMIDS_KEPT = int(os.environ.get('CAT_VIEW_PYRAMIDS_KEPT', 4))
+
+
+def build_view_tiles(user_id, rendition, pyramid_id=None):
+    """Start the viewer's tile pyramid for an 8-bit rendition and return its info (with URLs).
+
+    The tiles are written in the background, coarsest level first, so the response (and its
+    preview) goes out right away; a tile requested before its level exists waits for it.
+    Each pyramid gets a new id, so its tiles can be cached by the browser forever. A
+    pyramid_id naming the rendition's content (e.g. a scaled variant) reuses that pyramid if it
+    was already built or is still being built. Only the VIEW_PYRAMIDS_KEPT most recent
+    pyramids of a user are kept.
+    """
+    tiles_root = os.path.join('users', user_id, 'tiles')
+    pyramid_dir = os.path.join(tiles_root, pyramid_id) if pyramid_id else None
+    info = pending_info(pyramid_dir) if pyramid_dir else None
+    if info:
+        os.utime(pyramid_dir, None)
+    elif pyramid_dir and os.path.exists(os.path.join(pyramid_dir, 'info.json')):
+        with open(os.path.join(pyramid_dir, 'info.json')) as f:
+            info = json.load(f)
+        os.utime(pyramid_dir, None)
+    else:
+        pyramid_id = pyramid_id or uuid.uuid4().hex
+        pyramid_dir = os.path.join(tiles_root, pyramid_id)
+        shutil.rmtree(pyramid_dir, ignore_errors=True)
+        info = start_pyramid(rendition, pyramid_dir)
+
+    kept = sorted((entry for entry in os.scandir(tiles_root) if entry.is_dir()),
+                  key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in kept[VIEW_PYRAMIDS_KEPT:]:
+        if entry.name != pyramid_id and not cancel_pyramid(entry.path):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    info['id'] = pyramid_id
+    info['dzi_url'] = f'/tiles/{pyramid_id}/image.dzi'
+    info['tile_url'] = f'/tiles/{pyramid_id}/image_files/{{level}}/{{col}}_{{row}}.{info["format"]}'
+    return info
+
+
+def publish_view(user_id, image_path, rendition=None, view_key=None):
+    """Write what the viewer needs for an image and return the URLs for the JSON response.
+
+    The downsampled preview (converted_url) is written now and the tile pyramid started; the
+    full-resolution rendition (full_url) is only encoded when the viewer asks for it.
+    rendition defaults to the cached normalized rendition of image_path; one that cannot be
+    rebuilt from the file (a crop of the previous rendition) is written at full size right away.
+    view_key names the image content, so its tile pyramid can be reused (see build_view_tiles).
+    """
+    converted_dir = os.path.join('users', user_id, 'converted')
+    view_id = uuid.uuid4().hex
+    if rendition is None:
+        rendition = get_rendition(user_id, image_path)
+    else:
+        save_full_resolution(rendition, os.path.join(converted_dir, f'{view_id}_full.png'))
+    preview_path = save_preview(rendition, os.path.join(converted_dir, view_id))
+    session['full_view'] = {'id': view_id, 'path': image_path}
+    return {
+        'converted_url': f'/converted/{os.path.basename(preview_path)}',
+        'full_url': f'/full-image/{view_id}.png',
+        'tiles': build_view_tiles(user_id, rendition, view_key),
+        'width': int(rendition.shape[1]),
+        'height': int(rendition.shape[0]),
+    }
+
+
+@app.route('/tiles/<pyramid_id>/image.dzi')
+def serve_tile_descriptor(pyramid_id):
+    user_id = session['user_id']
+    response = send_from_directory(os.path.join('users', user_id, 'tiles', secure_filename(pyramid_id)), 'image.dzi',
+                                   mimetype='application/xml')
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/tiles/<pyramid_id>/image_files/<int:level>/<filename>')
+def serve_tile(pyramid_id, level, filename):
+    user_id = session['user_id']
+    pyramid_dir = os.path.join('users', user_id, 'tiles', secure_filename(pyramid_id))
+    level_dir = os.path.join(pyramid_dir, 'image_files', str(level))
+    if not os.path.exists(os.path.join(level_dir, filename)):
+        # Still being built: the levels are written coarsest first, so this one is on its way
+        wait_for_level(pyramid_dir, level)
+    response = send_from_directory(level_dir, filename)
+    # Pyramid ids are never reused, so a tile URL always names the same bytes
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 
 @app.route('/upload', methods=['POST'])
@@ -321,31 +375,28 @@ def upload_file():
 
     try:
         clear_uploaded_images()
-        original_name = file.filename
+        quota_error = check_quota(user_id)
+        if quota_error:
+            return jsonify({'error': quota_error}), 507
+        # Later requests name this file by original_name, so store it under the name they will send
+        original_name = secure_filename(file.filename)
         base_name = os.path.splitext(original_name)[0]
         original_extension = os.path.splitext(original_name)[1][1:].lower()
         user_upload_dir = os.path.join('users', user_id, 'uploads')
-        user_converted_dir = os.path.join('users', user_id, 'converted')
 
         # Save original file
         original_path = os.path.join(user_upload_dir, original_name)
         file.save(original_path)
 
-        # Store original dimensions
-        with Image.open(original_path) as img:
-            session['original_dimensions'] = img.size
-            session['current_dimensions'] = img.size
-            session['target_diameter'] = 34.0
-
-        # Generate normalized preview
-        unique_id = str(uuid.uuid4())
-        output_filename = f"{unique_id}.png"
-        output_path = os.path.join(user_converted_dir, output_filename)
-        
-        normalize_image(original_path, output_path)
+        # Store original dimensions (the decoded upload stays cached for later endpoints)
+        source = get_source(user_id, original_path)
+        session['original_dimensions'] = (source.width, source.height)
+        session['current_dimensions'] = (source.width, source.height)
+        session['target_diameter'] = 34.0
 
+        # Downsampled preview + tiles of the normalized rendition
         return jsonify({
-            'converted_url': f'/converted/{output_filename}',
+            **publish_view(user_id, original_path),
             'original_name': original_name,
             'base_name': base_name,
             'original_extension': original_extension
@@ -370,23 +421,10 @@ def export_annotations():
         if not os.path.exists(tiff_path):
             return jsonify({'error': 'Current TIFF file not found'}), 404
 
-        # Create in-memory ZIP file
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # Add YOLO txt file instead of CSV
-            txt_filename = f"{os.path.splitext(original_filename)[0]}.txt"
-            zipf.writestr(txt_filename, yolo_data)
-            # Add TIFF
-            zipf.write(tiff_path, os.path.basename(tiff_path))
-
-        zip_buffer.seek(0)
-
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=f'{os.path.splitext(original_filename)[0]}_export.zip'
-        )
+        # Stream the ZIP: YOLO txt file instead of CSV, then the TIFF (stored, not re-deflated)
+        txt_filename = f"{os.path.splitext(original_filename)[0]}.txt"
+        entries = [data_entry(txt_filename, yolo_data), file_entry(tiff_path)]
+        return zip_response(entries, f'{os.path.splitext(original_filename)[0]}_export.zip')
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -396,37 +434,52 @@ def upload_cropped_file():
     user_id = session['user_id']
     try:
         # Get crop coordinates and original filename
-        original_name = request.form['original_filename']
+        original_name = secure_filename(request.form['original_filename'])
+        upload_path = user_upload_path(user_id, original_name)
+        if upload_path is None:
+            return jsonify({'error': 'Invalid filename'}), 400
         x = int(float(request.form['x']))
         y = int(float(request.form['y']))
         width = int(float(request.form['width']))
         height = int(float(request.form['height']))
-        user_upload_dir = os.path.join('users', user_id, 'uploads')
-        user_convert_dir = os.path.join('users', user_id, 'converted')
-
-        # Path to original TIFF
-        upload_path = os.path.join(user_upload_dir, original_name)
-        
-        # Open and crop original image
-        with Image.open(upload_path) as img:
-            # Perform crop on original TIFF
-            cropped_img = img.crop((x, y, x + width, y + height))
-            
-            # Overwrite original file with cropped version
-            cropped_img.save(upload_path, format='TIFF', compression='tiff_deflate')
-            # 🔄 Update original and current dimensions to CROPPED size
-            session['original_dimensions'] = cropped_img.size  # (new_width, new_height)
-            session['current_dimensions'] = cropped_img.size
-
-
-        # Generate new PNG preview from updated TIFF
-        unique_id = str(uuid.uuid4())
-        output_filename = f"{unique_id}.png"
-        output_path = os.path.join(user_convert_dir, output_filename)
-        cropped_img.save(output_path, "PNG")
 
+        # The viewer keeps showing the rectangle of the rendition it was cropped from
+        view_rendition = ImageSource(upload_path, array=get_rendition(user_id, upload_path)).read_region(
+            x, y, width, height)
+
+        # The first crop moves the full-resolution upload aside (a rename, no copy); every crop
+        # is then read from it, so crops can be changed or undone without re-uploading
+        original_path = uncropped_original_path(user_id, original_name)
+        crop_box = session.get('crop_box')
+        if crop_box is None or not os.path.exists(original_path):
+            with open_image(upload_path) as source:
+                crop_box = (0, 0, source.width, source.height)
+            os.replace(upload_path, original_path)
+        box_x, box_y, box_w, box_h = crop_box
+
+        # Read only the crop rectangle from the original (tiles/strips outside it are never decoded)
+        with open_image(original_path) as source:
+            region = source.read_region(box_x + x, box_y + y, width, height)
+        # Outside the current working image stays black, as when cropping the working image itself
+        region[:max(0, -y)] = 0
+        region[max(0, box_h - y):] = 0
+        region[:, :max(0, -x)] = 0
+        region[:, max(0, box_w - x):] = 0
+        cropped_img = Image.fromarray(region)
+
+        # The cropped version becomes the working upload
+        replace_upload(upload_path, cropped_img)
+        invalidate_image(upload_path)
+        invalidate_upload(user_id)
+        remember_array(user_id, upload_path, region)
+        session['crop_box'] = (box_x + x, box_y + y, width, height)
+        # 🔄 Update original and current dimensions to CROPPED size
+        session['original_dimensions'] = cropped_img.size  # (new_width, new_height)
+        session['current_dimensions'] = cropped_img.size
+
+        # New preview + tiles from the cropped rendition
         return jsonify({
-            'converted_url': f'/converted/{output_filename}',
+            **publish_view(user_id, upload_path, view_rendition),
             'original_name': original_name,  # Keep original filename
             'base_name': os.path.splitext(original_name)[0],
             'original_extension': 'tiff'
@@ -435,8 +488,56 @@ def upload_cropped_file():
     except Exception as e:
         print(f"Error in upload-cropped: {str(e)}")
         return jsonify({'error': f"Server error: {str(e)}"}), 500
+
+
+@app.route('/undo-crop', methods=['POST'])
+def undo_crop():
+    """Restore the full-resolution upload kept by /upload-cropped"""
+    user_id = session['user_id']
+    try:
+        original_name = secure_filename(request.form['original_filename'])
+        upload_path = user_upload_path(user_id, original_name)
+        if upload_path is None:
+            return jsonify({'error': 'Invalid filename'}), 400
+        original_path = uncropped_original_path(user_id, original_name)
+        crop_box = session.get('crop_box')
+        if crop_box is None or not os.path.exists(original_path):
+            return jsonify({'error': 'No crop to undo'}), 400
+
+        os.replace(original_path, upload_path)
+        session.pop('crop_box', None)
+        invalidate_image(upload_path)
+        invalidate_upload(user_id)
+        source = get_source(user_id, upload_path)
+        session['original_dimensions'] = (source.width, source.height)
+        session['current_dimensions'] = (source.width, source.height)
+
+        return jsonify({
+            **publish_view(user_id, upload_path),
+            'original_name': original_name,
+            'base_name': os.path.splitext(original_name)[0],
+            'original_extension': os.path.splitext(original_name)[1][1:].lower(),
+            # Where the undone crop sat in the restored image, to move annotations back
+            'offset_x': crop_box[0],
+            'offset_y': crop_box[1]
+        })
+
+    except Exception as e:
+        print(f"Error in undo-crop: {str(e)}")
+        return jsonify({'error': f"Server error: {str(e)}"}), 500
     
-from scripts.detect_tiles import detect_tiles_in_batch
+from scripts.model_cache import DETECT_MODELS, BATCH_MODELS, evict_model
+from scripts.jobs import submit_job, get_job, job_summary, list_jobs, prune_jobs, job_result_paths
+from scripts.training_jobs import (TRAINING_THREADS, submit_training_job, get_training_job, training_job_summary,
+                                   list_training_jobs, active_training_job, cancel_training_job,
+                                   prune_training_jobs, load_training_jobs)
+from scripts.training_events import event_stream
+from scripts.warmup import start_warmup, readiness
+from scripts.storage import (USER_QUOTA_MB, check_quota, schedule_check, forget_user, user_usage, register_protected,
+                             start_storage_manager)
+
+# Results of batch jobs stay downloadable until the job is pruned
+register_protected(job_result_paths)
 
 @app.route('/detect-sgn', methods=['POST'])
 def detect_sgn():
@@ -445,47 +546,28 @@ def detect_sgn():
     user_id = session['user_id']
     threshold = float(request.json.get('threshold', 0.5))
     upload_dir = os.path.join('users', user_id, 'uploads')
-    tiles_dir = os.path.join('users', user_id, 'images', 'tiles')
-    output_txt_dir = os.path.join('users', user_id, 'images', 'tiles_output')
     merged_output_path = os.path.join('users', user_id, 'finaloutput', 'merged_sgn.txt')
 
-    os.makedirs(tiles_dir, exist_ok=True)
-    os.makedirs(output_txt_dir, exist_ok=True)
-
     try:
         files = [f for f in os.listdir(upload_dir) if f.lower().endswith(('.tif', '.tiff', '.png', '.jpg', '.jpeg'))]
         if not files:
             return jsonify({'error': 'No image found. Upload an image first.'}), 400
 
         image_path = os.path.join(upload_dir, files[0])
-        model_path = 'snapshots/SGN_best.pt'
-
-        # Step 1: Split into tiles
-        subprocess.run(['python3', 'scripts/split_image.py', '--image', image_path, '--output', tiles_dir], check=True)
-
-        # Step 2: Detect all tiles using GPU-efficient function
-        detect_tiles_in_batch(tiles_dir, output_txt_dir, model_path, threshold)
-
-        # Get image size from original
-        with Image.open(image_path) as img:
-            image_width, image_height = img.size
+        model_path = DETECT_MODELS['SGN']
 
-        # Step 3: Merge annotations
-        subprocess.run([
-            'python3', 'scripts/merge_annotations.py',
-            '--tiles', output_txt_dir,
-            '--output', merged_output_path,
-            '--image_width', str(image_width),
-            '--image_height', str(image_height)
-        ], check=True)
-
-        with open(merged_output_path, 'r') as f:
-            final_annotation = f.read()
+        # Split, detect and merge in-process (no tile PNGs / subprocesses)
+        tile_stats = {}
+        final_annotation, image_width, image_height = run_tiled_detection(
+            image_path, model_path, threshold, output_path=merged_output_path, stats=tile_stats,
+            image=get_source(user_id, image_path)
+        )
 
         return jsonify({
             "annotations": final_annotation,
             "image_width": image_width,
-            "image_height": image_height
+            "image_height": image_height,
+            "tiles": tile_stats
         })
 
     except Exception as e:
@@ -496,47 +578,28 @@ def detect_cd3():
     user_id = session['user_id']
     threshold = float(request.json.get('threshold', 0.5))
     upload_dir = os.path.join('users', user_id, 'uploads')
-    tiles_dir = os.path.join('users', user_id, 'images', 'tiles')
-    output_txt_dir = os.path.join('users', user_id, 'images', 'tiles_output')
     merged_output_path = os.path.join('users', user_id, 'finaloutput', 'merged_cd3.txt')
 
-    os.makedirs(tiles_dir, exist_ok=True)
-    os.makedirs(output_txt_dir, exist_ok=True)
-
     try:
         files = [f for f in os.listdir(upload_dir) if f.lower().endswith(('.tif', '.tiff', '.png', '.jpg', '.jpeg'))]
         if not files:
             return jsonify({'error': 'No image found. Upload an image first.'}), 400
 
         image_path = os.path.join(upload_dir, files[0])
-        model_path = 'snapshots/cd3_v2.pt'  # Changed model path
-
-        # Split into tiles
-        subprocess.run(['python3', 'scripts/split_image.py', '--image', image_path, '--output', tiles_dir], check=True)
-
-        # Detect all tiles
-        detect_tiles_in_batch(tiles_dir, output_txt_dir, model_path, threshold)
-
-        # Get image size
-        with Image.open(image_path) as img:
-            image_width, image_height = img.size
-
-        # Merge annotations
-        subprocess.run([
-            'python3', 'scripts/merge_annotations.py',
-            '--tiles', output_txt_dir,
-            '--output', merged_output_path,
-            '--image_width', str(image_width),
-            '--image_height', str(image_height)
-        ], check=True)
+        model_path = DETECT_MODELS['CD3']
 
-        with open(merged_output_path, 'r') as f:
-            final_annotation = f.read()
+        # Split, detect and merge in-process (no tile PNGs / subprocesses)
+        tile_stats = {}
+        final_annotation, image_width, image_height = run_tiled_detection(
+            image_path, model_path, threshold, output_path=merged_output_path, stats=tile_stats,
+            image=get_source(user_id, image_path)
+        )
 
         return jsonify({
             "annotations": final_annotation,
             "image_width": image_width,
-            "image_height": image_height
+            "image_height": image_height,
+            "tiles": tile_stats
         })
 
     except Exception as e:
@@ -549,12 +612,35 @@ def detect_cd3():
 def serve_converted(filename):
     user_id = session['user_id']
     converted_dir = os.path.join('users', user_id, 'converted')
-    return send_from_directory(converted_dir, filename)
+    response = send_from_directory(converted_dir, filename)
+    # Preview names are unique per image version
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/full-image/<view_id>.png')
+def serve_full_image(view_id):
+    """Full-resolution rendition of the current view, encoded on first request"""
+    user_id = session['user_id']
+    view = session.get('full_view')
+    if not view or view['id'] != view_id:
+        return jsonify({'error': 'Image is no longer current'}), 404
+    converted_dir = os.path.join('users', user_id, 'converted')
+    filename = f'{secure_filename(view_id)}_full.png'
+    if not os.path.exists(os.path.join(converted_dir, filename)):
+        save_full_resolution(get_rendition(user_id, view['path']), os.path.join(converted_dir, filename))
+    response = send_from_directory(converted_dir, filename)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
 
 @app.route('/save-training-data', methods=['POST'])
 def save_training_data():
     user_id = session['user_id']
     try:
+        quota_error = check_quota(user_id)
+        if quota_error:
+            return jsonify({'error': quota_error}), 507
+
         # Generate unique ID
         unique_id = str(uuid.uuid4())
         
@@ -656,47 +742,28 @@ def detect_madm():
     user_id = session['user_id']
     threshold = float(request.json.get('threshold', 0.5))
     upload_dir = os.path.join('users', user_id, 'uploads')
-    tiles_dir = os.path.join('users', user_id, 'images', 'tiles')
-    output_txt_dir = os.path.join('users', user_id, 'images', 'tiles_output')
     merged_output_path = os.path.join('users', user_id, 'finaloutput', 'merged_madm.txt')
 
-    os.makedirs(tiles_dir, exist_ok=True)
-    os.makedirs(output_txt_dir, exist_ok=True)
-
     try:
         files = [f for f in os.listdir(upload_dir) if f.lower().endswith(('.tif', '.tiff', '.png', '.jpg', '.jpeg'))]
         if not files:
             return jsonify({'error': 'No image found. Upload an image first.'}), 400
 
         image_path = os.path.join(upload_dir, files[0])
-        model_path = 'snapshots/MADM_v3.pt'
-
-        # Step 1: Split into tiles
-        subprocess.run(['python3', 'scripts/split_image.py', '--image', image_path, '--output', tiles_dir], check=True)
+        model_path = DETECT_MODELS['MADM']
 
-        # Step 2: Detect all tiles using GPU-efficient function
-        detect_tiles_in_batch(tiles_dir, output_txt_dir, model_path, threshold)
-
-        # Get image size from original
-        with Image.open(image_path) as img:
-            image_width, image_height = img.size
-
-        # Step 3: Merge annotations
-        subprocess.run([
-            'python3', 'scripts/merge_annotations.py',
-            '--tiles', output_txt_dir,
-            '--output', merged_output_path,
-            '--image_width', str(image_width),
-            '--image_height', str(image_height)
-        ], check=True)
-
-        with open(merged_output_path, 'r') as f:
-            final_annotation = f.read()
+        # Split, detect and merge in-process (no tile PNGs / subprocesses)
+        tile_stats = {}
+        final_annotation, image_width, image_height = run_tiled_detection(
+            image_path, model_path, threshold, output_path=merged_output_path, stats=tile_stats,
+            image=get_source(user_id, image_path)
+        )
 
         return jsonify({
             "annotations": final_annotation,
             "image_width": image_width,
-            "image_height": image_height
+            "image_height": image_height,
+            "tiles": tile_stats
         })
 
     except Exception as e:
@@ -705,255 +772,239 @@ def detect_madm():
 
 
 
-@app.route('/train-saved', methods=['POST'])
-def train_saved_data():
-    import shutil
-    import time
-    import os
-    from PIL import Image
-    from ultralytics import YOLO
-    from scripts.normalization import normalize_image
-    import subprocess
-
-    user_id       = session['user_id']
+def training_class_names(model_type):
+    """Class names written to data.yaml for a model type (None if it cannot be trained)"""
+    if model_type == 'SGN':
+        return ["SGN"]
+    if model_type == 'CD3':
+        # Hard-code CD3 at index 7 (with dummies at 0–6)
+        return [f"dummy{i}" for i in range(7)] + ["CD3"]
+    if model_type == 'MADM':
+        # ❗ ADDED: Explicitly define MADM class names
+        # These should match the classes your MADM model is designed to detect.
+        # This list is derived from your CLASS_MAP in the /save-training-data route.
+        return [
+            "SGN", 
+            "yellow neuron", 
+            "yellow astrocyte", 
+            "green neuron", 
+            "green astrocyte", 
+            "red neuron", 
+            "red astrocyte",
+            "CD3"
+        ]
+    return None
+
+
+def run_saved_training(ctx, user_id, model_type, epochs, num_images):
+    """Body of a /train-saved job, run by the training scheduler (scripts/training_jobs.py).
+
+    Builds the dataset, trains in a child process, then runs k-fold validation; returns the
+    result shown to the user. Cancelling the job terminates the running child process.
+    """
+    from scripts.dataset_builder import build_dataset
+
     snapshot_dir  = os.path.join('users', user_id, 'snapshots')
     yolo_base     = os.path.join('users', user_id, 'yolo_dataset')
     img_dir       = os.path.join(yolo_base, 'images')
     lbl_dir       = os.path.join(yolo_base, 'labels')
+    class_names   = training_class_names(model_type)
 
-    try:
-        # --- 1. Parse inputs ---
-        num_images = int(request.form.get('num_images', '0'))
-        model_type = request.form.get('model_type', 'SGN')
-        epochs     = int(request.form.get('epochs', '20'))
+    ctx.set_progress(stage='preparing')
 
-        print(f"[DEBUG] Inputs → num_images={num_images}, model_type={model_type}, epochs={epochs}")
+    # --- 2. Collect SAVED DATA (uploaded images + annotations) ---
+    print("[DEBUG] Collecting saved training data...")
 
-        # --- 2. Prep dataset dirs ---
-        shutil.rmtree(yolo_base, ignore_errors=True)
-        os.makedirs(img_dir, exist_ok=True)
-        os.makedirs(lbl_dir, exist_ok=True)
-        
-
-        # --- 3. Copy SAVED DATA (uploaded manually) ---
-# --- 3. COPY SAVED DATA (uploaded images + annotations) ---
-        print("[DEBUG] Copying saved training data...")
+    saved_data_dir = os.path.join('users', user_id, 'saved_data')
+    saved_annot_dir = os.path.join('users', user_id, 'saved_annotations')
 
-        saved_data_dir = os.path.join('users', user_id, 'saved_data')
-        saved_annot_dir = os.path.join('users', user_id, 'saved_annotations')
+    saved_imgs = [
+        f for f in os.listdir(saved_data_dir)
+        if f.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff'))
+    ]
 
-        saved_imgs = [
-            f for f in os.listdir(saved_data_dir)
-            if f.lower().endswith(('.jpg', '.jpeg', '.png', '.tif', '.tiff'))
+    print(f"[DEBUG] Found {len(saved_imgs)} saved images")
+
+    entries = []
+    for fname in saved_imgs:
+        # Get the unique_id from the filename (format is "{unique_id}_{original_name}")
+        unique_id = fname.split('_')[0]
+        src_lbl = os.path.join(saved_annot_dir, f"{unique_id}.txt")
+        if not os.path.exists(src_lbl):
+            print(f"[WARNING] Label missing for {fname} (expected {src_lbl})")
+            src_lbl = None
+        entries.append((os.path.join(saved_data_dir, fname), src_lbl))
+
+    # --- 3. Collect optional pre-train images + labels ---
+    pre_dir = 'pre_train_MADM' if model_type == 'MADM' else 'pre_train_SGN' if model_type == 'SGN' else 'pre_train_CD3'
+    labels_sub = os.path.join(pre_dir, 'yolo_labels')  # Changed from 'yolo_labels' to 'labels'
+    print(f"[DEBUG] Using pre-train dir: {pre_dir}")
+
+    all_imgs = sorted([
+        f for f in os.listdir(pre_dir)
+        if f.lower().endswith(('.png','.jpg','.jpeg','.tif','.tiff'))
+    ])
+    selected = all_imgs[:num_images]
+    print(f"[DEBUG] Using {len(selected)} pre-train images")
+
+    for fname in selected:
+        base = os.path.splitext(fname)[0] + '.txt'
+
+        # Check multiple possible label locations
+        possible_label_locations = [
+            os.path.join(labels_sub, base),  # Primary location
+            os.path.join(pre_dir, base),     # Alternative location
+            os.path.join(pre_dir, 'labels', base)  # Another common location
         ]
+        src_lbl = next((loc for loc in possible_label_locations if os.path.exists(loc)), None)
+        if src_lbl is None:
+            print(f"[WARNING] Could not find label for {fname} in any of these locations:")
+            for loc in possible_label_locations:
+                print(f"  - {loc}")
+        entries.append((os.path.join(pre_dir, fname), src_lbl))
+
+    # --- 4. Build the dataset: only images not converted before are normalized (in the
+    # worker processes); the rest are linked from the content-hash cache ---
+    stats = build_dataset(entries, img_dir, lbl_dir, os.path.join('users', user_id, 'dataset_cache'))
+    print(f"[DEBUG] Dataset built: {stats}")
+
+    ctx.check_cancelled()
+
+    # --- 5. Write data.yaml ---
+    nc = len(class_names)
+    yaml_path = os.path.join(yolo_base, 'data.yaml')
+    with open(yaml_path, 'w') as f:
+        f.write(f"path: {os.path.abspath(yolo_base)}\n")
+        f.write("train: images\nval: images\n")
+        f.write(f"nc: {nc}\n")
+        f.write(f"names: {class_names}\n")
+
+    print(f"[DEBUG] data.yaml written with nc={nc}, names={class_names}")
+
+    # --- 6. Train model (child process, see scripts/train_job.py) ---
+    weights = BATCH_MODELS.get(model_type, BATCH_MODELS['MADM'])
+    run_name = f"run_{int(time.time())}"
+    print(f"[DEBUG] Starting YOLO train, weights={weights}, run name={run_name}")
+    ctx.set_progress(stage='train', epoch=0, epochs=epochs, run_name=run_name)
+    progress_path = os.path.join(snapshot_dir, f"{run_name}.progress.json")
+    ctx.run_process([
+        'python3', '-m', 'scripts.train_job',
+        '--data', yaml_path,
+        '--weights', weights,
+        '--epochs', str(epochs),
+        '--imgsz', '640',
+        '--batch', '4',
+        '--workers', str(min(8, TRAINING_THREADS)),
+        '--project', snapshot_dir,
+        '--name', run_name,
+        '--progress', progress_path
+    ], progress_path=progress_path)
+
+    best = os.path.join(snapshot_dir, run_name, 'weights', 'best.pt')
+    if not os.path.exists(best):
+        raise RuntimeError('best.pt not found after training')
+
+    final = os.path.join(snapshot_dir, f"{model_type}_finetuned.pt")
+    shutil.copy2(best, final)
+    print(f"[DEBUG] Copied final model to {final}")
+
+    # --- 7. Check sample count ---
+    valid_samples = [
+        f for f in os.listdir(img_dir)
+        if os.path.exists(os.path.join(lbl_dir, os.path.splitext(f)[0] + '.txt'))
+    ]
+    if len(valid_samples) < 5:
+        msg = f"Not enough data for K-Fold (need 5, got {len(valid_samples)})"
+        print(f"[WARNING] {msg}")
+        return {
+            'model_url': f"/{final}",
+            'kfold_results': msg
+        }
 
-        print(f"[DEBUG] Found {len(saved_imgs)} saved images")
+    # --- 8. Run K-Fold ---
+    kfold_dir = os.path.join(snapshot_dir, run_name, 'kfold')
+    os.makedirs(kfold_dir, exist_ok=True)
+
+    cmd = [
+        'python3', '-m', 'scripts.kfold_train',
+        '--image_dir', img_dir,
+        '--label_dir', lbl_dir,
+        '--weights', best,
+        '--epochs', str(epochs),
+        '--output_dir', kfold_dir,
+        '--nc', str(nc),
+        '--progress', os.path.join(kfold_dir, 'progress.json'),
+        '--names'
+    ] + class_names
+
+    print(f"[DEBUG] Running 5-fold validation...")
+    ctx.set_progress(stage='kfold', eta_seconds=None, folds_done=0, folds=5)
+    ctx.run_process(cmd, progress_path=os.path.join(kfold_dir, 'progress.json'))
+
+    # --- 9. Read kfold_results.txt ---
+    kfold_result_path = os.path.join(kfold_dir, 'kfold_results.txt')
+    kfold_text = ""
+    if os.path.exists(kfold_result_path):
+        with open(kfold_result_path, 'r') as f:
+            kfold_text = f.read()
+
+    return {
+        'model_url': f"/snapshots/{model_type}_finetuned.pt",
+        'kfold_results': kfold_text
+    }
 
-        for fname in saved_imgs:
-            src_img = os.path.join(saved_data_dir, fname)
-            dst_img = os.path.join(img_dir, fname)
 
-            # Normalize to RGB
-            try:
-                if fname.lower().endswith(('.tif', '.tiff')):
-                    temp_path = os.path.join(img_dir, f"temp_{fname}.png")
-                    normalize_image(src_img, temp_path)
-                    with Image.open(temp_path) as im:
-                        if im.mode != 'RGB':
-                            im = im.convert('RGB')
-                        im.save(dst_img)
-                    os.remove(temp_path)
-                else:
-                    with Image.open(src_img) as im:
-                        if im.mode != 'RGB':
-                            im = im.convert('RGB')
-                        im.save(dst_img)
-                print(f"[DEBUG] Copied image: {fname}")
-            except Exception as e:
-                print(f"[ERROR] Failed to copy image {fname}: {e}")
-                continue
-
-            # Copy corresponding annotation
-            # Get the unique_id from the filename (format is "{unique_id}_{original_name}")
-            unique_id = fname.split('_')[0]
-            src_lbl = os.path.join(saved_annot_dir, f"{unique_id}.txt")
-            dst_lbl = os.path.join(lbl_dir, os.path.splitext(fname)[0] + '.txt')
-
-            if os.path.exists(src_lbl):
-                shutil.copy2(src_lbl, dst_lbl)
-                print(f"[DEBUG] Copied label: {src_lbl} to {dst_lbl}")
-            else:
-                print(f"[WARNING] Label missing for {fname} (expected {src_lbl})")
-
-
-        # --- 4. Copy optional pre-train images + labels ---
-        # Copy optional pre-train images + labels ---
-        pre_dir = 'pre_train_MADM' if model_type == 'MADM' else 'pre_train_SGN' if model_type == 'SGN' else 'pre_train_CD3'
-        labels_sub = os.path.join(pre_dir, 'yolo_labels')  # Changed from 'yolo_labels' to 'labels'
-        print(f"[DEBUG] Using pre-train dir: {pre_dir}")
-
-        all_imgs = sorted([
-            f for f in os.listdir(pre_dir)
-            if f.lower().endswith(('.png','.jpg','.jpeg','.tif','.tiff'))
-        ])
-        selected = all_imgs[:num_images]
-        print(f"[DEBUG] Copying {len(selected)} pre-train images")
-
-        for fname in selected:
-            src_img = os.path.join(pre_dir, fname)
-            dst_img = os.path.join(img_dir, fname)
+@app.route('/train-saved', methods=['POST'])
+def train_saved_data():
+    """Queue a training run on the saved data; poll /training-jobs/<job_id> for its progress"""
+    user_id = session['user_id']
+    try:
+        # --- 1. Parse inputs ---
+        num_images = int(request.form.get('num_images', '0'))
+        model_type = request.form.get('model_type', 'SGN')
+        epochs     = int(request.form.get('epochs', '20'))
 
-            try:
-                if fname.lower().endswith(('.tif', '.tiff')):
-                    temp_path = os.path.join(img_dir, f"temp_{fname}.png")
-                    normalize_image(src_img, temp_path)
-                    with Image.open(temp_path) as im:
-                        if im.mode != 'RGB':
-                            im = im.convert('RGB')
-                        im.save(dst_img)
-                    os.remove(temp_path)
-                else:
-                    with Image.open(src_img) as im:
-                        if im.mode != 'RGB':
-                            im = im.convert('RGB')
-                        im.save(dst_img)
-                print(f"[DEBUG] Copied and normalized image {fname}")
-            except Exception as e:
-                print(f"[ERROR] image copy {fname}: {e}")
-                continue  # Skip to next image if current one fails
+        print(f"[DEBUG] Inputs → num_images={num_images}, model_type={model_type}, epochs={epochs}")
 
-            # Handle label copying more robustly
-            base = os.path.splitext(fname)[0] + '.txt'
-            
-            # Check multiple possible label locations
-            possible_label_locations = [
-                os.path.join(labels_sub, base),  # Primary location
-                os.path.join(pre_dir, base),     # Alternative location
-                os.path.join(pre_dir, 'labels', base)  # Another common location
-            ]
-            
-            label_copied = False
-            for src_lbl in possible_label_locations:
-                if os.path.exists(src_lbl):
-                    dst_lbl = os.path.join(lbl_dir, base)
-                    shutil.copy2(src_lbl, dst_lbl)
-                    print(f"[DEBUG] Copied label from {src_lbl} to {dst_lbl}")
-                    label_copied = True
-                    break
-            
-            if not label_copied:
-                print(f"[WARNING] Could not find label for {fname} in any of these locations:")
-                for loc in possible_label_locations:
-                    print(f"  - {loc}")
-
-        # --- 5. Write data.yaml ---
-               # --- 5. Write data.yaml ---
-        if model_type == 'SGN':
-            class_names = ["SGN"]
-        elif model_type == 'CD3':
-            # Hard-code CD3 at index 7 (with dummies at 0–6)
-            class_names = [f"dummy{i}" for i in range(7)] + ["CD3"]
-        elif model_type == 'MADM':
-            # ❗ ADDED: Explicitly define MADM class names
-            # These should match the classes your MADM model is designed to detect.
-            # This list is derived from your CLASS_MAP in the /save-training-data route.
-            class_names = [
-                "SGN", 
-                "yellow neuron", 
-                "yellow astrocyte", 
-                "green neuron", 
-                "green astrocyte", 
-                "red neuron", 
-                "red astrocyte",
-                "CD3"
-            ]
-        else:
+        if training_class_names(model_type) is None:
             # Fallback for any unexpected model type
             return jsonify({'error': f'Unsupported model type for training: {model_type}'}), 400
 
-        # Simplified and more robust nc calculation
-        nc = len(class_names)
-        
-        yaml_path = os.path.join(yolo_base, 'data.yaml')
-        with open(yaml_path, 'w') as f:
-            f.write(f"path: {os.path.abspath(yolo_base)}\n")
-            f.write("train: images\nval: images\n")
-            f.write(f"nc: {nc}\n")
-            f.write(f"names: {class_names}\n")
-
-        print(f"[DEBUG] data.yaml written with nc={nc}, names={class_names}")
-
-        # --- 6. Train model ---
-        weights = 'snapshots/SGN_best.pt' if model_type == 'SGN' else 'snapshots/cd3_v3.pt' if model_type == 'CD3' else 'snapshots/MADM_v3.pt'
-        run_name = f"run_{int(time.time())}"
-        print(f"[DEBUG] Starting YOLO train, weights={weights}, run name={run_name}")
-        model = YOLO(weights)
-        model.train(
-            data=yaml_path,
-            epochs=epochs,
-            imgsz=640,
-            batch=4,
-            project=snapshot_dir,
-            name=run_name,
-            save=True
-        )
+        # One run per session at a time: they share the session's dataset directory
+        active = active_training_job(user_id)
+        if active is not None:
+            return jsonify({'error': 'A training run is already queued or running',
+                            'job_id': active['id'], 'status_url': f"/training-jobs/{active['id']}"}), 409
 
-        best = os.path.join(snapshot_dir, run_name, 'weights', 'best.pt')
-        time.sleep(3)
+        params = {'model_type': model_type, 'epochs': epochs, 'num_images': num_images}
+        job_id = submit_training_job(
+            user_id, params, lambda ctx: run_saved_training(ctx, user_id, model_type, epochs, num_images))
+        return jsonify({'job_id': job_id, 'status_url': f'/training-jobs/{job_id}'}), 202
 
-        if not os.path.exists(best):
-            return jsonify({'error': 'best.pt not found after training'}), 500
+    except Exception as e:
+        print(f"[ERROR] /train-saved exception: {e}")
+        return jsonify({'error': str(e)}), 500
 
-        final = os.path.join(snapshot_dir, f"{model_type}_finetuned.pt")
-        shutil.copy2(best, final)
-        print(f"[DEBUG] Copied final model to {final}")
 
-        # --- 7. Check sample count ---
-        valid_samples = [
-            f for f in os.listdir(img_dir)
-            if os.path.exists(os.path.join(lbl_dir, os.path.splitext(f)[0] + '.txt'))
-        ]
-        if len(valid_samples) < 5:
-            msg = f"Not enough data for K-Fold (need 5, got {len(valid_samples)})"
-            print(f"[WARNING] {msg}")
-            return jsonify({
-                'model_url': f"/{final}",
-                'kfold_results': msg
-            })
-
-        # --- 8. Run K-Fold ---
-        kfold_dir = os.path.join(snapshot_dir, run_name, 'kfold')
-        os.makedirs(kfold_dir, exist_ok=True)
-
-        cmd = [
-            'python3', 'scripts/kfold_train.py',
-            '--image_dir', img_dir,
-            '--label_dir', lbl_dir,
-            '--weights', best,
-            '--epochs', str(epochs),
-            '--output_dir', kfold_dir,
-            '--nc', str(nc),
-            '--names'
-        ] + class_names
-
-        print(f"[DEBUG] Running 5-fold validation...")
-        subprocess.run(cmd, check=True)
-
-        # --- 9. Read kfold_results.txt ---
-        kfold_result_path = os.path.join(kfold_dir, 'kfold_results.txt')
-        kfold_text = ""
-        if os.path.exists(kfold_result_path):
-            with open(kfold_result_path, 'r') as f:
-                kfold_text = f.read()
+@app.route('/training-jobs', methods=['GET'])
+def list_user_training_jobs():
+    return jsonify(list_training_jobs(session['user_id']))
 
-        return jsonify({
-            'model_url': f"/snapshots/{model_type}_finetuned.pt",
-            'kfold_results': kfold_text
-        })
 
-    except Exception as e:
-        print(f"[ERROR] /train-saved exception: {e}")
-        return jsonify({'error': str(e)}), 500
+@app.route('/training-jobs/<job_id>', methods=['GET'])
+def training_job_status(job_id):
+    """Status of a training run: queue position, stage, epoch, ETA, latest metrics, result"""
+    job = get_training_job(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(training_job_summary(job))
+
+
+@app.route('/training-jobs/<job_id>/cancel', methods=['POST'])
+def cancel_training(job_id):
+    if not cancel_training_job(job_id, session['user_id']):
+        return jsonify({'error': 'Job not found or already finished'}), 404
+    return jsonify(training_job_summary(get_training_job(job_id, session['user_id'])))
 
 
     
@@ -965,8 +1016,10 @@ def detect_custom():
         model_path = os.path.join('users', user_id, 'uploads', secure_filename(pt_file.filename))
         pt_file.save(model_path)
         
-        annotations, img_width, img_height, error = detect_with_tiling(user_id, model_path)
+        tile_stats = {}
+        annotations, img_width, img_height, error = detect_with_tiling(user_id, model_path, stats=tile_stats)
         
+        evict_model(model_path)
         try:
             os.remove(model_path)
         except:
@@ -978,7 +1031,8 @@ def detect_custom():
         return jsonify({
             "annotations": annotations,
             "image_width": img_width,
-            "image_height": img_height
+            "image_height": img_height,
+            "tiles": tile_stats
         })
 
     except Exception as e:
@@ -988,7 +1042,6 @@ def detect_custom():
 def scale_image():
     user_id = session['user_id']
     upload_dir = os.path.join('users', user_id, 'uploads')
-    converted_dir = os.path.join('users', user_id, 'converted')
     try:
         diameter = float(request.form['diameter'])
         target_diameter = float(request.form.get('target_diameter', 34))
@@ -999,45 +1052,52 @@ def scale_image():
         if not os.path.exists(original_path):
             return jsonify({'error': 'Original image not found'}), 400
 
-        with Image.open(original_path) as img:
-            # Get ORIGINAL dimensions from the actual file
-            original_width, original_height = img.size
-            
-            # Calculate scaling factor based on ORIGINAL dimensions
-            scaling_factor = target_diameter / diameter
-            
-            # Calculate new dimensions
-            new_width = int(original_width * scaling_factor)
-            new_height = int(original_height * scaling_factor)
-            
-            # Create scaled version (don't overwrite original)
-            base_name = os.path.splitext(original_filename)[0]
-            scaled_filename = f"{base_name}_scaled.tiff"
-            scaled_path = os.path.join(upload_dir, scaled_filename)
-            
-            resized_img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            resized_img.save(scaled_path, format='TIFF', compression='tiff_deflate')
-            
-            # Create normalized preview from SCALED image
-            unique_id = str(uuid.uuid4())
-            output_filename = f"{unique_id}.png"
-            output_path = os.path.join(converted_dir, output_filename)
-            normalize_image(scaled_path, output_path)
-
-            # Store scaling info in session
-            session['current_scaling_factor'] = scaling_factor
-            session['current_scaled_filename'] = scaled_filename
-            session['original_dimensions'] = (original_width, original_height)
-            session['current_dimensions'] = (new_width, new_height)
-
-            return jsonify({
-                'converted_url': f'/converted/{output_filename}',
-                'scaling_factor': scaling_factor,
-                'new_width': new_width,
-                'new_height': new_height,
-                'scaled_filename': scaled_filename
-            })
-            
+        source = get_source(user_id, original_path)
+        # Get ORIGINAL dimensions from the actual file
+        original_width, original_height = source.width, source.height
+        
+        # Calculate scaling factor based on ORIGINAL dimensions
+        scaling_factor = target_diameter / diameter
+        
+        # Calculate new dimensions
+        new_width = int(original_width * scaling_factor)
+        new_height = int(original_height * scaling_factor)
+        
+        # Create scaled version (don't overwrite original)
+        base_name = os.path.splitext(original_filename)[0]
+        scaled_filename = f"{base_name}_scaled.tiff"
+        scaled_path = os.path.join(upload_dir, scaled_filename)
+        
+        # Scaled variants are cached per image content and size, so a diameter that was already
+        # used is neither resampled nor encoded again: the scaled image is exported with the
+        # annotations, so it is LANCZOS and deflate-compressed like before, and that TIFF is
+        # cached next to the variant and linked into place
+        resized, cached_path = scaled_variant(original_path, new_width, new_height, 'lanczos',
+                                              cache_dir=os.path.join('users', user_id, 'scaled'),
+                                              prepare=lambda _: source)
+        export_path = exported_variant(resized, cached_path)
+        unchanged = os.path.exists(scaled_path) and os.path.samefile(export_path, scaled_path)
+        link_variant(export_path, scaled_path)
+        # The same file as last time keeps its cached rendition (and so its normalization)
+        if not unchanged:
+            invalidate_image(scaled_path)
+            remember_array(user_id, scaled_path, resized)
+
+        # Store scaling info in session
+        session['current_scaling_factor'] = scaling_factor
+        session['current_scaled_filename'] = scaled_filename
+        session['original_dimensions'] = (original_width, original_height)
+        session['current_dimensions'] = (new_width, new_height)
+
+        # Preview + tiles of the SCALED image (kept in memory, not re-read from disk)
+        return jsonify({
+            **publish_view(user_id, scaled_path, view_key=os.path.splitext(os.path.basename(cached_path))[0]),
+            'scaling_factor': scaling_factor,
+            'new_width': new_width,
+            'new_height': new_height,
+            'scaled_filename': scaled_filename
+        })
+        
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
@@ -1050,20 +1110,102 @@ def detect_finetuned():
         if not os.path.exists(model_path):
             return jsonify({'error': 'No trained model found'}), 400
         
-        annotations, img_width, img_height, error = detect_with_tiling(user_id, model_path)
+        tile_stats = {}
+        annotations, img_width, img_height, error = detect_with_tiling(user_id, model_path, stats=tile_stats)
         if error:
             return jsonify({'error': error}), 500
 
         return jsonify({
             "annotations": annotations,
             "image_width": img_width,
-            "image_height": img_height
+            "image_height": img_height,
+            "tiles": tile_stats
         })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def save_batch_upload(batch_dir):
+    """
+    Save the images (and optional custom model) of a batch request into batch_dir and read
+    the form params. Returns (image_paths, params) where params are batch_process_image_yolo kwargs.
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    # clear existing files
+    clear_folder(batch_dir)
+
+    for f in request.files.getlist('images'):
+        fname = secure_filename(f.filename)
+        if not fname:
+            continue
+        f.save(os.path.join(batch_dir, fname))
+
+    detection_type = request.form.get('detection_type', 'SGN')
+    threshold = float(request.form.get('threshold', 0.5))
+    cell_diameter = float(request.form.get('cell_diameter', 34))
+    custom_model_file = request.files.get('custom_model')
+
+    model_path = None
+    if detection_type == 'custom' and custom_model_file:
+        cp = os.path.join(batch_dir, 'custom_model.pt')
+        custom_model_file.save(cp)
+        model_path = cp
+
+    image_paths = []
+    for fname in sorted(os.listdir(batch_dir)):
+        if fname == 'custom_model.pt':
+            continue
+        input_path = os.path.join(batch_dir, fname)
+        if not os.path.isfile(input_path):
+            continue
+        if not fname.lower().endswith(('.tif', '.tiff', '.png', '.jpg', '.jpeg')):
+            continue
+        image_paths.append(input_path)
+
+    params = {
+        'detection_type': detection_type,
+        'threshold': threshold,
+        'model_path': model_path,
+        'cell_diameter': cell_diameter
+    }
+    return image_paths, params
+
+
+def batch_result_entries(results):
+    """ZIP entries for exact pairs: tiff + matching .txt (or an error file for failures)"""
+    for res in results:
+        orig = res.get('original_filename', 'unknown')
+        if not res.get('success'):
+            err_name = os.path.splitext(orig)[0] + '_ERROR.txt'
+            yield data_entry(err_name, res.get('error', 'processing error'))
+            continue
+
+        tiff_path = res.get('tiff_path')
+        txt_path = res.get('txt_path')
+
+        # defensive existence checks
+        if tiff_path and os.path.exists(tiff_path):
+            yield file_entry(tiff_path)
+        else:
+            # include a small note if the TIFF is missing
+            yield data_entry(os.path.splitext(orig)[0] + '_MISSING_TIFF.txt', f"Missing TIFF for {orig}")
+
+        if txt_path and os.path.exists(txt_path):
+            yield file_entry(txt_path)
+        else:
+            yield data_entry(os.path.splitext(orig)[0] + '_MISSING_TXT.txt', f"Missing TXT for {orig}")
+
+
+def zip_response(entries, download_name):
+    """Stream a ZIP built from entries as the response body (images stored, text deflated)"""
+    return Response(
+        stream_zip(entries),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+    )
+
+
 @app.route('/batch-detect', methods=['POST'])
 def batch_detect():
     user_id = session.get('user_id')
@@ -1071,93 +1213,136 @@ def batch_detect():
         return jsonify({'error': 'No active user session'}), 400
 
     try:
-        # 1) Save uploaded files into a temp per-user directory
+        if not request.files.getlist('images'):
+            return jsonify({'error': 'No images uploaded for batch.'}), 400
+
+        quota_error = check_quota(user_id)
+        if quota_error:
+            return jsonify({'error': quota_error}), 507
+
+        # 1-2) Save uploaded files into a temp per-user directory and read form params
         batch_dir = os.path.join('users', user_id, 'batch_temp')
-        os.makedirs(batch_dir, exist_ok=True)
-        # clear existing files
-        clear_folder(batch_dir)
+        image_paths, params = save_batch_upload(batch_dir)
+        model_path = params['model_path']
+
+        # 3-4) Process several images concurrently while the ZIP streams out; results come back
+        #      in upload order, each written as its exact tiff + txt pair (or an error file)
+        def process(input_path):
+            res = batch_process_image_yolo(user_id, input_path, **params)
+            # add original filename for diagnostics
+            res['original_filename'] = os.path.basename(input_path)
+            return res
+
+        def results():
+            try:
+                yield from map_images(process, image_paths)
+            finally:
+                # 5) Cleanup temp upload folder (keep finaloutput intact)
+                if model_path:
+                    evict_model(model_path)
+                shutil.rmtree(batch_dir, ignore_errors=True)
+
+        def entries():
+            # A small manifest goes first, so the response headers and the first bytes go out
+            # right away instead of after the first image has been detected
+            yield data_entry('manifest.txt', ''.join(f'{os.path.basename(p)}\n' for p in image_paths))
+            yield from batch_result_entries(results())
+
+        return zip_response(entries(), 'batch_results.zip')
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 
-        uploaded_files = request.files.getlist('images')
-        if not uploaded_files:
+@app.route('/jobs/batch-detect', methods=['POST'])
+def submit_batch_detect_job():
+    """Asynchronous /batch-detect: returns a job id immediately, images are processed by the job pool"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'No active user session'}), 400
+
+    try:
+        if not request.files.getlist('images'):
             return jsonify({'error': 'No images uploaded for batch.'}), 400
 
-        for f in uploaded_files:
-            fname = secure_filename(f.filename)
-            if not fname:
-                continue
-            f.save(os.path.join(batch_dir, fname))
-
-        # 2) Read form params
-        detection_type = request.form.get('detection_type', 'SGN')
-        threshold = float(request.form.get('threshold', 0.5))
-        cell_diameter = float(request.form.get('cell_diameter', 34))
-        custom_model_file = request.files.get('custom_model')
-
-        model_path = None
-        if detection_type == 'custom' and custom_model_file:
-            cp = os.path.join(batch_dir, 'custom_model.pt')
-            custom_model_file.save(cp)
-            model_path = cp
-
-        # 3) Process images one-by-one and collect results
-        results = []
-        for fname in sorted(os.listdir(batch_dir)):
-            if fname == 'custom_model.pt':
-                continue
-            input_path = os.path.join(batch_dir, fname)
-            if not os.path.isfile(input_path):
-                continue
-            if not fname.lower().endswith(('.tif', '.tiff', '.png', '.jpg', '.jpeg')):
-                continue
-
-            res = batch_process_image_yolo(user_id, input_path, detection_type, threshold, model_path=model_path, cell_diameter=cell_diameter)
-            # add original filename for diagnostics
-            res['original_filename'] = fname
-            results.append(res)
-
-        # 4) Build ZIP with exact pairs: tiff + matching .txt (or an error file for failures)
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for res in results:
-                orig = res.get('original_filename', 'unknown')
-                if not res.get('success'):
-                    err_name = os.path.splitext(orig)[0] + '_ERROR.txt'
-                    zf.writestr(err_name, res.get('error', 'processing error'))
-                    continue
-
-                tiff_path = res.get('tiff_path')
-                txt_path = res.get('txt_path')
-
-                # defensive existence checks
-                if tiff_path and os.path.exists(tiff_path):
-                    zf.write(tiff_path, os.path.basename(tiff_path))
-                else:
-                    # include a small note if the TIFF is missing
-                    zf.writestr(os.path.splitext(orig)[0] + '_MISSING_TIFF.txt', f"Missing TIFF for {orig}")
-
-                if txt_path and os.path.exists(txt_path):
-                    zf.write(txt_path, os.path.basename(txt_path))
-                else:
-                    zf.writestr(os.path.splitext(orig)[0] + '_MISSING_TXT.txt', f"Missing TXT for {orig}")
-
-        zip_buffer.seek(0)
-
-        # 5) Cleanup temp upload folder (keep finaloutput intact)
-        try:
+        quota_error = check_quota(user_id)
+        if quota_error:
+            return jsonify({'error': quota_error}), 507
+
+        # Each job gets its own input dir so concurrent jobs never clear each other's files
+        batch_dir = os.path.join('users', user_id, 'batch_jobs', uuid.uuid4().hex)
+        image_paths, params = save_batch_upload(batch_dir)
+        if not image_paths:
             shutil.rmtree(batch_dir, ignore_errors=True)
-        except Exception:
-            pass
+            return jsonify({'error': 'No supported images in batch.'}), 400
 
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='batch_results.zip'
-        )
+        def run_image(input_path, progress):
+            res = batch_process_image_yolo(user_id, input_path, progress=progress, **params)
+            res['original_filename'] = os.path.basename(input_path)
+            return res
+
+        def finish(job):
+            if params['model_path']:
+                evict_model(params['model_path'])
+            shutil.rmtree(batch_dir, ignore_errors=True)
+            schedule_check(user_id)
+
+        items = [(os.path.basename(p), p) for p in image_paths]
+        job_id = submit_job(user_id, 'batch-detect', items, run_image, on_finish=finish)
+        return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}'}), 202
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+
+@app.route('/jobs', methods=['GET'])
+def list_user_jobs():
+    return jsonify(list_jobs(session['user_id']))
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    summary = job_summary(job)
+    for img in summary['images']:
+        if img['status'] in ('done', 'failed'):
+            img['download_url'] = f"/jobs/{job_id}/results/{img['name']}"
+    summary['download_url'] = f'/jobs/{job_id}/download'
+    return jsonify(summary)
+
+
+@app.route('/jobs/<job_id>/results/<name>', methods=['GET'])
+def job_image_result(job_id, name):
+    """ZIP with the tiff + txt pair (or error file) of one finished image"""
+    job = get_job(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    image = next((img for img in job['images'] if img['name'] == name), None)
+    if image is None:
+        return jsonify({'error': 'Image not found in job'}), 404
+    if image['result'] is None:
+        return jsonify({'error': 'Image not finished yet', 'status': image['status']}), 409
+
+    return zip_response(batch_result_entries([image['result']]), f'{os.path.splitext(name)[0]}_results.zip')
+
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def job_download(job_id):
+    """Bulk ZIP of every image of the job that has finished so far"""
+    job = get_job(job_id, session['user_id'])
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    results = [img['result'] for img in job['images'] if img['result'] is not None]
+    if not results:
+        return jsonify({'error': 'No finished images yet'}), 409
+
+    return zip_response(batch_result_entries(results), 'batch_results.zip')
+
     
 
 
@@ -1168,14 +1353,11 @@ def serve_snapshot(filename):
     return send_from_directory(snapshot_dir, filename)
 
 
-from flask import jsonify, session
-from tensorflow.python.summary.summary_iterator import summary_iterator
-import os
-import glob
-
 @app.route('/events-data', methods=['GET'])
 def events_data():
+    """Scalars of the newest training run; ?since=<step> returns only the points after that step"""
     user_id = session.get('user_id')
+    since = request.args.get('since', type=int)
     base_path = os.path.join('users', user_id, 'snapshots')
     run_directories = glob.glob(os.path.join(base_path, 'run_*'))
     if not run_directories:
@@ -1186,43 +1368,38 @@ def events_data():
     if not os.path.exists(log_dir):
         return jsonify({'error': f'Log dir not found: {log_dir}'}), 404
 
-    # Find all event files directly in train/
+    # Records still being written are left for the next poll, so the live file can be read
     event_files = glob.glob(os.path.join(log_dir, 'events.out.tfevents.*'))
-    # Only pick files older than 5 seconds (to avoid reading during flush)
-    now = time.time()
-    event_files = [f for f in event_files if now - os.path.getmtime(f) > 5]
     if not event_files:
         return jsonify({'error': 'No event files found in train/'}), 404
 
     # Pick the newest one
-    event_files.sort(key=os.path.getmtime, reverse=True)
-    latest = event_files[0]
-    print(f"[events-data] ✅ Reading from: {latest}")
+    latest = max(event_files, key=os.path.getmtime)
+    scalars = read_scalars(latest, since=since)
 
-    scalars = {}
-    for e in summary_iterator(latest):
-        if not e.summary:
-            continue
-        for v in e.summary.value:
-            val = get_scalar_value(v)
-            if val is not None:
-                print(f"✅ Tag: {v.tag}, value: {val}")
-                scalars.setdefault(v.tag, []).append({
-                    'step': e.step,
-                    'wall_time': e.wall_time,
-                    'value': val
-                })
-
-
-    if not scalars:
+    if not scalars and since is None:
         return jsonify({'error': 'No scalar values found'}), 404
 
     return jsonify(scalars)
 
 
+@app.route('/training-events', methods=['GET'])
+def training_events():
+    """Server-Sent Events with the scalars and progress of the run being trained (see
+    scripts/training_events.py); open tabs of a session share one watcher"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return jsonify({'error': 'No active user session'}), 400
+    return Response(
+        event_stream(user_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 def delete_expired_sessions():
+    prune_jobs()
+    flush_activity()   # so recently active sessions are not mistaken for expired ones
     now = datetime.datetime.utcnow()  # Use UTC time
     users_dir = 'users'
     for user_id in os.listdir(users_dir):
@@ -1231,17 +1408,57 @@ def delete_expired_sessions():
             try:
                 mod_time = datetime.datetime.utcfromtimestamp(os.path.getmtime(user_path))
                 if (now - mod_time).total_seconds() > 86400:
+                    forget_session(user_id)
+                    forget_user(user_id)
                     shutil.rmtree(user_path)
                     print(f"Cleaned expired session: {user_id}")
             except Exception as e:
                 print(f"Error cleaning {user_id}: {str(e)}")
-# Initialize scheduler
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=delete_expired_sessions, trigger="interval", hours=24)
-scheduler.start()
 
-# Shut down the scheduler when exiting the app
-atexit.register(lambda: scheduler.shutdown())
+
+def start_scheduler():
+    from apscheduler.schedulers.background import BackgroundScheduler
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(func=delete_expired_sessions, trigger="interval", hours=24)
+    scheduler.start()
+
+    # Shut down the scheduler when exiting the app
+    atexit.register(lambda: scheduler.shutdown())
+
+
+@app.route('/storage', methods=['GET'])
+def storage_usage():
+    """Disk usage of the current session (bytes, per directory) and its quota"""
+    user_id = session['user_id']
+    return jsonify({**user_usage(user_id), 'quota': USER_QUOTA_MB * 1024 * 1024})
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """503 until the background warm-up (scheduler, heavy imports, CAT_WARMUP_MODELS) is done,
+    and for good if one of its steps failed; load balancers should only route to instances answering 200"""
+    state = readiness()
+    return jsonify(state), 200 if state['ready'] else 503
+
+
+def start_background_services():
+    """Start-up work of the serving process (never of the CPU pool's worker processes)"""
+    # Training runs of earlier processes are listed again (unfinished ones as interrupted)
+    load_training_jobs()
+    # Heavy libraries are imported in the background (see scripts/warmup.py), not at module load
+    start_warmup([('scheduler', start_scheduler), ('storage', start_storage_manager)])
+
+
+# Worker processes of the CPU pool (scripts/batch_pipeline.py) import the main module again as
+# __mp_main__; only `python app.py` (__main__) or a WSGI server's import starts the services
+if __name__ != '__mp_main__':
+    start_background_services()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+# batch_pipeline.py - parallel per-image execution for batch detection
+#
+# A batch image goes through three stages:
+#   1) normalize + OpenCV area resize -> detection image  (CPU, worker process)
+#   2) tiled YOLO inference on the detection image         (shared inference executor)
+#   3) LANCZOS resize + TIFF of the original (exported)    (CPU, worker process, overlaps stage 2)
+# Resized images of stages 1 and 3 are scaled variants (scripts/scaled_variants.py), so
+# re-running a batch with the same images and diameter skips both resizes.
+# The CPU stages run in a process pool so they scale with cores instead of fighting over
+# the GIL; inference stays in this process so every worker shares one cached model.
+
+import os
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from scripts.normalization import normalized_rendition
+from scripts.image_source import open_image
+from scripts.scaled_variants import DETECTION_RESAMPLE, scaled_variant, link_variant
+# Disable decompression bomb protection for large TIFF files
+Image.MAX_IMAGE_PIXELS = None
+
+# Images in flight at once for a synchronous /batch-detect request
+BATCH_WORKERS = int(os.environ.get('CAT_BATCH_WORKERS', min(4, os.cpu_count() or 1)))
+# Worker processes for the CPU stages (0 = run them in the calling thread)
+CPU_PROCESSES = int(os.environ.get('CAT_BATCH_PROCESSES', min(4, os.cpu_count() or 1)))
+# Concurrent inference calls; each one holds a decoded detection image plus the model's activations
+INFERENCE_WORKERS = int(os.environ.get('CAT_INFERENCE_WORKERS', 1))
+
+_pool_lock = threading.Lock()
+_cpu_pool = None
+_inference_executor = ThreadPoolExecutor(max_workers=max(1, INFERENCE_WORKERS), thread_name_prefix='cat-infer')
+_image_executor = ThreadPoolExecutor(max_workers=max(1, BATCH_WORKERS), thread_name_prefix='cat-batch')
+# Threads that wait on worker-pool results for submit_cpu, separate from the image slots
+_cpu_waiters = ThreadPoolExecutor(max_workers=max(1, CPU_PROCESSES), thread_name_prefix='cat-cpu')
+
+
+def _mp_context():
+    # The pool is created lazily, when app.py already runs request, job and model threads, so
+    # forking this process could copy a lock some other thread holds. Workers come from a
+    # forkserver instead (spawn where it is not available): a fresh process that preloads only
+    # the stage modules (numpy/PIL). Each worker still imports the parent's main module again,
+    # as __mp_main__, so app.py starts its background services only outside of that.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['scripts.batch_pipeline'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _get_cpu_pool():
+    global _cpu_pool
+    with _pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ProcessPoolExecutor(max_workers=CPU_PROCESSES, mp_context=_mp_context())
+        return _cpu_pool
+
+
+def _reset_cpu_pool():
+    global _cpu_pool
+    with _pool_lock:
+        if _cpu_pool is not None:
+            _cpu_pool.shutdown(wait=False, cancel_futures=True)
+        _cpu_pool = None
+
+
+def run_cpu(fn, *args):
+    """Run a CPU-bound stage in the worker pool and return its result.
+
+    fn must be a module-level function. A crashed worker (e.g. OOM on a huge TIFF)
+    replaces the pool so later images are not affected.
+    """
+    if CPU_PROCESSES <= 0:
+        return fn(*args)
+    try:
+        return _get_cpu_pool().submit(fn, *args).result()
+    except BrokenProcessPool:
+        _reset_cpu_pool()
+        raise RuntimeError(f"worker process died while running {fn.__name__}")
+
+
+def submit_cpu(fn, *args):
+    """Like run_cpu but returns a future, so the caller can overlap it with inference."""
+    return _cpu_waiters.submit(run_cpu, fn, *args)
+
+
+def run_inference(fn, *args, **kwargs):
+    """Run fn on the shared, bounded inference executor and return its result."""
+    return _inference_executor.submit(fn, *args, **kwargs).result()
+
+
+def map_images(fn, items):
+    """Yield fn(item) for every item in order, with up to BATCH_WORKERS images in flight."""
+    futures = [_image_executor.submit(fn, item) for item in items]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # Client went away: drop the images that have not started yet
+        for future in futures:
+            future.cancel()
+
+
+def _detection_pixels(image_path):
+    """Normalized 8-bit RGB pixels, the same image normalize_image would write."""
+    normalized, _ = normalized_rendition(image_path)
+    if normalized is None:
+        with Image.open(image_path) as img:
+            normalized = np.asarray(img.convert('RGB'))
+    return normalized
+
+
+def prepare_detection_image(image_path, cache_dir, detection_type, cell_diameter):
+    """Stage 1: normalized (and optionally rescaled) image used for detection, as a cached variant.
+
+    Returns (detection_path, det_w, det_h, scaling_factor).
+    """
+    with open_image(image_path) as source:
+        w, h = source.width, source.height
+
+    scaling_factor = 1.0
+    target_diameter = 20.0 if detection_type == 'CD3' else 34.0
+    det_w, det_h = w, h
+    if float(cell_diameter) != target_diameter:
+        scaling_factor = target_diameter / float(cell_diameter)
+        det_w = max(1, int(round(w * scaling_factor)))
+        det_h = max(1, int(round(h * scaling_factor)))
+
+    # Only feeds detection, so the fast OpenCV resampling is used
+    _, detection_path = scaled_variant(image_path, det_w, det_h, DETECTION_RESAMPLE, cache_dir=cache_dir,
+                                       variant='normalized', prepare=_detection_pixels)
+    return detection_path, det_w, det_h, scaling_factor
+
+
+def write_scaled_copy(src_path, dst_path, width, height, cache_dir):
+    """Stage 3: resized copy of the ORIGINAL image, mode/bit depth preserved, saved as TIFF."""
+    # Exported to the user, so LANCZOS; mode is not converted, which preserves the original
+    # "look" (e.g. pitch black)
+    _, cached_path = scaled_variant(src_path, width, height, 'lanczos', cache_dir=cache_dir)
+    return link_variant(cached_path, dst_path)
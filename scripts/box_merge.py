@@ -0,0 +1,142 @@
+# box_merge.py - global de-duplication of tile detections (NMS / weighted box fusion)
+
+import os
+import numpy as np
+
+MERGE_METHOD = os.environ.get('CAT_MERGE_METHOD', 'nms')       # 'nms', 'wbf' or 'none'
+MERGE_IOU_THRESHOLD = float(os.environ.get('CAT_MERGE_IOU', 0.5))
+MERGE_MATCH_METRIC = os.environ.get('CAT_MERGE_METRIC', 'ios')  # 'iou' or 'ios' (intersection over smaller box)
+
+# Offsets to the "forward" half of a cell's 3x3 neighbourhood, so every unordered pair is visited once
+_NEIGHBOUR_OFFSETS = ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1))
+
+
+def _expand_ranges(starts, counts):
+    """Concatenate [start, start + count) for every row without a Python loop."""
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    steps = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + steps
+
+
+def candidate_pairs(boxes):
+    """Return (i, j) index arrays of boxes that may overlap, using a uniform spatial grid.
+
+    The cell size is the largest box side, so overlapping boxes always sit in the same or
+    adjacent cells and the pair count stays close to linear in the number of boxes.
+    """
+    n = len(boxes)
+    if n < 2:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    cell = max(float(np.max(boxes[:, 2:] - boxes[:, :2])), 1.0)
+    ix = np.floor(boxes[:, 0] / cell).astype(np.int64)
+    iy = np.floor(boxes[:, 1] / cell).astype(np.int64)
+    ix -= ix.min() - 1
+    iy -= iy.min() - 1
+    rows = iy.max() + 2
+    keys = ix * rows + iy
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    first, second = [], []
+    for dx, dy in _NEIGHBOUR_OFFSETS:
+        target = (ix + dx) * rows + (iy + dy)
+        lo = np.searchsorted(sorted_keys, target, side='left')
+        hi = np.searchsorted(sorted_keys, target, side='right')
+        counts = hi - lo
+        i = np.repeat(np.arange(n), counts)
+        j = order[_expand_ranges(lo, counts)]
+        if dx == 0 and dy == 0:
+            keep = i < j
+            i, j = i[keep], j[keep]
+        first.append(i)
+        second.append(j)
+
+    return np.concatenate(first), np.concatenate(second)
+
+
+def pairwise_overlap(boxes, i, j, metric=MERGE_MATCH_METRIC):
+    """Vectorized IoU (or intersection over the smaller box) for index pairs."""
+    a, b = boxes[i], boxes[j]
+    iw = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    ih = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    inter = iw * ih
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    if metric == 'ios':
+        denom = np.minimum(area_a, area_b)
+    else:
+        denom = area_a + area_b - inter
+    return inter / np.maximum(denom, 1e-9)
+
+
+def merge_boxes(boxes, scores, classes, method=MERGE_METHOD, iou_threshold=MERGE_IOU_THRESHOLD,
+                metric=MERGE_MATCH_METRIC, tiles=None):
+    """De-duplicate detections across the whole image.
+
+    method='nms' keeps the highest scoring box of every overlapping group (per class);
+    method='wbf' replaces each group with its score-weighted average box and the group's
+    best score. tiles optionally gives the tile each box was detected in: boxes of one tile
+    were already de-duplicated by the model's own NMS, so only pairs from different tiles
+    are merged (with 'ios', two touching cells of one tile would otherwise be merged too).
+    Only boxes that actually overlap something are visited in Python, so
+    merge time is dominated by the vectorized grid and overlap computations.
+    Returns (boxes, scores, classes).
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+    classes = np.asarray(classes).reshape(-1).astype(np.int64)
+    if method == 'none' or len(boxes) < 2:
+        return boxes, scores, classes
+
+    i, j = candidate_pairs(boxes)
+    same = classes[i] == classes[j]
+    if tiles is not None:
+        tiles = np.asarray(tiles).reshape(-1)
+        same &= tiles[i] != tiles[j]
+    i, j = i[same], j[same]
+    hit = pairwise_overlap(boxes, i, j, metric) > iou_threshold
+    i, j = i[hit], j[hit]
+    if len(i) == 0:
+        return boxes, scores, classes
+
+    # rank 0 = best score; orient every pair as (better, worse)
+    order = np.argsort(-scores, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    swap = rank[i] > rank[j]
+    better = np.where(swap, j, i)
+    worse = np.where(swap, i, j)
+
+    # CSR adjacency from each box to the lower-scored boxes it may suppress, in rank order
+    by_rank = np.argsort(rank[better], kind='stable')
+    better, worse = better[by_rank], worse[by_rank]
+    heads, starts, counts = np.unique(better, return_index=True, return_counts=True)
+    heads_in_order = np.argsort(rank[heads], kind='stable')
+
+    owner = np.arange(len(boxes))
+    suppressed = np.zeros(len(boxes), dtype=bool)
+    for k in heads_in_order:
+        head = heads[k]
+        if suppressed[head]:
+            continue
+        victims = worse[starts[k]:starts[k] + counts[k]]
+        victims = victims[~suppressed[victims]]
+        suppressed[victims] = True
+        owner[victims] = head
+
+    keep = np.flatnonzero(~suppressed)
+    if method != 'wbf':
+        return boxes[keep], scores[keep], classes[keep]
+
+    weights = scores.astype(np.float64)
+    fused = np.zeros((len(boxes), 4), dtype=np.float64)
+    np.add.at(fused, owner, boxes * weights[:, None])
+    total = np.bincount(owner, weights=weights, minlength=len(boxes))
+    best = np.zeros(len(boxes), dtype=np.float32)
+    np.maximum.at(best, owner, scores)
+    fused = fused[keep] / np.maximum(total[keep], 1e-9)[:, None]
+    return fused.astype(np.float32), best[keep], classes[keep]
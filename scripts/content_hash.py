@@ -0,0 +1,51 @@
+# content_hash.py - content digests of files, remembered per (path, mtime, size)
+#
+# Used as the identity of an image/model in the detection and scaled-variant caches, so a
+# re-uploaded or copied file with the same bytes hits the same entries. Kept free of heavy
+# imports so the batch worker processes can use it.
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+_HASH_CHUNK = 4 * 1024 * 1024
+# Files whose digest is remembered (least recently used are forgotten first)
+DIGEST_CACHE_ENTRIES = int(os.environ.get('CAT_DIGEST_CACHE_ENTRIES', 4096))
+
+_lock = threading.Lock()
+_digests = OrderedDict()   # abspath -> ((mtime_ns, size), content digest), least recently used first
+
+
+def file_digest(path):
+    """blake2b of a file's bytes, remembered per (path, mtime, size) so unchanged files are hashed once."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = (st.st_mtime_ns, st.st_size)
+    with _lock:
+        cached = _digests.get(path)
+        if cached is not None and cached[0] == stat_key:
+            _digests.move_to_end(path)
+            return cached[1]
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _lock:
+        _digests[path] = (stat_key, digest)
+        _digests.move_to_end(path)
+        while len(_digests) > max(1, DIGEST_CACHE_ENTRIES):
+            _digests.popitem(last=False)
+    return digest
+
+
+def forget_digest(path):
+    """Drop the remembered digest of path (its bytes are about to change)."""
+    with _lock:
+        _digests.pop(os.path.abspath(path), None)
+
+
+def clear_digests():
+    with _lock:
+        _digests.clear()
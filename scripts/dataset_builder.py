@@ -0,0 +1,112 @@
+# dataset_builder.py - incremental YOLO training dataset for /train-saved
+#
+# Every training image is converted once (normalized to 8-bit RGB, same pixels as
+# normalize_image + convert('RGB')) into a content-addressed cache: <cache_dir>/<digest><ext>.
+# Building the dataset then only converts images whose bytes were never seen before, in the
+# batch worker processes, and hard-links the cached files into yolo_dataset/images. Files of
+# the previous build that are still wanted are left in place; stale ones are removed.
+
+import os
+import uuid
+import shutil
+from PIL import Image
+from scripts.content_hash import file_digest
+from scripts.normalization import normalized_rendition
+from scripts.batch_pipeline import submit_cpu
+from scripts.scaled_variants import link_variant
+
+
+def convert_training_image(src_path, dst_path):
+    """Write src_path as the 8-bit RGB image used for training (written once, no temp PNG)."""
+    rgb = None
+    if src_path.lower().endswith(('.tif', '.tiff')):
+        rgb, _ = normalized_rendition(src_path)
+    if rgb is not None:
+        img = Image.fromarray(rgb)
+    else:
+        with Image.open(src_path) as im:
+            img = im.convert('RGB') if im.mode != 'RGB' else im.copy()
+    ext = os.path.splitext(dst_path)[1].lower()
+    tmp_path = f'{os.path.splitext(dst_path)[0]}.{uuid.uuid4().hex}.tmp{ext}'
+    img.save(tmp_path)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+def _sync_labels(labels, lbl_dir):
+    for name in os.listdir(lbl_dir):
+        if name not in labels:
+            os.remove(os.path.join(lbl_dir, name))
+    # Label files are tiny and may be edited in place, so they are always copied
+    for name, src_lbl in labels.items():
+        shutil.copy2(src_lbl, os.path.join(lbl_dir, name))
+
+
+def build_dataset(entries, img_dir, lbl_dir, cache_dir):
+    """Bring img_dir/lbl_dir to exactly the given (image_path, label_path or None) entries.
+
+    Images keep their file name (a later entry with the same name replaces an earlier one, as
+    when they were copied in order). Returns {'images', 'converted', 'cached', 'failed', 'labels'}.
+    """
+    os.makedirs(img_dir, exist_ok=True)
+    os.makedirs(lbl_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    wanted = {}
+    for src_img, src_lbl in entries:
+        wanted[os.path.basename(src_img)] = (src_img, src_lbl)
+
+    # Convert the images never seen before, in parallel; the rest are already cached
+    cached, pending = {}, {}
+    for fname, (src_img, _) in wanted.items():
+        try:
+            cache_path = os.path.join(cache_dir, file_digest(src_img) + os.path.splitext(fname)[1].lower())
+        except OSError as e:
+            print(f"[dataset] cannot read {src_img}: {e}")
+            continue
+        if os.path.exists(cache_path):
+            cached[fname] = cache_path
+        elif cache_path not in pending.values():
+            pending[fname] = cache_path
+        else:
+            cached[fname] = cache_path   # same bytes under another name, converted below
+    futures = {fname: submit_cpu(convert_training_image, wanted[fname][0], cache_path)
+               for fname, cache_path in pending.items()}
+
+    stats = {'images': 0, 'converted': 0, 'cached': len(cached), 'failed': 0, 'labels': 0}
+    ready = {}
+    for fname, future in futures.items():
+        try:
+            ready[fname] = future.result()
+            stats['converted'] += 1
+        except Exception as e:
+            print(f"[dataset] failed to convert {wanted[fname][0]}: {e}")
+            stats['failed'] += 1
+    for fname, cache_path in cached.items():
+        if os.path.exists(cache_path):
+            ready[fname] = cache_path
+        else:
+            stats['failed'] += 1
+
+    # Images: link from the cache, drop what the previous build had and this one does not
+    for name in os.listdir(img_dir):
+        if name not in ready:
+            os.remove(os.path.join(img_dir, name))
+    for fname, cache_path in ready.items():
+        link_variant(cache_path, os.path.join(img_dir, fname))
+    stats['images'] = len(ready)
+
+    labels = {}
+    for fname in ready:
+        src_lbl = wanted[fname][1]
+        if src_lbl:
+            labels[os.path.splitext(fname)[0] + '.txt'] = src_lbl
+    _sync_labels(labels, lbl_dir)
+    stats['labels'] = len(labels)
+
+    # YOLO's label cache (<dataset>/labels.cache) describes the previous file set
+    dataset_dir = os.path.dirname(os.path.normpath(lbl_dir))
+    for name in os.listdir(dataset_dir):
+        if name.endswith('.cache'):
+            os.remove(os.path.join(dataset_dir, name))
+    return stats
@@ -8,6 +8,10 @@ from PIL import Image
 import numpy as np
 from ultralytics import YOLO
 from ultralytics.utils import LOGGER
+try:
+    from scripts.percentile import normalize_to_uint8
+except ImportError:  # run as a script from inside scripts/
+    from percentile import normalize_to_uint8
 LOGGER.setLevel("ERROR")
 
 
@@ -24,10 +28,7 @@ def normalize_image_percentile(img_path, percentile_low=1, percentile_high=99):
     elif arr.ndim != 2:
         raise ValueError("Expected single-channel image")
 
-    p_low = np.percentile(arr, percentile_low)
-    p_high = np.percentile(arr, percentile_high)
-    arr_clipped = np.clip(arr, p_low, p_high)
-    arr_normalized = ((arr_clipped - p_low) * 255.0 / (p_high - p_low)).astype(np.uint8)
+    arr_normalized, _, _ = normalize_to_uint8(arr, percentile_low, percentile_high)
 
     return Image.fromarray(arr_normalized)
 
@@ -1,8 +1,29 @@
 # detect_tiles.py
 import os
 from PIL import Image
-from ultralytics import YOLO
 import numpy as np
+from scripts.tiling import (TILE_SIZE, TILE_OVERLAP, SKIP_BACKGROUND, SKIP_DUPLICATES, iter_tiles, tile_origins,
+                            merge_tile_boxes, background_thresholds, is_background_tile, tile_digest)
+from scripts.box_merge import MERGE_METHOD, merge_boxes
+from scripts.model_cache import model_lock
+
+# Number of tiles sent to the model per forward pass
+DETECT_BATCH_SIZE = int(os.environ.get('CAT_DETECT_BATCH_SIZE', 16))
+# ultralytics' own limit on boxes kept per image (here: per tile)
+DEFAULT_MAX_DET = 300
+
+_torch_configured = False
+
+def _torch():
+    """torch, imported on first use (it takes seconds and most requests never need it)."""
+    global _torch_configured
+    import torch
+    if not _torch_configured:
+        # CPU-only hosts: let torch's intra-op pool span every core for the batched forward passes
+        if not torch.cuda.is_available():
+            torch.set_num_threads(int(os.environ.get('CAT_TORCH_THREADS', os.cpu_count() or 1)))
+        _torch_configured = True
+    return torch
 
 def convert_image_for_detection(img):
     if img.mode != 'RGB':
@@ -18,30 +39,170 @@ def convert_image_for_detection(img):
         img = img.convert('RGB')
     return img
 
-def detect_tiles_in_batch(tiles_dir, output_dir, model_path, threshold):
+def detect_tiles_in_batch(tiles_dir, output_dir, model_path, threshold, batch_size=DETECT_BATCH_SIZE):
     os.makedirs(output_dir, exist_ok=True)
-    model = YOLO(model_path)
+    with model_lock(model_path) as model:
+        _detect_tile_files(model, tiles_dir, output_dir, threshold, batch_size)
 
-    for fname in os.listdir(tiles_dir):
-        if not fname.endswith('.png'):
-            continue
 
-        tile_path = os.path.join(tiles_dir, fname)
-        output_path = os.path.join(output_dir, fname.replace('.png', '.txt'))
+def _detect_tile_files(model, tiles_dir, output_dir, threshold, batch_size):
+    fnames = [f for f in os.listdir(tiles_dir) if f.endswith('.png')]
 
+    for start in range(0, len(fnames), batch_size):
+        chunk = fnames[start:start + batch_size]
         try:
-            img = Image.open(tile_path)
-            width, height = img.size
-            img = convert_image_for_detection(img)
+            tiles = []
+            for fname in chunk:
+                with Image.open(os.path.join(tiles_dir, fname)) as img:
+                    # Same conversion as before, then back to a BGR array for batching
+                    tiles.append(np.asarray(convert_image_for_detection(img))[:, :, ::-1])
+
+            for fname, tile, dets in zip(chunk, tiles, predict_tile_batch(model, tiles, threshold)):
+                height, width = tile.shape[:2]
+                output_path = os.path.join(output_dir, fname.replace('.png', '.txt'))
+                with open(output_path, 'w') as f:
+                    for x1, y1, x2, y2, _, cls in dets:
+                        f.write(f"{int(cls)} {(x1 + x2) / 2 / width:.6f} {(y1 + y2) / 2 / height:.6f} "
+                                f"{(x2 - x1) / width:.6f} {(y2 - y1) / height:.6f}\n")
+
+        except Exception as e:
+            print(f"Error on tiles {chunk[0]}..{chunk[-1]}: {str(e)}")
+
+
+def tile_to_bgr(tile):
+    """Array counterpart of convert_image_for_detection for in-memory tiles.
+
+    Returns a contiguous HxWx3 uint8 array in the BGR order ultralytics expects for numpy input.
+    Palette images must already be expanded (image_source.expand_palette does this on decode).
+    """
+    if tile.dtype == np.uint16:
+        min_val = tile.min()
+        max_val = tile.max()
+        if max_val > min_val:
+            tile = ((tile - min_val) / (max_val - min_val) * 255).astype(np.uint8)
+        else:
+            tile = (tile // 256).astype(np.uint8)
+    elif tile.dtype != np.uint8:
+        tile = np.asarray(Image.fromarray(tile).convert('RGB'))
+
+    if tile.ndim == 2:
+        return np.ascontiguousarray(np.repeat(tile[:, :, None], 3, axis=2))
+    if tile.shape[2] <= 2:
+        # Gray, or gray + alpha (LA): alpha is dropped like PIL's convert('RGB') did
+        return np.ascontiguousarray(np.repeat(tile[:, :, :1], 3, axis=2))
+    # RGB(A) -> BGR, dropping alpha like PIL's convert('RGB') did
+    return np.ascontiguousarray(tile[:, :, 2::-1])
+
+
+def pad_tile(tile, tile_size=TILE_SIZE):
+    """Zero-pad an HxWx3 tile on the bottom/right to tile_size x tile_size so a batch shares one shape."""
+    height, width = tile.shape[:2]
+    if height == tile_size and width == tile_size:
+        return tile
+    padded = np.zeros((tile_size, tile_size, 3), dtype=tile.dtype)
+    padded[:height, :width] = tile
+    return padded
+
 
-            results = model.predict(source=img, conf=threshold, save=False)
+def predict_tile_batch(model, tiles, threshold, tile_size=TILE_SIZE, max_det=DEFAULT_MAX_DET):
+    """Run a single forward pass over a list of HxWx3 uint8 tiles, keeping at most max_det boxes per tile.
 
-            with open(output_path, 'w') as f:
-                for result in results:
-                    for box in result.boxes:
-                        cls = int(box.cls.item())
-                        x_center, y_center, w, h = box.xywhn[0].cpu().numpy()
-                        f.write(f"{cls} {x_center:.6f} {y_center:.6f} {w:.6f} {h:.6f}\n")
+    Tiles are padded to a common shape, all boxes are moved off the device in one
+    transfer, and the result is split back into one (N, 6) array per tile:
+    x1, y1, x2, y2 (pixels, clipped to the unpadded tile), confidence, class.
+    """
+    torch = _torch()
+    size = max(tile_size, max(max(t.shape[:2]) for t in tiles))
+    results = model.predict(source=[pad_tile(t, size) for t in tiles], conf=threshold, max_det=max_det, save=False,
+                            verbose=False)
 
+    counts = [len(r.boxes) for r in results]
+    dets = torch.cat([r.boxes.data for r in results]).cpu().numpy()
+
+    # Clip boxes that run into the padding back to each tile's real extent; drop the ones left empty
+    limits = np.array([[t.shape[1], t.shape[0]] * 2 for t in tiles], dtype=dets.dtype)
+    tile_index = np.repeat(np.arange(len(tiles)), counts)
+    dets[:, :4] = np.clip(dets[:, :4], 0, limits[tile_index])
+    keep = (dets[:, 2] > dets[:, 0]) & (dets[:, 3] > dets[:, 1])
+    dets, tile_index = dets[keep], tile_index[keep]
+
+    counts = np.bincount(tile_index, minlength=len(tiles))
+    return np.split(dets, np.cumsum(counts)[:-1])
+
+
+def detect_image_array(arr, model_path, threshold, tile_size=TILE_SIZE, batch_size=DETECT_BATCH_SIZE,
+                       overlap=TILE_OVERLAP, merge_method=MERGE_METHOD, skip_background=SKIP_BACKGROUND,
+                       stats=None, progress=None, max_det=DEFAULT_MAX_DET, skip_duplicates=SKIP_DUPLICATES,
+                       return_tiles=False):
+    """Tile a decoded image array, run the model on batches of tiles and merge the boxes in memory.
+
+    Tiles overlap by `overlap` pixels; duplicates found in several tiles are removed by a
+    global NMS / weighted box fusion pass (merge_method, see box_merge.merge_boxes).
+    With skip_background, tiles without foreground are not sent to the model; with
+    skip_duplicates, tiles byte-identical to an earlier tile reuse its detections. If a `stats` dict is given it
+    receives total_tiles, skipped_background and skipped_duplicate counts. progress(done, total)
+    is called as tiles are completed. At most max_det boxes are kept per tile.
+    Returns (boxes, scores, classes) with boxes as xyxy pixel coordinates in the full image, plus
+    the tile index of every box with return_tiles (for a later merge_boxes(..., tiles=...)).
+    """
+    tile_results = []
+    tile_dets_by_origin = {}
+    duplicates = []   # (x, y, origin of the identical tile that was run)
+    seen = {}
+    counts = {'total_tiles': 0, 'skipped_background': 0, 'skipped_duplicate': 0}
+    total = len(tile_origins(arr.shape[0], tile_size, overlap)) * len(tile_origins(arr.shape[1], tile_size, overlap))
+
+    if skip_background:
+        floor, min_std = background_thresholds(arr)
+
+    def flush(model, batch):
+        try:
+            dets = predict_tile_batch(model, [tile_to_bgr(tile) for _, _, tile in batch], threshold, tile_size,
+                                      max_det)
+            for (x, y, _), tile_dets in zip(batch, dets):
+                tile_dets_by_origin[(x, y)] = tile_dets
+                tile_results.append((x, y, tile_dets[:, :4], tile_dets[:, 4], tile_dets[:, 5]))
         except Exception as e:
-            print(f"Error on tile {fname}: {str(e)}")
+            print(f"Error on tiles {batch[0][0]}_{batch[0][1]}..{batch[-1][0]}_{batch[-1][1]}: {str(e)}")
+
+    # Shared, already-loaded model from the process-wide cache
+    with model_lock(model_path) as model:
+        batch = []
+        for x, y, tile in iter_tiles(arr, tile_size, overlap):
+            counts['total_tiles'] += 1
+            if skip_background and is_background_tile(tile, floor, min_std):
+                counts['skipped_background'] += 1
+                continue
+            if skip_duplicates:
+                key = tile_digest(tile)
+                if key in seen:
+                    counts['skipped_duplicate'] += 1
+                    duplicates.append((x, y, seen[key]))
+                    continue
+                seen[key] = (x, y)
+            batch.append((x, y, tile))
+            if len(batch) == batch_size:
+                flush(model, batch)
+                batch = []
+                if progress:
+                    progress(counts['total_tiles'], total)
+        if batch:
+            flush(model, batch)
+    if progress:
+        progress(total, total)
+
+    # Identical tiles produce identical detections; reuse them at the duplicate's offset
+    for x, y, origin in duplicates:
+        tile_dets = tile_dets_by_origin.get(origin)
+        if tile_dets is not None:
+            tile_results.append((x, y, tile_dets[:, :4], tile_dets[:, 4], tile_dets[:, 5]))
+
+    if stats is not None:
+        stats.update(counts)
+
+    boxes, scores, classes, tiles = merge_tile_boxes(tile_results, with_tiles=True)
+    if merge_method != 'none':
+        # Merging keeps boxes of its own choosing; their tiles are not tracked past it
+        boxes, scores, classes = merge_boxes(boxes, scores, classes, method=merge_method, tiles=tiles)
+        tiles = None
+    return (boxes, scores, classes, tiles) if return_tiles else (boxes, scores, classes)
@@ -0,0 +1,150 @@
+# detection_cache.py - content-addressed cache of raw detections, re-sliced per threshold
+
+import os
+import threading
+from collections import OrderedDict
+from scripts.tiling import TILE_SIZE, TILE_OVERLAP, SKIP_BACKGROUND
+from scripts.box_merge import merge_boxes, MERGE_METHOD, MERGE_IOU_THRESHOLD, MERGE_MATCH_METRIC
+from scripts.detect_tiles import detect_image_array
+from scripts.image_source import open_image
+from scripts.content_hash import file_digest, forget_digest, clear_digests
+
+# Detections are computed once at this confidence and filtered per request
+DETECTION_FLOOR = float(os.environ.get('CAT_DETECTION_FLOOR', 0.05))
+# Boxes kept per tile on the floor run. ultralytics keeps 300 by default, and a tile crowded
+# with low-confidence boxes would otherwise push out boxes that pass a higher threshold
+FLOOR_MAX_DET = int(os.environ.get('CAT_FLOOR_MAX_DET', 10000))
+# Upper bound for the memory held by cached detections
+DETECTION_CACHE_MB = int(os.environ.get('CAT_DETECTION_CACHE_MB', 256))
+
+_lock = threading.Lock()
+_entries = OrderedDict()   # key -> {'floor', 'boxes', 'scores', 'classes', 'tiles', 'width', 'height', 'stats', 'nbytes', 'path'}
+_key_locks = {}            # key -> lock so concurrent requests for the same image detect only once
+
+
+def detection_key(image_path, model_path, scale=1.0, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                  skip_background=SKIP_BACKGROUND, variant=None):
+    """Everything that changes the raw detections except the confidence threshold."""
+    return (file_digest(image_path), file_digest(model_path), float(scale), tile_size, overlap,
+            bool(skip_background), variant)
+
+
+def _evict_locked():
+    limit = DETECTION_CACHE_MB * 1024 * 1024
+    total = sum(e['nbytes'] for e in _entries.values())
+    while total > limit and len(_entries) > 1:
+        _, entry = _entries.popitem(last=False)
+        total -= entry['nbytes']
+
+
+def _lookup(key, threshold):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry['floor'] <= threshold:
+            _entries.move_to_end(key)
+            return entry
+    return None
+
+
+def _detect_raw(image_path, model_path, threshold, scale, tile_size, overlap, skip_background, progress, image,
+                variant):
+    key = detection_key(image_path, model_path, scale, tile_size, overlap, skip_background, variant)
+    entry = _lookup(key, threshold)
+    if entry is not None:
+        return entry, True
+
+    with _lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    try:
+        with key_lock:
+            return _detect_locked(key, image_path, model_path, threshold, tile_size, overlap, skip_background,
+                                  progress, image)
+    finally:
+        with _lock:
+            _key_locks.pop(key, None)
+
+
+def _detect_locked(key, image_path, model_path, threshold, tile_size, overlap, skip_background, progress, image):
+    entry = _lookup(key, threshold)
+    if entry is not None:
+        return entry, True
+
+    floor = min(DETECTION_FLOOR, threshold)
+    stats = {}
+    if image is not None:
+        height, width = image.shape[:2]
+        boxes, scores, classes, tiles = detect_image_array(image, model_path, floor, tile_size=tile_size,
+                                                           overlap=overlap, merge_method='none',
+                                                           skip_background=skip_background, stats=stats,
+                                                           progress=progress, max_det=FLOOR_MAX_DET,
+                                                           return_tiles=True)
+    else:
+        # Tiles are read from the file one at a time; large TIFFs are never decoded whole
+        with open_image(image_path) as source:
+            height, width = source.shape[:2]
+            boxes, scores, classes, tiles = detect_image_array(source, model_path, floor, tile_size=tile_size,
+                                                               overlap=overlap, merge_method='none',
+                                                               skip_background=skip_background, stats=stats,
+                                                               progress=progress, max_det=FLOOR_MAX_DET,
+                                                               return_tiles=True)
+    entry = {
+        'floor': floor,
+        'boxes': boxes,
+        'scores': scores,
+        'classes': classes,
+        'tiles': tiles,
+        'width': width,
+        'height': height,
+        'stats': stats,
+        'nbytes': boxes.nbytes + scores.nbytes + classes.nbytes + tiles.nbytes,
+        'path': os.path.abspath(image_path),
+    }
+    with _lock:
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        _evict_locked()
+    return entry, False
+
+
+def detect_cached(image_path, model_path, threshold, scale=1.0, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                  merge_method=MERGE_METHOD, skip_background=SKIP_BACKGROUND, stats=None, progress=None,
+                  image=None, variant=None):
+    """Tiled detection with the raw (pre-merge) boxes cached at DETECTION_FLOOR.
+
+    The first call for an image/model runs the model at the floor confidence; any later
+    threshold at or above the floor is answered by filtering the cached scores and merging,
+    without touching the model. scale tags the resampling the caller applied to produce
+    image_path and is part of the key. image is an optional array-like of the pixels to
+    detect on (e.g. a cached source or rendition of image_path); when it is not the file's
+    own pixels, variant names the transformation (e.g. 'normalized') so keys stay distinct.
+    Returns (boxes, scores, classes, width, height).
+    """
+    entry, hit = _detect_raw(image_path, model_path, threshold, scale, tile_size, overlap, skip_background,
+                             progress, image, variant)
+    if stats is not None:
+        stats.update(entry['stats'])
+        stats['cached'] = hit
+    if hit and progress:
+        total = entry['stats'].get('total_tiles', 0)
+        progress(total, total)
+
+    keep = entry['scores'] >= threshold
+    boxes, scores, classes = merge_boxes(entry['boxes'][keep], entry['scores'][keep], entry['classes'][keep],
+                                         method=merge_method, iou_threshold=MERGE_IOU_THRESHOLD,
+                                         metric=MERGE_MATCH_METRIC, tiles=entry['tiles'][keep])
+    return boxes, scores, classes, entry['width'], entry['height']
+
+
+def invalidate_image(image_path):
+    """Forget the digest and every cached detection of image_path (after crop / scale rewrites it)."""
+    path = os.path.abspath(image_path)
+    forget_digest(path)
+    with _lock:
+        for key in [k for k, e in _entries.items() if e['path'] == path]:
+            del _entries[key]
+
+
+def clear_cache():
+    with _lock:
+        _entries.clear()
+    clear_digests()
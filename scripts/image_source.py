@@ -0,0 +1,285 @@
+# image_source.py - region access to large images without decoding the whole file
+#
+# open_image(path) returns an ImageSource that behaves like a read-only (H, W[, S]) array:
+# slicing it with source[y0:y1, x0:x1] decodes only the pixels asked for.
+#   - uncompressed single-page TIFF -> tifffile memory map (the OS pages in what is touched)
+#   - tiled / striped TIFF          -> only the tiles/strips intersecting the slice are decoded
+#   - anything else (PNG, JPEG, ...) -> decoded once with PIL, like load_image_array
+# Palette images (including palette TIFFs) are decoded with PIL and expanded to RGB(A).
+# Peak memory for tiled work is then one tile (plus a few cached segments), not the image.
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import tifffile
+from PIL import Image
+# Disable decompression bomb protection for large TIFF files
+Image.MAX_IMAGE_PIXELS = None
+
+# Rows per band for streamed whole-image passes (statistics, normalization, resizing)
+BAND_ROWS = int(os.environ.get('CAT_BAND_ROWS', 512))
+# Decoded TIFF segments kept per source, so tiles sharing a strip decode it once
+SEGMENT_CACHE_MB = int(os.environ.get('CAT_SEGMENT_CACHE_MB', 64))
+
+
+def expand_palette(img):
+    """Palette images as RGB (RGBA if they have transparency); other modes are returned as is.
+
+    Their pixels are palette indices, which mean nothing to statistics or the model."""
+    if img.mode == 'P':
+        return img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+    if img.mode == 'PA':
+        return img.convert('RGBA')
+    return img
+
+
+def _is_tiff(path):
+    return path.lower().endswith(('.tif', '.tiff'))
+
+
+class ImageSource:
+    """Read-only array-like view of an image file (see module comment)."""
+
+    def __init__(self, path, array=None):
+        self.path = path
+        self.kind = 'array'
+        self.page_count = 1
+        self.in_memory = array is not None
+        self._tif = None
+        self._page = None
+        self._array = None
+        self._segments = OrderedDict()
+        self._segment_bytes = 0
+        self._lock = threading.Lock()
+
+        if array is not None:
+            # Pixels already in memory (e.g. an image that was just written to path)
+            self._array = np.asarray(array)
+        elif _is_tiff(path):
+            try:
+                self._open_tiff(path)
+            except Exception as e:
+                print(f"[image-source] falling back to full decode for {path}: {e}")
+                self.close()
+                self.kind = 'array'
+        if self.kind == 'array':
+            if self._array is None:
+                with Image.open(path) as img:
+                    self._array = np.asarray(expand_palette(img))
+            self.shape = self._array.shape
+            self.dtype = self._array.dtype
+
+    def _open_tiff(self, path):
+        tif = tifffile.TiffFile(path)
+        self._tif = tif
+        series = tif.series[0]
+        page = series.pages[0]
+        self.page_count = len(series.pages)
+        # Only the first page is exposed, matching what PIL decoded before
+        if page.planarconfig != 1 and page.samplesperpixel > 1:
+            raise ValueError('planar (separate) sample layout')
+        if page.imagedepth != 1:
+            raise ValueError('volumetric page')
+        if page.photometric == tifffile.PHOTOMETRIC.PALETTE:
+            raise ValueError('palette image')
+        self._page = page
+        self.dtype = np.dtype(page.dtype)
+        self.shape = (page.imagelength, page.imagewidth) + ((page.samplesperpixel,) if page.samplesperpixel > 1 else ())
+
+        if page.is_memmappable:
+            self._array = tifffile.memmap(path, page=0, mode='r').reshape(self.shape)
+            self.kind = 'memmap'
+        else:
+            if page.is_tiled:
+                self._seg_h, self._seg_w = page.tilelength, page.tilewidth
+            else:
+                self._seg_h, self._seg_w = min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+            self._seg_cols = -(-page.imagewidth // self._seg_w)
+            self.kind = 'segments'
+
+    # -- array protocol -------------------------------------------------------------------
+
+    @property
+    def height(self):
+        return self.shape[0]
+
+    @property
+    def width(self):
+        return self.shape[1]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def cached_bytes(self):
+        """Decoded pixels this source holds in memory (the OS caches memory-mapped pages)."""
+        if self.kind == 'array':
+            return self.nbytes
+        return self._segment_bytes
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows = key[0] if len(key) > 0 else slice(None)
+        cols = key[1] if len(key) > 1 else slice(None)
+        rest = key[2:]
+        if not isinstance(rows, slice) or not isinstance(cols, slice):
+            raise TypeError('ImageSource supports slice indexing on the first two axes only')
+
+        if self.kind == 'memmap' and self._array is None:
+            with self._lock:
+                if self._array is None:
+                    self._array = tifffile.memmap(self.path, page=0, mode='r').reshape(self.shape)
+        if self.kind != 'segments':
+            return np.asarray(self._array[(rows, cols) + rest])
+
+        y0, y1, ystep = rows.indices(self.height)
+        x0, x1, xstep = cols.indices(self.width)
+        if ystep < 1 or xstep < 1:
+            raise ValueError('negative steps are not supported')
+        if ystep == 1:
+            out = self._read(x0, y0, x1, y1)[:, ::xstep]
+        else:
+            # Strided read (e.g. a subsample for statistics): one band at a time
+            band_rows = max(BAND_ROWS // ystep, 1) * ystep
+            bands = []
+            for by in range(y0, y1, band_rows):
+                by1 = min(by + band_rows, y1)
+                bands.append(self._read(x0, by, x1, by1)[::ystep, ::xstep].copy())
+            out = np.concatenate(bands) if bands else np.zeros((0, 0) + self.shape[2:], self.dtype)
+        return out[(slice(None), slice(None)) + rest] if rest else out
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:, :]
+        return arr.astype(dtype) if dtype is not None else arr
+
+    # -- segment decoding -------------------------------------------------------------------
+
+    def _segment(self, index):
+        with self._lock:
+            seg = self._segments.get(index)
+            if seg is not None:
+                self._segments.move_to_end(index)
+                return seg
+
+            if self._tif is None:
+                # Reopened after release()
+                self._tif = tifffile.TiffFile(self.path)
+                self._page = self._tif.series[0].pages[0]
+            page = self._page
+            offset, count = page.dataoffsets[index], page.databytecounts[index]
+            if count:
+                fh = self._tif.filehandle
+                fh.seek(offset)
+                data = fh.read(count)
+            else:
+                data = None
+            seg, _, _ = page.decode(data, index, jpegtables=page.jpegtables)
+            if seg is None:
+                seg = np.zeros((1, self._seg_h, self._seg_w, page.samplesperpixel), self.dtype)
+            seg = seg[0]  # (length, width, samples)
+
+            self._segments[index] = seg
+            self._segment_bytes += seg.nbytes
+            while self._segment_bytes > SEGMENT_CACHE_MB * 1024 * 1024 and len(self._segments) > 1:
+                _, old = self._segments.popitem(last=False)
+                self._segment_bytes -= old.nbytes
+            return seg
+
+    def _read(self, x0, y0, x1, y1):
+        """Decode the rectangle [x0, x1) x [y0, y1) (already clipped to the image)."""
+        samples = self.shape[2] if self.ndim == 3 else 1
+        out = np.empty((max(y1 - y0, 0), max(x1 - x0, 0), samples), self.dtype)
+        if out.size:
+            for sy in range(y0 // self._seg_h, -(-y1 // self._seg_h)):
+                for sx in range(x0 // self._seg_w, -(-x1 // self._seg_w)):
+                    seg = self._segment(sy * self._seg_cols + sx)
+                    top, left = sy * self._seg_h, sx * self._seg_w
+                    ya, yb = max(y0, top), min(y1, top + self._seg_h)
+                    xa, xb = max(x0, left), min(x1, left + self._seg_w)
+                    out[ya - y0:yb - y0, xa - x0:xb - x0] = seg[ya - top:yb - top, xa - left:xb - left]
+        return out if self.ndim == 3 else out[:, :, 0]
+
+    # -- helpers ---------------------------------------------------------------------------
+
+    def read_region(self, x, y, width, height):
+        """Pixels of the box (x, y, x + width, y + height) with PIL crop semantics:
+        parts of the box outside the image are filled with zeros."""
+        out = np.zeros((height, width) + self.shape[2:], self.dtype)
+        xa, ya = max(x, 0), max(y, 0)
+        xb, yb = min(x + width, self.width), min(y + height, self.height)
+        if xb > xa and yb > ya:
+            out[ya - y:yb - y, xa - x:xb - x] = self[ya:yb, xa:xb]
+        return out
+
+    def iter_bands(self, rows=BAND_ROWS):
+        """Yield (y, band) over the full image, `rows` rows at a time."""
+        for y in range(0, self.height, rows):
+            yield y, self[y:min(y + rows, self.height), :]
+
+    def release(self):
+        """Close the file and drop decoded segments; a later read reopens the file.
+
+        Pixels given in memory or decoded whole (kind 'array') are kept."""
+        with self._lock:
+            self._segments.clear()
+            self._segment_bytes = 0
+            if self.kind == 'memmap':
+                self._array = None
+            if self._tif is not None:
+                self._tif.close()
+                self._tif = None
+
+    def close(self):
+        self._segments.clear()
+        self._array = None
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_image(path):
+    """Open an image file for region access (use as a context manager)."""
+    return ImageSource(path)
+
+
+def _pil_array(region):
+    """PIL image of an array region using the modes PIL itself decodes TIFFs into."""
+    return Image.fromarray(np.ascontiguousarray(region))
+
+
+def resize_source(source, width, height, resample=Image.Resampling.LANCZOS, rows=BAND_ROWS):
+    """Resize an ImageSource to (width, height) one output band at a time.
+
+    Each band is resampled from its source rows plus a margin wide enough for the filter,
+    using PIL's box argument, so the result matches a whole-image resize while only the
+    output array and one source band are in memory. Returns a PIL image.
+    """
+    scale_y = source.height / height
+    # LANCZOS reaches 3 source pixels per output pixel when enlarging, 3 * scale when shrinking
+    margin = int(np.ceil(3 * max(scale_y, 1.0))) + 2
+    out = None
+    for oy in range(0, height, rows):
+        oy1 = min(oy + rows, height)
+        sy0, sy1 = oy * scale_y, oy1 * scale_y
+        ry0 = max(int(np.floor(sy0)) - margin, 0)
+        ry1 = min(int(np.ceil(sy1)) + margin, source.height)
+        band = _pil_array(source[ry0:ry1, :])
+        resized = band.resize((width, oy1 - oy), resample, box=(0, sy0 - ry0, source.width, sy1 - ry0))
+        arr = np.asarray(resized)
+        if out is None:
+            out = np.empty((height,) + arr.shape[1:], arr.dtype)
+        out[oy:oy1] = arr
+    return Image.fromarray(out)
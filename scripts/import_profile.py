@@ -0,0 +1,68 @@
+# scripts/import_profile.py - run as: python3 -m scripts.import_profile [--max-seconds 5] [--top 15]
+# Import-time regression check for app.py. Imports it in a fresh interpreter with
+# -X importtime and the warm-up thread disabled (CAT_WARMUP=0), prints the slowest top-level
+# imports, and exits with status 1 if the import took longer than --max-seconds or loaded a
+# library that must only be imported on first use / by the warm-up thread.
+import os, sys, json, argparse, subprocess
+
+# Libraries that must not be imported while app.py loads
+HEAVY_MODULES = ('torch', 'ultralytics', 'tensorflow', 'h5py', 'sklearn', 'apscheduler')
+
+PROBE = """
+import sys, time, json
+t0 = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - t0
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print('IMPORT-PROFILE ' + json.dumps({{'seconds': seconds, 'heavy': heavy}}))
+"""
+
+
+def parse_importtime(stderr):
+    """(module, self_us, cumulative_us) of the top-level imports in -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        if name.startswith('  '):
+            continue   # imported by another module, already in its cumulative time
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def main(args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, CAT_WARMUP='0', PYTHONPATH=root)
+    code = PROBE.format(module=args.module, heavy=HEAVY_MODULES)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root, env=env,
+                          capture_output=True, text=True)
+    result = next((json.loads(line.split(' ', 1)[1]) for line in proc.stdout.splitlines()
+                   if line.startswith('IMPORT-PROFILE ')), None)
+    if proc.returncode != 0 or result is None:
+        print('\n'.join(l for l in proc.stderr.splitlines() if not l.startswith('import time:')))
+        print(f"[import-profile] importing {args.module} failed")
+        return 1
+
+    print(f"[import-profile] slowest imports of {args.module}:")
+    for name, self_us, cumulative_us in sorted(parse_importtime(proc.stderr), key=lambda r: -r[2])[:args.top]:
+        print(f"  {cumulative_us / 1e6:8.3f}s  {name}")
+    print(f"[import-profile] import {args.module}: {result['seconds']:.2f}s (limit {args.max_seconds}s)")
+
+    failed = False
+    if result['heavy']:
+        print(f"[import-profile] FAIL: imported at load time: {', '.join(result['heavy'])}")
+        failed = True
+    if result['seconds'] > args.max_seconds:
+        print(f"[import-profile] FAIL: import took longer than {args.max_seconds}s")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='app', help='module to import (default: app)')
+    parser.add_argument('--max-seconds', type=float, default=float(os.environ.get('CAT_IMPORT_MAX_SECONDS', 5)))
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to list')
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,150 @@
+# jobs.py - background job registry for detection / batch detection
+
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Images processed concurrently across all jobs
+JOB_WORKERS = int(os.environ.get('CAT_JOB_WORKERS', min(4, os.cpu_count() or 1)))
+# Finished jobs are forgotten after this many seconds
+JOB_TTL_SECONDS = int(os.environ.get('CAT_JOB_TTL', 86400))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='cat-job')
+_lock = threading.Lock()
+_jobs = {}   # job_id -> job dict (see submit_job)
+
+
+def _job_status(job):
+    states = [img['status'] for img in job['images']]
+    if any(s in ('queued', 'running') for s in states):
+        return 'running' if any(s != 'queued' for s in states) else 'queued'
+    if all(s == 'done' for s in states):
+        return 'done'
+    if all(s == 'failed' for s in states):
+        return 'failed'
+    return 'partial'
+
+
+def submit_job(user_id, kind, items, run_item, on_finish=None):
+    """Queue one task per item and return the job id.
+
+    items is a list of (name, payload). run_item(payload, progress) does the work for one
+    item and returns a result dict ({'success': bool, ...} like batch_process_image_yolo);
+    progress(done, total) may be called from the worker to report per-tile completion.
+    on_finish(job) runs once after the last item completes.
+    """
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'user_id': user_id,
+        'kind': kind,
+        'created': time.time(),
+        'finished': None,
+        'images': [
+            {'name': name, 'status': 'queued', 'tiles_done': 0, 'tiles_total': None,
+             'started': None, 'finished': None, 'result': None, 'error': None}
+            for name, _ in items
+        ],
+    }
+    remaining = [len(items)]
+
+    def run(index, payload):
+        image = job['images'][index]
+
+        def progress(done, total):
+            image['tiles_done'] = done
+            image['tiles_total'] = total
+
+        image['status'] = 'running'
+        image['started'] = time.time()
+        try:
+            result = run_item(payload, progress)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+
+        image['result'] = result
+        image['error'] = None if result.get('success') else result.get('error', 'processing error')
+        image['status'] = 'done' if result.get('success') else 'failed'
+        image['finished'] = time.time()
+
+        with _lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            job['finished'] = time.time()
+            if on_finish:
+                try:
+                    on_finish(job)
+                except Exception as e:
+                    print(f"[jobs] on_finish failed for {job_id}: {e}")
+
+    with _lock:
+        _jobs[job_id] = job
+    for index, (_, payload) in enumerate(items):
+        _executor.submit(run, index, payload)
+    return job_id
+
+
+def get_job(job_id, user_id):
+    """Return the job if it exists and belongs to user_id, else None."""
+    job = _jobs.get(job_id)
+    if job is None or job['user_id'] != user_id:
+        return None
+    return job
+
+
+def job_summary(job):
+    """JSON-safe status of a job: overall state plus per-image and per-tile progress."""
+    images = []
+    for img in job['images']:
+        images.append({
+            'name': img['name'],
+            'status': img['status'],
+            'tiles_done': img['tiles_done'],
+            'tiles_total': img['tiles_total'],
+            'error': img['error'],
+            'tiles': (img['result'] or {}).get('tiles'),
+        })
+    finished = sum(1 for img in job['images'] if img['status'] in ('done', 'failed'))
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'status': _job_status(job),
+        'created': job['created'],
+        'finished': job['finished'],
+        'images_done': finished,
+        'images_total': len(job['images']),
+        'images': images,
+    }
+
+
+def list_jobs(user_id):
+    with _lock:
+        return [job_summary(j) for j in _jobs.values() if j['user_id'] == user_id]
+
+
+def job_result_paths(user_id):
+    """Output files referenced by the results of user_id's jobs (downloadable until pruned)."""
+    with _lock:
+        jobs = [j for j in _jobs.values() if j['user_id'] == user_id]
+    paths = []
+    for job in jobs:
+        for img in job['images']:
+            result = img['result'] or {}
+            paths.extend(p for p in (result.get('tiff_path'), result.get('txt_path')) if p)
+    return paths
+
+
+def prune_jobs(user_id=None):
+    """Drop finished jobs past JOB_TTL_SECONDS, or every job of user_id when given."""
+    now = time.time()
+    with _lock:
+        for job_id in list(_jobs):
+            job = _jobs[job_id]
+            if user_id is not None:
+                if job['user_id'] == user_id:
+                    del _jobs[job_id]
+            elif job['finished'] and now - job['finished'] > JOB_TTL_SECONDS:
+                del _jobs[job_id]
@@ -1,11 +1,26 @@
-# scripts/kfold_train.py
-import os, shutil, argparse
+# scripts/kfold_train.py - run as: python3 -m scripts.kfold_train ...
+#
+# Folds are laid out with hard links to the dataset's images and labels (no copies) and run
+# in separate processes, up to --parallel at once, each with its own share of the thread budget
+# (OMP_NUM_THREADS set by the training scheduler, i.e. its TRAINING_THREADS, else all cores).
+# By default one fold runs per FOLD_THREADS threads of that budget (every fold holds its own
+# model, optimizer and dataloader workers in memory, so CAT_KFOLD_PARALLEL caps it). kfold_results.txt
+# (and --progress, if given) is rewritten as each fold finishes.
+import os, json, shutil, argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from sklearn.model_selection import KFold
-from ultralytics import YOLO
+
+THREAD_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+# Threads a fold should get at least before another fold runs alongside it
+FOLD_THREADS = int(os.environ.get('CAT_KFOLD_FOLD_THREADS', 4))
+# Upper bound for folds run at once (0: no bound besides the thread budget)
+KFOLD_PARALLEL = int(os.environ.get('CAT_KFOLD_PARALLEL', 0))
+
 
 def get_dataset(image_dir, label_dir):
     samples = []
-    for fname in os.listdir(image_dir):
+    for fname in sorted(os.listdir(image_dir)):
         if fname.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff')):
             base = os.path.splitext(fname)[0]
             label_file = os.path.join(label_dir, f"{base}.txt")
@@ -21,44 +36,103 @@ def write_yaml(path, nc, names, root_dir):
         f.write(f"nc: {nc}\n")
         f.write(f"names: {names}\n")
 
+def link_into(src, dst_dir):
+    """Hard link src into dst_dir (a copy across filesystems), replacing a file from an earlier run."""
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def layout_fold(fold_dir, samples, train_idx, val_idx):
+    train_img = os.path.join(fold_dir, 'train', 'images')
+    train_lbl = os.path.join(fold_dir, 'train', 'labels')
+    val_img = os.path.join(fold_dir, 'val', 'images')
+    val_lbl = os.path.join(fold_dir, 'val', 'labels')
+    for p in [train_img, train_lbl, val_img, val_lbl]:
+        os.makedirs(p, exist_ok=True)
+
+    for idx in train_idx:
+        link_into(samples[idx][0], train_img)
+        link_into(samples[idx][1], train_lbl)
+    for idx in val_idx:
+        link_into(samples[idx][0], val_img)
+        link_into(samples[idx][1], val_lbl)
+
+def run_fold(i, fold_dir, yaml_path, weights, epochs, workers):
+    """Train and validate one fold (in a worker process); returns (fold index, mAP@0.5)."""
+    from ultralytics import YOLO
+    # A fresh process per fold: nothing to share, so no model cache
+    model = YOLO(weights)
+    model.train(data=yaml_path, epochs=epochs, imgsz=640, batch=4, workers=workers, name=f"fold_{i}",
+                project=fold_dir)
+    val_result = model.val(data=yaml_path, workers=workers)
+    return i, float(val_result.box.map50)
+
+def thread_budget():
+    return int(os.environ.get('OMP_NUM_THREADS') or os.cpu_count() or 1)
+
+def default_parallel(n_folds):
+    """Folds run at once by default: one per FOLD_THREADS threads of the budget, at most KFOLD_PARALLEL."""
+    parallel = max(1, thread_budget() // max(1, FOLD_THREADS))
+    if KFOLD_PARALLEL:
+        parallel = min(parallel, KFOLD_PARALLEL)
+    return min(parallel, n_folds)
+
+def write_results(output_dir, results, n_folds, progress_path=None):
+    """Rewrite kfold_results.txt with the folds finished so far."""
+    done = sorted(results.items())
+    avg_map = sum(results.values()) / len(results)
+    with open(os.path.join(output_dir, 'kfold_results.txt'), 'w') as f:
+        for i, val in done:
+            f.write(f"Fold {i}: mAP@0.5 = {val:.4f}\n")
+        if len(results) < n_folds:
+            f.write(f"\n{len(results)}/{n_folds} folds finished, average so far mAP@0.5 = {avg_map:.4f}\n")
+        else:
+            f.write(f"\nAverage mAP@0.5 = {avg_map:.4f}\n")
+    if progress_path:
+        tmp_path = f"{progress_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'stage': 'kfold', 'folds_done': len(results), 'folds': n_folds,
+                       'fold_map50': {str(i): v for i, v in done}, 'average_map50': avg_map}, f)
+        os.replace(tmp_path, progress_path)
+
 def main(args):
     samples = get_dataset(args.image_dir, args.label_dir)
-    kf = KFold(n_splits=5, shuffle=True, random_state=42)
-    results = []
+    n_folds = 5
+    kf = KFold(n_splits=n_folds, shuffle=True, random_state=42)
 
+    folds = []
     for i, (train_idx, val_idx) in enumerate(kf.split(samples)):
         fold_dir = os.path.join(args.output_dir, f"fold_{i}")
-        train_img = os.path.join(fold_dir, 'train', 'images')
-        train_lbl = os.path.join(fold_dir, 'train', 'labels')
-        val_img = os.path.join(fold_dir, 'val', 'images')
-        val_lbl = os.path.join(fold_dir, 'val', 'labels')
-        for p in [train_img, train_lbl, val_img, val_lbl]:
-            os.makedirs(p, exist_ok=True)
-
-        for idx in train_idx:
-            shutil.copy2(samples[idx][0], train_img)
-            shutil.copy2(samples[idx][1], train_lbl)
-        for idx in val_idx:
-            shutil.copy2(samples[idx][0], val_img)
-            shutil.copy2(samples[idx][1], val_lbl)
-
+        layout_fold(fold_dir, samples, train_idx, val_idx)
         yaml_path = os.path.join(fold_dir, 'data.yaml')
-        write_yaml(yaml_path, args.nc, args.names, fold_dir)
+        write_yaml(yaml_path, args.nc, args.names, os.path.abspath(fold_dir))
+        folds.append((i, os.path.abspath(fold_dir), yaml_path))
 
-        model = YOLO(args.weights)
-        model.train(data=yaml_path, epochs=args.epochs, imgsz=640, batch=4, name=f"fold_{i}", project=fold_dir)
-        val_result = model.val(data=yaml_path)
-        map50 = val_result.box.map50
-        results.append(map50)
-        print(f"[FOLD {i}] mAP@0.5 = {map50:.4f}")
+    parallel = max(1, min(args.parallel or default_parallel(n_folds), n_folds))
+    fold_threads = max(1, thread_budget() // parallel)
+    workers = min(2, fold_threads)
+    print(f"[K-FOLD] {n_folds} folds, {parallel} at a time, {fold_threads} threads each")
 
-    avg_map = sum(results) / len(results)
-    print(f"[K-FOLD] Average mAP@0.5 = {avg_map:.4f}")
+    # Spawned workers start with this environment, so each fold gets its share of threads
+    for var in THREAD_VARS:
+        os.environ[var] = str(fold_threads)
 
-    with open(os.path.join(args.output_dir, 'kfold_results.txt'), 'w') as f:
-        for i, val in enumerate(results):
-            f.write(f"Fold {i}: mAP@0.5 = {val:.4f}\n")
-        f.write(f"\nAverage mAP@0.5 = {avg_map:.4f}\n")
+    results = {}
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(run_fold, i, fold_dir, yaml_path, args.weights, args.epochs, workers)
+                   for i, fold_dir, yaml_path in folds]
+        for future in as_completed(futures):
+            i, map50 = future.result()
+            results[i] = map50
+            print(f"[FOLD {i}] mAP@0.5 = {map50:.4f}")
+            write_results(args.output_dir, results, n_folds, args.progress)
+
+    avg_map = sum(results.values()) / len(results)
+    print(f"[K-FOLD] Average mAP@0.5 = {avg_map:.4f}")
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -69,5 +143,9 @@ if __name__ == '__main__':
     parser.add_argument('--output_dir', required=True)
     parser.add_argument('--nc', type=int, required=True)
     parser.add_argument('--names', nargs='+', required=True)
+    parser.add_argument('--parallel', type=int, default=None,
+                        help='folds run at once (default: from the thread budget); each holds a full model '
+                             'and its dataloaders in memory')
+    parser.add_argument('--progress', default=None, help='JSON file updated as folds finish')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,127 @@
+# model_cache.py - process-wide registry of loaded YOLO models with LRU eviction
+
+import os
+import copy
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Upper bound for the estimated memory held by cached models
+MODEL_CACHE_MB = int(os.environ.get('CAT_MODEL_CACHE_MB', 2048))
+
+# Weights served by the interactive detection endpoints (/detect, /detect-madm, /detect-cd3)
+DETECT_MODELS = {
+    'SGN': 'snapshots/SGN_best.pt',
+    'MADM': 'snapshots/MADM_v3.pt',
+    'CD3': 'snapshots/cd3_v2.pt',
+}
+# Weights used by batch detection and as the starting point of fine-tuning
+BATCH_MODELS = {
+    'SGN': 'snapshots/SGN_best.pt',
+    'MADM': 'snapshots/MADM_v3.pt',
+    'CD3': 'snapshots/cd3_v3.pt',
+}
+
+_registry_lock = threading.Lock()
+_models = OrderedDict()   # key -> {'model', 'lock', 'nbytes', 'path'}, least recently used first
+_load_locks = {}          # key -> lock so concurrent requests load a given file only once
+
+
+def model_key(model_path):
+    """Cache key: absolute path plus mtime and size, so an overwritten .pt is reloaded."""
+    path = os.path.abspath(model_path)
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+def _model_nbytes(model, model_path):
+    """Rough resident size of a loaded model: weights + buffers, plus the checkpoint it keeps."""
+    try:
+        tensors = list(model.model.parameters()) + list(model.model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors) + os.path.getsize(model_path)
+    except Exception:
+        return 2 * os.path.getsize(model_path)
+
+
+def _evict_locked():
+    limit = MODEL_CACHE_MB * 1024 * 1024
+    total = sum(e['nbytes'] for e in _models.values())
+    while total > limit and len(_models) > 1:
+        key, entry = _models.popitem(last=False)
+        total -= entry['nbytes']
+        print(f"[model-cache] evicted {entry['path']}")
+
+
+def _get_entry(model_path):
+    key = model_key(model_path)
+    with _registry_lock:
+        entry = _models.get(key)
+        if entry is not None:
+            _models.move_to_end(key)
+            return entry
+        load_lock = _load_locks.setdefault(key, threading.Lock())
+
+    with load_lock:
+        with _registry_lock:
+            entry = _models.get(key)
+            if entry is not None:
+                _models.move_to_end(key)
+                return entry
+
+        from ultralytics import YOLO   # imported on first load (or by the warm-up thread)
+        model = YOLO(model_path)
+        entry = {
+            'model': model,
+            'lock': threading.Lock(),
+            'nbytes': _model_nbytes(model, model_path),
+            'path': key[0],
+        }
+        with _registry_lock:
+            # Drop stale versions of the same file before inserting the new one
+            for stale in [k for k in _models if k[0] == key[0]]:
+                del _models[stale]
+            _models[key] = entry
+            _load_locks.pop(key, None)
+            _evict_locked()
+        print(f"[model-cache] loaded {key[0]}")
+        return entry
+
+
+def get_model(model_path):
+    """Return the shared YOLO instance for model_path, loading it on first use."""
+    return _get_entry(model_path)['model']
+
+
+@contextmanager
+def model_lock(model_path):
+    """Yield the shared model while holding its lock (ultralytics predictors are not thread-safe)."""
+    entry = _get_entry(model_path)
+    with entry['lock']:
+        yield entry['model']
+
+
+def load_model_copy(model_path):
+    """Return a private copy of a cached model for training, which mutates the YOLO object.
+
+    The copy is made in memory from the warm instance instead of re-reading the weights;
+    any attached predictor/trainer is left out of the copy.
+    """
+    entry = _get_entry(model_path)
+    with entry['lock']:
+        model = entry['model']
+        memo = {id(getattr(model, 'predictor', None)): None, id(getattr(model, 'trainer', None)): None}
+        return copy.deepcopy(model, memo)
+
+
+def evict_model(model_path):
+    """Forget every cached version of model_path (e.g. a temporary uploaded .pt)."""
+    path = os.path.abspath(model_path)
+    with _registry_lock:
+        for key in [k for k in _models if k[0] == path]:
+            del _models[key]
+
+
+def cached_models():
+    """Paths and estimated sizes of the models currently held, most recently used last."""
+    with _registry_lock:
+        return [{'path': e['path'], 'mb': round(e['nbytes'] / 1024 / 1024, 1)} for e in _models.values()]
@@ -2,40 +2,82 @@
 import numpy as np
 from PIL import Image
 import tifffile
+from scripts.image_source import open_image
+from scripts.percentile import value_histogram, histogram_percentiles, percentile_lut, apply_lut, normalize_to_uint8
+
+
+def _normalize_streamed(source, low_percentile, high_percentile):
+    """Same result as the in-memory path for a uint16 source, built band by band:
+    percentiles come from an accumulated histogram and each band is mapped through the
+    lookup table into the preallocated 8-bit output, so only the output and one band
+    are ever in memory."""
+    hist = None
+    for _, band in source.iter_bands():
+        hist = value_histogram(band, hist)
+    p_low, p_high = histogram_percentiles(hist, [low_percentile, high_percentile])
+
+    lut = percentile_lut(p_low, p_high, source.dtype)
+    channels = source.shape[2] if source.ndim == 3 else 3
+    normalized = np.zeros((source.height, source.width, channels), dtype=np.uint8)
+    if p_high > p_low:
+        for y, band in source.iter_bands():
+            scaled = apply_lut(band, lut)
+            normalized[y:y + len(band)] = scaled[:, :, None] if scaled.ndim == 2 else scaled
+    return normalized, (p_low, p_high)
+
+
+def normalized_rendition(input_path, low_percentile=1, high_percentile=99, source=None):
+    """The 8-bit array normalize_image saves for input_path, and the (p_low, p_high) it used.
+
+    percentiles is None when the image was already 8-bit; the array is None for non-integer
+    images, which normalize_image converts with PIL instead. An already open ImageSource of
+    input_path can be passed to avoid opening or decoding the file again.
+    """
+    is_tiff = input_path.lower().endswith(('.tif', '.tiff'))
+    # Large 16-bit TIFFs are read region by region instead of decoded whole
+    if is_tiff:
+        if source is not None:
+            if source.kind != 'array' and source.page_count == 1 and source.dtype == np.uint16:
+                return _normalize_streamed(source, low_percentile, high_percentile)
+        else:
+            with open_image(input_path) as source:
+                if source.kind != 'array' and source.page_count == 1 and source.dtype == np.uint16:
+                    return _normalize_streamed(source, low_percentile, high_percentile)
+
+    # Read image
+    if source is not None and source.kind == 'array' and (source.in_memory or not is_tiff):
+        img_array = source[:, :]
+    elif is_tiff:
+        img_array = tifffile.imread(input_path)
+    else:
+        img = Image.open(input_path)
+        img_array = np.array(img)
+
+    # Check if normalization is needed
+    if img_array.dtype == np.uint8:
+        # Already 8-bit, just convert to RGB if needed
+        if len(img_array.shape) == 2:
+            img_array = np.stack((img_array,) * 3, axis=-1)
+        return img_array, None
+    if np.issubdtype(img_array.dtype, np.integer):
+        # Normalize >8-bit images: exact histogram percentiles + uint16 -> uint8 lookup table
+        # (all zeros when the percentiles collapse, e.g. a constant image)
+        normalized, p_low, p_high = normalize_to_uint8(img_array, low_percentile, high_percentile)
+
+        # Ensure 3-channel output
+        if len(normalized.shape) == 2:
+            rgb = np.empty(normalized.shape + (3,), dtype=np.uint8)
+            rgb[...] = normalized[:, :, None]
+            normalized = rgb
+        return normalized, (p_low, p_high)
+    return None, None
+
 
 def normalize_image(input_path, output_path, low_percentile=1, high_percentile=99):
     """Normalize an image file and save the result using improved percentile-based scaling"""
     try:
-        # Read image
-        if input_path.lower().endswith(('.tif', '.tiff')):
-            img_array = tifffile.imread(input_path)
-        else:
-            img = Image.open(input_path)
-            img_array = np.array(img)
-        
-        # Check if normalization is needed
-        if img_array.dtype == np.uint8:
-            # Already 8-bit, just convert to RGB if needed
-            if len(img_array.shape) == 2:
-                img_array = np.stack((img_array,) * 3, axis=-1)
-            result = Image.fromarray(img_array)
-        elif np.issubdtype(img_array.dtype, np.integer):
-            # Normalize >8-bit images
-            p_low = np.percentile(img_array, low_percentile)
-            p_high = np.percentile(img_array, high_percentile)
-            
-            if p_high <= p_low:
-                # Edge case: all values are the same or percentiles are invalid
-                normalized = np.zeros_like(img_array, dtype=np.uint8)
-            else:
-                # Clip and scale to [0,255], convert to uint8
-                clipped = np.clip(img_array, p_low, p_high)
-                normalized = ((clipped - p_low) * 255.0 / (p_high - p_low)).astype(np.uint8)
-            
-            # Ensure 3-channel output
-            if len(normalized.shape) == 2:
-                normalized = np.stack((normalized,) * 3, axis=-1)
-            
+        normalized, _ = normalized_rendition(input_path, low_percentile, high_percentile)
+        if normalized is not None:
             result = Image.fromarray(normalized)
         else:
             # For non-integer types, just convert to RGB
@@ -58,4 +100,4 @@ def normalize_image(input_path, output_path, low_percentile=1, high_percentile=9
             img.save(output_path)
             return True
         except:
-            return False
\ No newline at end of file
+            return False
@@ -6,6 +6,10 @@ import cv2
 import numpy as np
 import tifffile
 import matplotlib.pyplot as plt
+try:
+    from scripts.percentile import normalize_to_uint8
+except ImportError:  # run as a script from inside scripts/
+    from percentile import normalize_to_uint8
 
 def load_config():
     """从 YAML 或 JSON 文件加载配置。"""
@@ -54,15 +58,8 @@ def process_image(image_path, downsample_percentile_low=1, downsample_percentile
         elif np.issubdtype(img_raw.dtype, np.integer):
             was_normalized = True
             print(f"  类型: >8-bit ({img_raw.dtype})。正在归一化...")
-            p_low_val = np.percentile(img_raw, downsample_percentile_low)
-            p_high_val = np.percentile(img_raw, downsample_percentile_high)
-            
-            if p_high_val <= p_low_val:
-                processed_img = np.zeros_like(img_raw, dtype=np.uint8)
-            else:
-                clipped_img = np.clip(img_raw, p_low_val, p_high_val)
-                scaled_img = (clipped_img - p_low_val) * (255.0 / (p_high_val - p_low_val))
-                processed_img = scaled_img.astype(np.uint8)
+            # 直方图精确分位数 + 查找表映射（分位数相同时全部为 0）
+            processed_img, _, _ = normalize_to_uint8(img_raw, downsample_percentile_low, downsample_percentile_high)
         else:
             print(f"  警告: 不支持的图像数据类型 {img_raw.dtype}。已跳过。")
             return None, False
@@ -0,0 +1,107 @@
+# percentile.py - exact percentile normalization of integer images via histograms and lookup tables
+#
+# Shared by normalization.normalize_image, detect.normalize_image_percentile and the
+# normalizationv2 / preprocessing_multichannel scripts. For uint8/uint16 data the percentiles
+# come from a bincount histogram (no sort/partition) and the clip + scale is a uint16 -> uint8
+# lookup table applied chunk by chunk into the output, so no float64 image-sized temporaries exist.
+
+import numpy as np
+
+# dtypes whose full value range fits in a bincount histogram
+HISTOGRAM_DTYPES = (np.uint8, np.uint16)
+# Elements per chunk for bincount / take, which widen their input to intp internally
+_CHUNK = 1 << 22
+
+
+def supports_histogram(dtype):
+    return np.dtype(dtype) in [np.dtype(t) for t in HISTOGRAM_DTYPES]
+
+
+def _chunks(flat):
+    for start in range(0, flat.size, _CHUNK):
+        yield start, flat[start:start + _CHUNK]
+
+
+def value_histogram(arr, hist=None):
+    """Add the value counts of a uint8/uint16 array (or chunk) to hist and return it."""
+    arr = np.asarray(arr)
+    nbins = 1 << (8 * arr.dtype.itemsize)
+    if hist is None:
+        hist = np.zeros(nbins, dtype=np.int64)
+    for _, chunk in _chunks(arr.reshape(-1)):
+        hist += np.bincount(chunk, minlength=nbins)
+    return hist
+
+
+def histogram_percentiles(hist, percentiles):
+    """Percentiles from a value histogram, identical to np.percentile's default (linear) method."""
+    cumulative = np.cumsum(hist)
+    n = int(cumulative[-1])
+    if n == 0:
+        return [0.0 for _ in percentiles]
+    values = []
+    for p in percentiles:
+        position = p / 100.0 * (n - 1)
+        below = int(np.floor(position))
+        above = min(below + 1, n - 1)
+        # value at sorted index k is the first bin whose cumulative count exceeds k
+        v_below = int(np.searchsorted(cumulative, below, side='right'))
+        v_above = int(np.searchsorted(cumulative, above, side='right'))
+        values.append(v_below + (v_above - v_below) * (position - below))
+    return values
+
+
+def image_percentiles(arr, low_percentile=1, high_percentile=99):
+    """(p_low, p_high) of an integer array; exact, via histogram when the dtype allows it."""
+    if supports_histogram(arr.dtype):
+        p_low, p_high = histogram_percentiles(value_histogram(arr), [low_percentile, high_percentile])
+    else:
+        p_low, p_high = np.percentile(arr, [low_percentile, high_percentile])
+    return float(p_low), float(p_high)
+
+
+def percentile_lut(p_low, p_high, dtype=np.uint16):
+    """uint8 lookup table for every value of dtype: clip to [p_low, p_high], scale to [0, 255].
+
+    Same arithmetic as the original per-pixel expression, evaluated once per possible value.
+    When p_high <= p_low the table is all zeros.
+    """
+    values = np.arange(1 << (8 * np.dtype(dtype).itemsize), dtype=np.float64)
+    if p_high <= p_low:
+        return np.zeros(len(values), dtype=np.uint8)
+    clipped = np.clip(values, p_low, p_high)
+    return ((clipped - p_low) * 255.0 / (p_high - p_low)).astype(np.uint8)
+
+
+def apply_lut(arr, lut, out=None):
+    """out[...] = lut[arr] without an image-sized index temporary; returns out."""
+    arr = np.ascontiguousarray(arr)
+    if out is None:
+        out = np.empty(arr.shape, dtype=lut.dtype)
+    flat_out = out.reshape(-1)
+    for start, chunk in _chunks(arr.reshape(-1)):
+        np.take(lut, chunk, out=flat_out[start:start + chunk.size])
+    return out
+
+
+def normalize_to_uint8(arr, low_percentile=1, high_percentile=99, out=None):
+    """Percentile-normalize an integer array to uint8.
+
+    Returns (normalized, p_low, p_high). uint8/uint16 input goes through the histogram +
+    lookup-table path; wider integer types fall back to np.percentile and a per-chunk scale.
+    """
+    arr = np.asarray(arr)
+    p_low, p_high = image_percentiles(arr, low_percentile, high_percentile)
+    if supports_histogram(arr.dtype):
+        return apply_lut(arr, percentile_lut(p_low, p_high, arr.dtype), out), p_low, p_high
+
+    if out is None:
+        out = np.empty(arr.shape, dtype=np.uint8)
+    if p_high <= p_low:
+        out[...] = 0
+        return out, p_low, p_high
+    flat_out = out.reshape(-1)
+    for start, chunk in _chunks(np.ascontiguousarray(arr).reshape(-1)):
+        clipped = np.clip(chunk, p_low, p_high)
+        flat_out[start:start + chunk.size] = ((clipped - p_low) * 255.0 / (p_high - p_low)).astype(np.uint8)
+    return out, p_low, p_high
@@ -6,6 +6,10 @@ import cv2
 import numpy as np
 import tifffile
 import matplotlib.pyplot as plt
+try:
+    from scripts.percentile import normalize_to_uint8
+except ImportError:  # run as a script from inside scripts/
+    from percentile import normalize_to_uint8
 
 def load_config():
     """Load configuration from a YAML or JSON file."""
@@ -63,16 +67,11 @@ def convert_to_8bit_if_needed(image_path, downsample_percentile_low=1, downsampl
             else:
                 # Downsample higher bit-depth single-channel images to 8-bit
                 print(f"  Downsampling from {img_raw.dtype} to 8-bit.")
-                p_low_val = np.percentile(img_raw, downsample_percentile_low)
-                p_high_val = np.percentile(img_raw, downsample_percentile_high)
-                
-                if p_high_val == p_low_val:
-                    converted_img = np.zeros_like(img_raw, dtype=np.uint8)
-                    if p_high_val > 0:
-                        converted_img.fill(255)
-                else:
-                    converted_img = (np.clip(img_raw, p_low_val, p_high_val) - p_low_val) * (255.0 / (p_high_val - p_low_val))
-                    converted_img = converted_img.astype(np.uint8)
+                # Exact histogram percentiles + lookup table (no float64 image copies)
+                converted_img, p_low_val, p_high_val = normalize_to_uint8(
+                    img_raw, downsample_percentile_low, downsample_percentile_high)
+                if p_high_val == p_low_val and p_high_val > 0:
+                    converted_img.fill(255)
                 
                 return cv2.cvtColor(converted_img, cv2.COLOR_GRAY2BGR)
         
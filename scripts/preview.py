@@ -0,0 +1,63 @@
+# preview.py - fast-to-encode, downsampled previews of the normalized rendition for the viewer
+#
+# The viewer paints the preview first (stretched to the full image size, annotations stay in
+# full-resolution coordinates) while the tile pyramid streams in the detail. The preview is
+# capped at PREVIEW_MAX_DIM pixels on its longest side and encoded as WebP, JPEG or PNG with
+# fast compression. The full-resolution rendition is only encoded when it is asked for.
+
+import os
+import numpy as np
+from PIL import Image
+
+PREVIEW_FORMAT = os.environ.get('CAT_PREVIEW_FORMAT', 'jpeg').lower()   # 'webp', 'jpeg' or 'png'
+PREVIEW_QUALITY = int(os.environ.get('CAT_PREVIEW_QUALITY', 85))
+PREVIEW_MAX_DIM = int(os.environ.get('CAT_PREVIEW_MAX_DIM', 2048))
+
+_EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg', 'png': 'png'}
+
+
+def preview_extension(fmt=PREVIEW_FORMAT):
+    return _EXTENSIONS.get(fmt, 'png')
+
+
+def _as_rgb_image(image):
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.ascontiguousarray(image))
+    return image if image.mode == 'RGB' else image.convert('RGB')
+
+
+def encode_image(image, path, fmt=PREVIEW_FORMAT, quality=PREVIEW_QUALITY):
+    """Save an RGB image with the fastest settings of the chosen format."""
+    if fmt == 'webp':
+        # method 0 is the fastest encoder effort; quality still controls the size
+        image.save(path, 'WEBP', quality=quality, method=0)
+    elif fmt == 'jpeg':
+        image.save(path, 'JPEG', quality=quality)
+    else:
+        image.save(path, 'PNG', compress_level=1)
+
+
+def downsample(image, max_dim=PREVIEW_MAX_DIM):
+    """Shrink an image so its longest side is at most max_dim (aspect ratio kept)."""
+    width, height = image.size
+    longest = max(width, height)
+    if max_dim <= 0 or longest <= max_dim:
+        return image
+    scale = max_dim / longest
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # reducing_gap lets PIL do most of the shrink with a cheap integer box reduce first
+    return image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+
+def save_preview(rendition, path_without_ext, max_dim=PREVIEW_MAX_DIM, fmt=PREVIEW_FORMAT,
+                 quality=PREVIEW_QUALITY):
+    """Write the downsampled preview of an 8-bit rendition; returns the file path written."""
+    path = f'{path_without_ext}.{preview_extension(fmt)}'
+    encode_image(downsample(_as_rgb_image(rendition), max_dim), path, fmt, quality)
+    return path
+
+
+def save_full_resolution(rendition, path):
+    """Write the rendition at full resolution as PNG with fast (level 1) compression."""
+    encode_image(_as_rgb_image(rendition), path, 'png')
+    return path
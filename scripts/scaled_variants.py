@@ -0,0 +1,165 @@
+# scaled_variants.py - cached rescaled copies of images, keyed by content and target size
+#
+# A variant is identified by (content digest of the source file, what was resized, target
+# size, resampling method). Variants are kept in memory (bounded LRU) and, when a cache_dir is
+# given, as uncompressed TIFFs there, so /scale-image to an already used diameter and repeated
+# batch runs reuse them instead of resampling again. Callers link the cached file into place
+# (link_variant); exports saved compressed link a compressed copy kept next to it
+# (exported_variant), so a repeated export is not encoded again either.
+#
+# A linked variant is one file with two names. Storage eviction skips files with other links
+# (scripts/storage.py), so its space is only reclaimed after the linked copy is deleted too
+# (e.g. a batch output evicted from finaloutput); usage counts it once.
+#
+# Resampling is chosen per stage:
+#   'area' / 'linear' - OpenCV on the numpy array, used for detection inputs; dtypes OpenCV
+#                       cannot resize (e.g. int32 from 'I' mode images) go through float64
+#   'lanczos'         - PIL LANCZOS, band by band, for every image that is exported to the user
+
+import os
+import uuid
+import shutil
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+import tifffile
+from PIL import Image
+from scripts.content_hash import file_digest
+from scripts.image_source import ImageSource, open_image, resize_source
+
+# Resampling used for images that only feed detection
+DETECTION_RESAMPLE = os.environ.get('CAT_DETECTION_RESAMPLE', 'area')
+# Upper bound for the variants held in memory (per process)
+SCALED_CACHE_MB = int(os.environ.get('CAT_SCALED_CACHE_MB', 256))
+
+_CV2_INTERPOLATION = {'area': cv2.INTER_AREA, 'linear': cv2.INTER_LINEAR}
+# dtypes cv2.resize accepts for both interpolations
+_CV2_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+
+_lock = threading.Lock()
+_variants = OrderedDict()  # key -> array, least recently used first
+_key_locks = {}            # key -> lock so concurrent requests resample a variant only once
+
+
+def resample(pixels, width, height, method=DETECTION_RESAMPLE):
+    """Resize an array or ImageSource to (width, height) and return a numpy array."""
+    if method == 'lanczos':
+        source = pixels if isinstance(pixels, ImageSource) else ImageSource('', array=pixels)
+        return np.asarray(resize_source(source, width, height, Image.Resampling.LANCZOS))
+    arr = np.ascontiguousarray(np.asarray(pixels))
+    if arr.shape[1] == width and arr.shape[0] == height:
+        return arr
+    interpolation = _CV2_INTERPOLATION[method]
+    if arr.dtype in _CV2_DTYPES:
+        return cv2.resize(arr, (width, height), interpolation=interpolation)
+    # float64 holds every int32/uint32 value exactly; round and clip back to the source dtype
+    out = cv2.resize(arr.astype(np.float64), (width, height), interpolation=interpolation)
+    if arr.dtype.kind in 'iu':
+        info = np.iinfo(arr.dtype)
+        out = np.clip(np.rint(out), info.min, info.max)
+    elif arr.dtype.kind == 'b':
+        out = np.rint(out)
+    return out.astype(arr.dtype)
+
+
+def variant_key(image_path, width, height, method, variant='original'):
+    return f"{file_digest(image_path)}_{variant}_{width}x{height}_{method}"
+
+
+def _remember(key, arr):
+    if arr.nbytes > SCALED_CACHE_MB * 1024 * 1024:
+        return   # would evict everything else and still exceed the budget
+    with _lock:
+        _variants[key] = arr
+        _variants.move_to_end(key)
+        total = sum(a.nbytes for a in _variants.values())
+        while total > SCALED_CACHE_MB * 1024 * 1024:
+            _, old = _variants.popitem(last=False)
+            total -= old.nbytes
+
+
+def _write_tiff(arr, cached_path):
+    os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+    tmp_path = f'{cached_path}.{uuid.uuid4().hex}.tmp'
+    # Uncompressed, so later reads are a memory map instead of a decode
+    photometric = 'rgb' if arr.ndim == 3 and arr.shape[2] in (3, 4) else 'minisblack'
+    tifffile.imwrite(tmp_path, arr, photometric=photometric)
+    os.replace(tmp_path, cached_path)
+
+
+def _lookup(key, cached_path):
+    with _lock:
+        arr = _variants.get(key)
+        if arr is not None:
+            _variants.move_to_end(key)
+    if arr is not None:
+        if cached_path is not None and not os.path.exists(cached_path):
+            _write_tiff(arr, cached_path)   # the file was removed (e.g. storage cleanup)
+        return arr
+    if cached_path is not None and os.path.exists(cached_path):
+        with open_image(cached_path) as source:
+            arr = source[:, :].copy()
+        _remember(key, arr)
+        return arr
+    return None
+
+
+def scaled_variant(image_path, width, height, method=DETECTION_RESAMPLE, cache_dir=None, variant='original',
+                   prepare=None):
+    """Pixels of image_path resized to (width, height), built once per content and size.
+
+    prepare(image_path) returns the pixels to resize (e.g. the normalized rendition, with
+    variant naming it); by default the image itself is resized. Returns (array, cached_path),
+    cached_path being the variant's TIFF in cache_dir (None without a cache_dir).
+    """
+    key = variant_key(image_path, width, height, method, variant)
+    cached_path = os.path.join(cache_dir, f'{key}.tiff') if cache_dir else None
+    arr = _lookup(key, cached_path)
+    if arr is not None:
+        return arr, cached_path
+
+    with _lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    try:
+        with key_lock:
+            arr = _lookup(key, cached_path)
+            if arr is None:
+                if prepare is not None:
+                    arr = resample(prepare(image_path), width, height, method)
+                else:
+                    with open_image(image_path) as source:
+                        arr = resample(source, width, height, method)
+                if cached_path is not None:
+                    _write_tiff(arr, cached_path)
+                _remember(key, arr)
+    finally:
+        with _lock:
+            _key_locks.pop(key, None)
+    return arr, cached_path
+
+
+def exported_variant(arr, cached_path):
+    """Deflate-compressed TIFF of a cached variant's pixels, encoded once next to cached_path."""
+    export_path = f'{os.path.splitext(cached_path)[0]}_deflate.tiff'
+    if not os.path.exists(export_path):
+        tmp_path = f'{export_path}.{uuid.uuid4().hex}.tmp'
+        Image.fromarray(arr).save(tmp_path, format='TIFF', compression='tiff_deflate')
+        os.replace(tmp_path, export_path)
+    return export_path
+
+
+def link_variant(cached_path, dst_path):
+    """Put a cached variant at dst_path as a hard link (a copy across filesystems).
+
+    While dst_path exists the cached file cannot be evicted (see the module comment)."""
+    if os.path.exists(dst_path) and os.path.samefile(cached_path, dst_path):
+        # Already in place (rename onto another link of the same file would be a no-op)
+        return dst_path
+    tmp_path = f'{dst_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.link(cached_path, tmp_path)
+    except OSError:
+        shutil.copyfile(cached_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+    return dst_path
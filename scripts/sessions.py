@@ -0,0 +1,85 @@
+# sessions.py - cheap per-request session bootstrap
+#
+# set_user_session (app.py) runs before every request, image fetches and chart streams
+# included. Instead of creating every session directory and touching the user directory each
+# time, the directories are created once per process (the session is then remembered as
+# initialized and only re-checked with a single stat every SESSION_RECHECK_SECONDS, in case
+# another process removed it), and the time of the last request is kept in memory and written
+# to the user directory's mtime - which delete_expired_sessions reads - every
+# ACTIVITY_FLUSH_SECONDS by a background thread.
+
+import os
+import time
+import atexit
+import threading
+
+USERS_DIR = 'users'
+# Created for every session (relative to users/<id>)
+SESSION_DIRS = ('uploads', 'converted', 'saved_data', 'saved_annotations', 'finaloutput', 'ft_upload', 'images',
+                'input', 'output', 'output/output_csv', 'snapshots', 'tiles', 'scaled', 'originals')
+# How often recorded activity is written to the user directories' mtime
+ACTIVITY_FLUSH_SECONDS = float(os.environ.get('CAT_ACTIVITY_FLUSH_SECONDS', 60))
+# How long an initialized session is trusted before its directory is checked again
+SESSION_RECHECK_SECONDS = float(os.environ.get('CAT_SESSION_RECHECK_SECONDS', 60))
+
+_lock = threading.Lock()
+_initialized = {}   # user_id -> when its directories were last known to exist
+_activity = {}      # user_id -> time of its last request, not yet written
+_flusher = None
+
+
+def ensure_session_dirs(user_id):
+    """Create the session directories of user_id, once per process."""
+    now = time.time()
+    checked = _initialized.get(user_id)
+    if checked is not None:
+        if now - checked < SESSION_RECHECK_SECONDS:
+            return
+        if os.path.isdir(os.path.join(USERS_DIR, user_id, SESSION_DIRS[0])):
+            _initialized[user_id] = now
+            return
+    for name in SESSION_DIRS:
+        os.makedirs(os.path.join(USERS_DIR, user_id, name), exist_ok=True)
+    _initialized[user_id] = now
+
+
+def touch_session(user_id):
+    """Record a request of user_id; written to disk by the next flush."""
+    with _lock:
+        _activity[user_id] = time.time()
+    _ensure_flusher()
+
+
+def flush_activity():
+    """Write the recorded last-request times to the user directories' mtime."""
+    global _activity
+    with _lock:
+        pending, _activity = _activity, {}
+    for user_id, when in pending.items():
+        try:
+            os.utime(os.path.join(USERS_DIR, user_id), (when, when))
+        except OSError:
+            pass   # removed in the meantime
+
+
+def forget_session(user_id):
+    """Drop what is remembered about user_id (its directory is being deleted)."""
+    with _lock:
+        _initialized.pop(user_id, None)
+        _activity.pop(user_id, None)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(ACTIVITY_FLUSH_SECONDS)
+        flush_activity()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is None:
+        with _lock:
+            if _flusher is None:
+                _flusher = threading.Thread(target=_flush_loop, name='cat-session-activity', daemon=True)
+                _flusher.start()
+                atexit.register(flush_activity)
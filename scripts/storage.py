@@ -0,0 +1,363 @@
+# storage.py - per-user disk usage, quotas and LRU eviction of derived artifacts
+#
+# Usage is tracked incrementally: every directory under users/<id> is remembered with its
+# mtime and the files it held, and only directories whose mtime changed (a file was added,
+# removed or replaced) are listed again. A file written in place does not change its
+# directory's mtime, so the periodic sweep also stat's the files of unchanged directories.
+# Hard links count once per user. All scanning happens in the storage thread, under a lock of
+# that user only; a request's quota check (check_quota) reads the last scanned usage plus the
+# bytes uploaded since (schedule_check), and only scans itself the first time or when that
+# estimate is over the quota.
+#
+# When a user exceeds USER_QUOTA_MB, or all users together exceed TOTAL_QUOTA_MB or leave less
+# than MIN_FREE_MB free on the disk, derived artifacts are deleted least recently used first:
+# previews, tile pyramids, scaled variants and the training conversion cache first, then batch
+# outputs (finaloutput). Everything they hold can be rebuilt or was already delivered; user
+# data (uploads, originals, saved data and annotations, snapshots) is never evicted - a user
+# whose own data is over the quota gets 507 on new uploads instead (check_quota).
+#
+# Files younger than MIN_AGE_SECONDS, files with other hard links (in use elsewhere), the
+# newest tile pyramid and preview of each user (the ones on screen) and files registered by
+# register_protected (e.g. results of batch jobs not yet downloaded) are left alone.
+
+import os
+import time
+import shutil
+import threading
+
+USERS_DIR = 'users'
+# Per-user limit; 0 disables it
+USER_QUOTA_MB = int(os.environ.get('CAT_USER_QUOTA_MB', 5120))
+# Limit for all users together; 0 disables it
+TOTAL_QUOTA_MB = int(os.environ.get('CAT_STORAGE_QUOTA_MB', 0))
+# Free space kept on the disk holding users/
+MIN_FREE_MB = int(os.environ.get('CAT_MIN_FREE_MB', 2048))
+# Artifacts younger than this are not evicted
+MIN_AGE_SECONDS = float(os.environ.get('CAT_STORAGE_MIN_AGE_SECONDS', 600))
+# How often every user is checked (users with new writes are checked right away)
+STORAGE_CHECK_SECONDS = float(os.environ.get('CAT_STORAGE_CHECK_SECONDS', 300))
+# Eviction stops at this fraction of the limit, so the next write does not trigger it again
+LOW_WATER = 0.9
+
+# Derived artifacts in eviction order: all of a tier goes (LRU) before the next is touched
+EVICTION_TIERS = (('converted', 'tiles', 'scaled', 'dataset_cache'), ('finaloutput',))
+
+_lock = threading.Lock()  # guards the registries below, never held while scanning
+_user_locks = {}      # user id -> RLock held while its tree is scanned or evicted
+_dirs = {}            # user id -> {directory path -> _DirState}
+_usage = {}           # user id -> usage of its last scan (see user_usage)
+_written = {}         # user id -> bytes reported by schedule_check since that scan
+_protected = []       # callables user_id -> paths that must not be evicted
+_pending = set()      # users to check soon
+_sweep_requested = False  # a request found the disk short; sweep now
+_wakeup = threading.Condition(_lock)
+_sweep_lock = threading.Lock()
+_manager = None
+
+
+class _DirState:
+    def __init__(self, mtime_ns, files, subdirs):
+        self.mtime_ns = mtime_ns
+        self.files = files        # name -> (inode, bytes on disk, last use, link count)
+        self.subdirs = subdirs    # names
+
+
+def _user_lock(user_id):
+    with _lock:
+        return _user_locks.setdefault(user_id, threading.RLock())
+
+
+def _forget_tree(dirs, path):
+    prefix = path + os.sep
+    for key in [k for k in dirs if k == path or k.startswith(prefix)]:
+        del dirs[key]
+
+
+def _file_info(st):
+    return st.st_ino, st.st_blocks * 512, max(st.st_atime, st.st_mtime), st.st_nlink
+
+
+def _dir_state(dirs, path, restat=False):
+    """The directory's files, listed again only if its mtime changed; None if it is gone.
+
+    With restat, the files of an unchanged directory are stat'ed again, so files that grew
+    in place count at their current size."""
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        _forget_tree(dirs, path)
+        return None
+    state = dirs.get(path)
+    if state is not None and state.mtime_ns == mtime_ns:
+        if restat:
+            for name in list(state.files):
+                try:
+                    state.files[name] = _file_info(os.stat(os.path.join(path, name), follow_symlinks=False))
+                except OSError:
+                    del state.files[name]
+        return state
+    files, subdirs = {}, []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files[entry.name] = _file_info(entry.stat(follow_symlinks=False))
+                except OSError:
+                    pass
+    except OSError:
+        _forget_tree(dirs, path)
+        return None
+    if state is not None:
+        for name in set(state.subdirs) - set(subdirs):
+            _forget_tree(dirs, os.path.join(path, name))
+    state = dirs[path] = _DirState(mtime_ns, files, subdirs)
+    return state
+
+
+def _walk(dirs, path, restat=False):
+    """Yield (file path, (inode, bytes, last use, links)) of every file under path."""
+    state = _dir_state(dirs, path, restat)
+    if state is None:
+        return
+    for name, info in list(state.files.items()):
+        yield os.path.join(path, name), info
+    for name in list(state.subdirs):
+        yield from _walk(dirs, os.path.join(path, name), restat)
+
+
+def _user_dirs(user_id):
+    with _lock:
+        return _dirs.setdefault(user_id, {})
+
+
+def user_usage(user_id, restat=False):
+    """{'total', 'derived', 'dirs': {top-level dir: bytes}} of users/<id>, in bytes (scans it)."""
+    root = os.path.join(USERS_DIR, user_id)
+    derived = {name for tier in EVICTION_TIERS for name in tier}
+    seen, dirs, usage = set(), {}, {'total': 0, 'derived': 0}
+    with _user_lock(user_id):
+        for path, (inode, nbytes, _, _) in _walk(_user_dirs(user_id), root, restat):
+            if inode in seen:
+                continue
+            seen.add(inode)
+            top = os.path.relpath(path, root).split(os.sep)[0]
+            dirs[top] = dirs.get(top, 0) + nbytes
+            usage['total'] += nbytes
+            if top in derived:
+                usage['derived'] += nbytes
+        usage['dirs'] = dirs
+        with _lock:
+            _usage[user_id] = usage
+            _written[user_id] = 0
+    return usage
+
+
+def _user_ids():
+    try:
+        with os.scandir(USERS_DIR) as it:
+            return [e.name for e in it if e.is_dir()]
+    except OSError:
+        return []
+
+
+def register_protected(func):
+    """func(user_id) returns paths that must not be evicted (e.g. results still to be downloaded)."""
+    _protected.append(func)
+
+
+def _candidates(user_id, tier, now):
+    """(last use, bytes, path, is_dir) of the evictable artifacts of user_id in a tier."""
+    root = os.path.join(USERS_DIR, user_id)
+    protected = set()
+    for func in _protected:
+        try:
+            protected.update(os.path.abspath(p) for p in func(user_id) if p)
+        except Exception as e:
+            print(f"[storage] protected paths of {user_id}: {e}")
+    units = []
+    dirs = _user_dirs(user_id)
+    for name in tier:
+        base = os.path.join(root, name)
+        if name == 'tiles':
+            # Pyramids go as a whole; the most recently used one is on screen
+            state = _dir_state(dirs, base)
+            pyramids = []
+            for pyramid in (state.subdirs if state else []):
+                path = os.path.join(base, pyramid)
+                pyramid_state = _dir_state(dirs, path)
+                if pyramid_state is None:
+                    continue
+                nbytes = sum(info[1] for _, info in _walk(dirs, path))
+                pyramids.append((pyramid_state.mtime_ns / 1e9, nbytes, path, True))
+            pyramids.sort()
+            units.extend(p for p in pyramids[:-1] if now - p[0] >= MIN_AGE_SECONDS)
+            continue
+        if name == 'converted':
+            # A view's preview and full rendition (<view_id>.<ext>, <view_id>_full.png) go
+            # separately, but the most recently used view is on screen and keeps both
+            views = {}
+            for path, (_, nbytes, last_use, links) in _walk(dirs, base):
+                view_id = os.path.basename(path).split('.')[0]
+                view_id = view_id[:-len('_full')] if view_id.endswith('_full') else view_id
+                views.setdefault(view_id, []).append((last_use, nbytes, path, links))
+            newest = max(views, key=lambda v: max(f[0] for f in views[v]), default=None)
+            for view_id, files in views.items():
+                if view_id == newest:
+                    continue
+                units.extend((last_use, nbytes, path, False) for last_use, nbytes, path, links in files
+                             if links == 1 and now - last_use >= MIN_AGE_SECONDS
+                             and os.path.abspath(path) not in protected)
+            continue
+        for path, (_, nbytes, last_use, links) in _walk(dirs, base):
+            if links > 1 or now - last_use < MIN_AGE_SECONDS or os.path.abspath(path) in protected:
+                continue
+            units.append((last_use, nbytes, path, False))
+    return units
+
+
+def _evict(units, need):
+    """Delete units (oldest first) until need bytes are freed; returns the bytes freed."""
+    freed = 0
+    for last_use, nbytes, path, is_dir in sorted(units):
+        if freed >= need:
+            break
+        try:
+            if is_dir:
+                shutil.rmtree(path)
+            else:
+                if os.stat(path).st_nlink > 1:
+                    continue   # linked into place since it was listed
+                os.remove(path)
+        except OSError:
+            continue
+        freed += nbytes
+        print(f"[storage] evicted {path} ({nbytes / 1024 / 1024:.1f} MB)")
+    return freed
+
+
+def enforce_user_quota(user_id, restat=False):
+    """Evict derived artifacts of user_id while it is over USER_QUOTA_MB; returns its usage."""
+    with _user_lock(user_id):
+        usage = user_usage(user_id, restat)
+        limit = USER_QUOTA_MB * 1024 * 1024
+        if not limit or usage['total'] <= limit:
+            return usage
+        need = usage['total'] - int(limit * LOW_WATER)
+        now = time.time()
+        for tier in EVICTION_TIERS:
+            need -= _evict(_candidates(user_id, tier, now), need)
+            if need <= 0:
+                break
+        return user_usage(user_id)
+
+
+def _disk_shortfall(total):
+    """Bytes to free for TOTAL_QUOTA_MB and MIN_FREE_MB (0 if both are met)."""
+    need = 0
+    if TOTAL_QUOTA_MB and total > TOTAL_QUOTA_MB * 1024 * 1024:
+        need = total - int(TOTAL_QUOTA_MB * 1024 * 1024 * LOW_WATER)
+    if MIN_FREE_MB:
+        try:
+            free = shutil.disk_usage(USERS_DIR).free
+        except OSError:
+            free = None
+        if free is not None and free < MIN_FREE_MB * 1024 * 1024:
+            need = max(need, int(MIN_FREE_MB * 1024 * 1024 / LOW_WATER) - free)
+    return need
+
+
+def sweep():
+    """Enforce every user's quota, then the total quota and free space across all users.
+
+    Unlike the checks after writes, this stat's every file, so files that grew in place count."""
+    with _sweep_lock:
+        total = sum(enforce_user_quota(user_id, restat=True)['total'] for user_id in _user_ids())
+        need = _disk_shortfall(total)
+        if need <= 0:
+            return
+        now = time.time()
+        for tier in EVICTION_TIERS:
+            units = []
+            for user_id in _user_ids():
+                with _user_lock(user_id):
+                    units.extend(_candidates(user_id, tier, now))
+            need -= _evict(units, need)
+            if need <= 0:
+                return
+        print(f"[storage] still {need / 1024 / 1024:.0f} MB short after evicting derived artifacts")
+
+
+def check_quota(user_id):
+    """Make room before user_id stores new data; returns an error message if there is none.
+
+    Uses the last scanned usage plus the bytes written since; user_id's tree is only scanned
+    (and evicted) here the first time or when that estimate is over the quota. Running out of
+    disk space wakes the storage thread's sweep instead of sweeping here."""
+    global _sweep_requested
+    with _lock:
+        usage = _usage.get(user_id)
+        written = _written.get(user_id, 0)
+    if usage is None:
+        usage, written = user_usage(user_id), 0
+    limit = USER_QUOTA_MB * 1024 * 1024
+    if limit and usage['total'] + written > limit:
+        usage = enforce_user_quota(user_id)
+        if usage['total'] > limit:
+            return (f"Storage quota exceeded ({usage['total'] / 1024 / 1024:.0f} MB of {USER_QUOTA_MB} MB); "
+                    f"clear saved training data or start a new session")
+    if _disk_shortfall(0) > 0:
+        # Freeing space across users is the storage thread's job
+        with _wakeup:
+            _sweep_requested = True
+            _wakeup.notify()
+        return 'The server is out of disk space, please try again later'
+    return None
+
+
+def schedule_check(user_id, nbytes=0):
+    """Check user_id's quota soon, in the storage thread, after it wrote about nbytes."""
+    with _wakeup:
+        _written[user_id] = _written.get(user_id, 0) + nbytes
+        _pending.add(user_id)
+        _wakeup.notify()
+
+
+def forget_user(user_id):
+    """Drop what is remembered about users/<id> (it is being deleted)."""
+    with _lock:
+        _pending.discard(user_id)
+        for registry in (_dirs, _usage, _written, _user_locks):
+            registry.pop(user_id, None)
+
+
+def _run():
+    global _sweep_requested
+    next_sweep = time.time() + STORAGE_CHECK_SECONDS
+    while True:
+        with _wakeup:
+            if not _pending and not _sweep_requested:
+                _wakeup.wait(timeout=max(0.0, next_sweep - time.time()))
+            pending = list(_pending)
+            _pending.clear()
+            sweep_now, _sweep_requested = _sweep_requested, False
+        try:
+            for user_id in pending:
+                enforce_user_quota(user_id)
+            if sweep_now or time.time() >= next_sweep:
+                sweep()
+                next_sweep = time.time() + STORAGE_CHECK_SECONDS
+        except Exception as e:
+            print(f"[storage] check failed: {e}")
+
+
+def start_storage_manager():
+    """Start the thread that checks users after writes and sweeps every STORAGE_CHECK_SECONDS."""
+    global _manager
+    with _lock:
+        if _manager is None:
+            _manager = threading.Thread(target=_run, name='cat-storage', daemon=True)
+            _manager.start()
+    sweep()
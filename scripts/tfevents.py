@@ -0,0 +1,228 @@
+# tfevents.py - incremental reader for the scalars in TensorBoard event files, without TensorFlow
+#
+# An events.out.tfevents.* file is a TFRecord stream of serialized Event protos:
+#   uint64 length | uint32 masked crc32c(length) | data[length] | uint32 masked crc32c(data)
+# The few Event/Summary/TensorProto fields that carry scalars are decoded by hand below.
+#
+# Each file's byte offset and parsed scalars are remembered, so polling a file that is still
+# being written only parses the records appended since the last call. A record that is not
+# completely written yet is left for the next call.
+
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+# Event files whose parsed scalars are kept (per process)
+MAX_EVENT_FILES = 32
+
+_lock = threading.Lock()
+_files = OrderedDict()   # abspath -> _EventFile, least recently used first
+
+
+# --- TFRecord framing ---
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC_TABLE = _crc32c_table()
+
+
+def _masked_crc32c(data):
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc = _CRC_TABLE[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    crc ^= 0xFFFFFFFF
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def _records(buf):
+    """Yield (end offset, record data) for the complete records in buf."""
+    pos = 0
+    while len(buf) - pos >= 12:
+        header = buf[pos:pos + 8]
+        length, = struct.unpack('<Q', header)
+        length_crc, = struct.unpack_from('<I', buf, pos + 8)
+        if _masked_crc32c(header) != length_crc:
+            raise ValueError(f'corrupt record header at byte {pos}')
+        end = pos + 12 + length + 4
+        if end > len(buf):
+            return   # still being written
+        data = buf[pos + 12:pos + 12 + length]
+        data_crc, = struct.unpack_from('<I', buf, end - 4)
+        if _masked_crc32c(data) == data_crc:
+            yield end, data
+        else:
+            yield end, None
+        pos = end
+
+
+# --- protobuf wire format ---
+
+def _varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """Yield (field number, wire type, value) of a message; value is an int (varint) or bytes."""
+    pos = 0
+    while pos < len(buf):
+        key, pos = _varint(buf, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire == 2:
+            length, pos = _varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f'unsupported wire type {wire}')
+        yield field, wire, value
+
+
+def _signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+# TensorProto dtype -> (struct format of tensor_content, repeated field, its kind)
+_TENSOR_TYPES = {
+    1: ('<f', 5, 'f'),    # DT_FLOAT: float_val
+    2: ('<d', 6, 'd'),    # DT_DOUBLE: double_val
+    3: ('<i', 7, 'int'),  # DT_INT32: int_val
+    9: ('<q', 10, 'int'),  # DT_INT64: int64_val
+    10: ('<?', 11, 'int'),  # DT_BOOL: bool_val
+    19: ('<e', 13, 'half'),  # DT_HALF: half_val (bits in an int32)
+}
+
+
+def _tensor_scalar(buf):
+    """First value of a TensorProto of a numeric dtype, else None."""
+    fields = list(_fields(buf))
+    dtype = next((v for f, w, v in fields if f == 1 and w == 0), None)
+    if dtype not in _TENSOR_TYPES:
+        return None
+    fmt, val_field, kind = _TENSOR_TYPES[dtype]
+    for field, wire, value in fields:
+        if field == 4 and wire == 2 and len(value) >= struct.calcsize(fmt):
+            return float(struct.unpack_from(fmt, value)[0])   # tensor_content
+    for field, wire, value in fields:
+        if field != val_field:
+            continue
+        if kind in ('f', 'd'):
+            if len(value) >= struct.calcsize(kind):
+                return float(struct.unpack_from('<' + kind, value)[0])
+            continue
+        if wire == 2:
+            if not value:
+                continue
+            value, _ = _varint(value, 0)
+        if kind == 'half':
+            return float(struct.unpack('<e', struct.pack('<H', value & 0xFFFF))[0])
+        return float(_signed(value))
+    return None
+
+
+def _event_scalars(data):
+    """(step, wall_time, [(tag, value)]) of a serialized Event."""
+    step, wall_time, values = 0, 0.0, []
+    for field, wire, value in _fields(data):
+        if field == 1 and wire == 1:
+            wall_time, = struct.unpack('<d', value)
+        elif field == 2 and wire == 0:
+            step = _signed(value)
+        elif field == 5 and wire == 2:
+            for vfield, _, summary_value in _fields(value):
+                if vfield != 1:
+                    continue
+                tag, scalar, tensor = None, None, None
+                for f, w, v in _fields(summary_value):
+                    if f == 1 and w == 2:
+                        tag = v.decode('utf-8', 'replace')
+                    elif f == 2 and w == 5:
+                        scalar, = struct.unpack('<f', v)
+                    elif f == 8 and w == 2:
+                        tensor = v
+                if scalar is None and tensor is not None:
+                    scalar = _tensor_scalar(tensor)
+                if tag is not None and scalar is not None:
+                    values.append((tag, float(scalar)))
+    return step, wall_time, values
+
+
+# --- incremental reading ---
+
+class _EventFile:
+    def __init__(self, inode):
+        self.inode = inode
+        self.offset = 0
+        self.scalars = {}   # tag -> [{'step', 'wall_time', 'value'}] in file order
+        self.lock = threading.Lock()
+
+
+def _state(path, inode):
+    with _lock:
+        state = _files.get(path)
+        if state is None or state.inode != inode:
+            state = _files[path] = _EventFile(inode)
+        _files.move_to_end(path)
+        while len(_files) > MAX_EVENT_FILES:
+            _files.popitem(last=False)
+    return state
+
+
+def _read_new_records(path, state, size):
+    with open(path, 'rb') as f:
+        f.seek(state.offset)
+        buf = f.read(size - state.offset)
+    consumed = 0
+    try:
+        for end, data in _records(buf):
+            consumed = end
+            if data is None:
+                print(f"[tfevents] skipping a record with a bad checksum in {path}")
+                continue
+            step, wall_time, values = _event_scalars(data)
+            for tag, value in values:
+                state.scalars.setdefault(tag, []).append({'step': step, 'wall_time': wall_time, 'value': value})
+    except (ValueError, IndexError, struct.error) as e:
+        print(f"[tfevents] stopped reading {path}: {e}")
+    state.offset += consumed
+
+
+def read_scalars(path, since=None):
+    """Scalars of an event file as {tag: [{'step', 'wall_time', 'value'}]}, reading only what
+    was appended since the last call. With since, only points with step > since are returned."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    state = _state(path, st.st_ino)
+    with state.lock:
+        if st.st_size < state.offset:
+            # Truncated or rewritten: start over
+            state.offset, state.scalars = 0, {}
+        if st.st_size > state.offset:
+            _read_new_records(path, state, st.st_size)
+        if since is None:
+            return {tag: list(points) for tag, points in state.scalars.items()}
+        result = {}
+        for tag, points in state.scalars.items():
+            new = [p for p in points if p['step'] > since]
+            if new:
+                result[tag] = new
+        return result
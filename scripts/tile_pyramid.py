@@ -0,0 +1,170 @@
+# tile_pyramid.py - Deep Zoom (DZI) tile pyramids of the normalized preview for the viewer
+#
+# Layout of one pyramid directory (DZI conventions, overlap 0):
+#   image.dzi                          descriptor (XML)
+#   info.json                          same information for the viewer
+#   image_files/<level>/<col>_<row>.<format>
+# Level max_level is full resolution; every level below halves both dimensions (rounding up)
+# down to level 0, which is 1x1 pixel. info.json is written last and marks a complete pyramid.
+#
+# start_pyramid() returns the info right away and writes the tiles on a background thread,
+# coarsest level first; wait_for_level() lets a tile request block until its level exists.
+
+import os
+import json
+import math
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+VIEW_TILE_SIZE = int(os.environ.get('CAT_VIEW_TILE_SIZE', 256))
+VIEW_TILE_FORMAT = os.environ.get('CAT_VIEW_TILE_FORMAT', 'png')   # 'png' or 'jpeg'
+VIEW_TILE_QUALITY = int(os.environ.get('CAT_VIEW_TILE_QUALITY', 90))
+PYRAMID_WORKERS = int(os.environ.get('CAT_PYRAMID_WORKERS', 2))
+
+_executor = ThreadPoolExecutor(max_workers=max(1, PYRAMID_WORKERS), thread_name_prefix='cat-pyramid')
+_lock = threading.Condition()
+_builds = {}   # realpath of out_dir -> {'info', 'levels_done': set, 'cancelled'}
+
+_DZI_TEMPLATE = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{fmt}" Overlap="0" '
+                 'TileSize="{tile}">\n  <Size Width="{width}" Height="{height}"/>\n</Image>\n')
+
+
+def level_count(width, height):
+    return int(math.ceil(math.log2(max(width, height, 1)))) + 1
+
+
+def _halve(arr):
+    """2x2 box average, rounding odd dimensions up (the last row/column is repeated)."""
+    height, width = arr.shape[:2]
+    if height % 2 or width % 2:
+        arr = np.pad(arr, ((0, height % 2), (0, width % 2)) + ((0, 0),) * (arr.ndim - 2), mode='edge')
+    acc = arr[0::2, 0::2].astype(np.uint16)
+    acc += arr[1::2, 0::2]
+    acc += arr[0::2, 1::2]
+    acc += arr[1::2, 1::2]
+    acc += 2
+    acc >>= 2
+    return acc.astype(np.uint8)
+
+
+def _save_tile(tile, path, fmt):
+    img = Image.fromarray(np.ascontiguousarray(tile))
+    if fmt == 'jpeg':
+        img.convert('RGB').save(path, 'JPEG', quality=VIEW_TILE_QUALITY)
+    else:
+        img.save(path, 'PNG', compress_level=1)
+
+
+def pyramid_info(width, height, tile_size=VIEW_TILE_SIZE, fmt=VIEW_TILE_FORMAT):
+    ext = 'jpg' if fmt == 'jpeg' else 'png'
+    return {'width': width, 'height': height, 'tile_size': tile_size,
+            'levels': level_count(width, height), 'format': ext}
+
+
+def _write_levels(rendition, out_dir, info, fmt, on_level=None, cancelled=None):
+    """Write every level's tiles, coarsest first, calling on_level(level) after each one."""
+    tile_size, ext = info['tile_size'], info['format']
+    # The halvings are cheap next to encoding; keeping them lets the coarse levels go out first
+    levels = [rendition]
+    for _ in range(info['levels'] - 1):
+        levels.append(_halve(levels[-1]))
+    for level, level_arr in enumerate(reversed(levels)):
+        level_dir = os.path.join(out_dir, 'image_files', str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        level_h, level_w = level_arr.shape[:2]
+        for row, y in enumerate(range(0, level_h, tile_size)):
+            for col, x in enumerate(range(0, level_w, tile_size)):
+                if cancelled and cancelled():
+                    return False
+                _save_tile(level_arr[y:y + tile_size, x:x + tile_size],
+                           os.path.join(level_dir, f'{col}_{row}.{ext}'), fmt)
+        if on_level:
+            on_level(level)
+    return True
+
+
+def _write_descriptor(out_dir, info):
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'image.dzi'), 'w') as f:
+        f.write(_DZI_TEMPLATE.format(fmt=info['format'], tile=info['tile_size'],
+                                     width=info['width'], height=info['height']))
+
+
+def _write_info(out_dir, info):
+    tmp_path = os.path.join(out_dir, 'info.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(info, f)
+    os.replace(tmp_path, os.path.join(out_dir, 'info.json'))
+
+
+def build_pyramid(rendition, out_dir, tile_size=VIEW_TILE_SIZE, fmt=VIEW_TILE_FORMAT):
+    """Write the DZI pyramid of an 8-bit (H, W[, C]) array into out_dir and return its info dict."""
+    info = pyramid_info(rendition.shape[1], rendition.shape[0], tile_size, fmt)
+    _write_descriptor(out_dir, info)
+    _write_levels(rendition, out_dir, info, fmt)
+    _write_info(out_dir, info)
+    return info
+
+
+def start_pyramid(rendition, out_dir, tile_size=VIEW_TILE_SIZE, fmt=VIEW_TILE_FORMAT):
+    """Like build_pyramid, but the tiles are written in the background; returns the info at once.
+
+    Starting a pyramid that is already being built into out_dir returns that build's info.
+    """
+    key = os.path.realpath(out_dir)
+    with _lock:
+        build = _builds.get(key)
+        if build:
+            return dict(build['info'])
+        info = pyramid_info(rendition.shape[1], rendition.shape[0], tile_size, fmt)
+        build = {'info': info, 'levels_done': set(), 'cancelled': False}
+        _builds[key] = build
+    _write_descriptor(out_dir, info)
+
+    def level_done(level):
+        with _lock:
+            build['levels_done'].add(level)
+            _lock.notify_all()
+
+    def run():
+        try:
+            if _write_levels(rendition, out_dir, info, fmt, level_done, lambda: build['cancelled']):
+                _write_info(out_dir, info)
+        except Exception as e:
+            print(f"[pyramid] Building {out_dir} failed: {e}")
+        finally:
+            with _lock:
+                _builds.pop(key, None)
+                _lock.notify_all()
+            if build['cancelled']:
+                shutil.rmtree(out_dir, ignore_errors=True)
+
+    _executor.submit(run)
+    return dict(info)
+
+
+def cancel_pyramid(out_dir):
+    """Stop a background build of out_dir (its directory is removed when the build stops)."""
+    with _lock:
+        build = _builds.get(os.path.realpath(out_dir))
+        if build:
+            build['cancelled'] = True
+        return build is not None
+
+
+def wait_for_level(out_dir, level, timeout=30):
+    """Block until level of a pyramid being built in out_dir is written (or its build ends)."""
+    key = os.path.realpath(out_dir)
+    with _lock:
+        _lock.wait_for(lambda: key not in _builds or level in _builds[key]['levels_done'], timeout)
+
+
+def pending_info(out_dir):
+    """Info of the pyramid being built in out_dir, or None if no build is running."""
+    with _lock:
+        build = _builds.get(os.path.realpath(out_dir))
+        return dict(build['info']) if build else None
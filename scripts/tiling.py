@@ -0,0 +1,119 @@
+# tiling.py - in-process tiling engine (replaces the split_image.py / merge_annotations.py round trip)
+
+import os
+import hashlib
+import numpy as np
+from PIL import Image
+from scripts.percentile import image_percentiles
+from scripts.image_source import expand_palette
+# Disable decompression bomb protection for large TIFF files
+Image.MAX_IMAGE_PIXELS = None
+
+TILE_SIZE = 512
+# Pixels shared by neighbouring tiles so cells on a seam are seen whole by at least one tile
+TILE_OVERLAP = int(os.environ.get('CAT_TILE_OVERLAP', 64))
+
+# Background pre-filter: tiles with no foreground are never sent to the model
+SKIP_BACKGROUND = os.environ.get('CAT_SKIP_BACKGROUND', '1') != '0'
+# Tiles byte-identical to an earlier tile reuse its detections instead of being run again
+SKIP_DUPLICATES = os.environ.get('CAT_SKIP_DUPLICATE_TILES', '1') != '0'
+# A tile is flat if its std is below this fraction of the image's p_low..p_high range
+BACKGROUND_MIN_STD = float(os.environ.get('CAT_BACKGROUND_MIN_STD', 0.01))
+# ...or if fewer than this fraction of its pixels are above the image's low percentile
+BACKGROUND_MIN_FOREGROUND = float(os.environ.get('CAT_BACKGROUND_MIN_FOREGROUND', 0.005))
+# Pixels sampled from the image to estimate its percentiles
+_STATS_SAMPLE = 1 << 20
+
+
+def load_image_array(image_path):
+    """Decode an image file into a numpy array using the same decoder split_image.py used.
+
+    Palette images are expanded to RGB(A), as split_image.py's tile PNGs were by convert('RGB')."""
+    with Image.open(image_path) as img:
+        return np.asarray(expand_palette(img))
+
+
+def tile_origins(length, tile_size=TILE_SIZE, overlap=0):
+    """Start offsets along one axis for tiles of tile_size that overlap by `overlap` pixels."""
+    stride = max(tile_size - overlap, 1)
+    return range(0, max(length - overlap, 1), stride)
+
+
+def iter_tiles(arr, tile_size=TILE_SIZE, overlap=0):
+    """Yield (x, y, tile) for every tile of the array in row-major order.
+
+    Tiles are numpy views into arr, so nothing is copied; edge tiles are smaller
+    than tile_size exactly like the PNG tiles split_image.py used to write.
+    With overlap=0 the grid is identical to split_image.py's.
+    """
+    height, width = arr.shape[:2]
+    for y in tile_origins(height, tile_size, overlap):
+        for x in tile_origins(width, tile_size, overlap):
+            yield x, y, arr[y:y + tile_size, x:x + tile_size]
+
+
+def background_thresholds(arr, low_percentile=1, high_percentile=99):
+    """Image-level (floor, min_std) used by is_background_tile.
+
+    floor is the normalization low percentile; min_std is BACKGROUND_MIN_STD of the
+    percentile range. Percentiles are estimated on a strided subsample of the image.
+    """
+    step = max(1, int(np.sqrt(arr.shape[0] * arr.shape[1] / _STATS_SAMPLE)))
+    sample = arr[::step, ::step]
+    p_low, p_high = image_percentiles(sample, low_percentile, high_percentile)
+    return p_low, BACKGROUND_MIN_STD * (p_high - p_low)
+
+
+def is_background_tile(tile, floor, min_std):
+    """True when a tile's intensity statistics show no foreground.
+
+    Checked cheapest first: everything at or below the floor, a flat tile, or almost
+    no pixels above the floor.
+    """
+    if tile.size == 0 or tile.max() <= floor:
+        return True
+    if tile.std() <= min_std:
+        return True
+    return np.count_nonzero(tile > floor) < BACKGROUND_MIN_FOREGROUND * tile.size
+
+
+def tile_digest(tile):
+    """Content key for byte-identical tile detection."""
+    return tile.shape, hashlib.blake2b(np.ascontiguousarray(tile).data, digest_size=16).digest()
+
+
+def merge_tile_boxes(tile_results, with_tiles=False):
+    """Shift per-tile pixel boxes into full-image coordinates and concatenate them.
+
+    tile_results is a list of (x_offset, y_offset, boxes, scores, classes) where boxes
+    are xyxy pixel coordinates relative to the tile. Returns (boxes, scores, classes), plus
+    the index into tile_results each box came from if with_tiles is set.
+    """
+    if not tile_results:
+        empty = np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        return empty + (np.zeros(0, dtype=np.int64),) if with_tiles else empty
+
+    boxes = []
+    for x, y, tile_boxes, _, _ in tile_results:
+        boxes.append(np.asarray(tile_boxes, dtype=np.float32).reshape(-1, 4) + np.array([x, y, x, y], dtype=np.float32))
+    scores = np.concatenate([np.asarray(r[3], dtype=np.float32).reshape(-1) for r in tile_results])
+    classes = np.concatenate([np.asarray(r[4]).reshape(-1).astype(np.int64) for r in tile_results])
+    if with_tiles:
+        tiles = np.repeat(np.arange(len(tile_results)), [len(b) for b in boxes])
+        return np.concatenate(boxes), scores, classes, tiles
+    return np.concatenate(boxes), scores, classes
+
+
+def format_yolo_annotations(boxes, classes, image_width, image_height):
+    """Format full-image xyxy pixel boxes as YOLO lines normalized to the image size."""
+    if len(boxes) == 0:
+        return ""
+    boxes = np.asarray(boxes, dtype=np.float64)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2.0 / image_width
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2.0 / image_height
+    w = (boxes[:, 2] - boxes[:, 0]) / image_width
+    h = (boxes[:, 3] - boxes[:, 1]) / image_height
+    return "".join(
+        f"{int(c)} {x:.6f} {y:.6f} {bw:.6f} {bh:.6f}\n"
+        for c, x, y, bw, bh in zip(classes, cx, cy, w, h)
+    )
@@ -0,0 +1,65 @@
+# scripts/train_job.py - run as: python3 -m scripts.train_job ...
+# One YOLO training run in its own process, started by the training scheduler
+# (scripts/training_jobs.py). Progress (epoch, metrics, epoch durations) is written to
+# --progress after every epoch so the scheduler can report it and estimate the time left.
+import os, json, time, argparse
+from ultralytics import YOLO
+
+
+def write_progress(path, progress):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, path)
+
+
+def _scalar(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def main(args):
+    progress = {'stage': 'train', 'epoch': 0, 'epochs': args.epochs, 'metrics': {}, 'epoch_seconds': []}
+    write_progress(args.progress, progress)
+    last = [time.time()]
+
+    def on_fit_epoch_end(trainer):
+        now = time.time()
+        progress['epoch'] = trainer.epoch + 1
+        progress['epochs'] = trainer.epochs
+        progress['epoch_seconds'].append(now - last[0])
+        metrics = {k: _scalar(v) for k, v in (trainer.metrics or {}).items()}
+        progress['metrics'] = {k: v for k, v in metrics.items() if v is not None}
+        last[0] = now
+        write_progress(args.progress, progress)
+
+    # Its own process: load the weights directly, the model cache has nothing to share here
+    model = YOLO(args.weights)
+    model.add_callback('on_fit_epoch_end', on_fit_epoch_end)
+    model.train(
+        data=args.data,
+        epochs=args.epochs,
+        imgsz=args.imgsz,
+        batch=args.batch,
+        workers=args.workers,
+        project=args.project,
+        name=args.name,
+        save=True
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', required=True)
+    parser.add_argument('--weights', required=True)
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=4)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--project', required=True)
+    parser.add_argument('--name', required=True)
+    parser.add_argument('--progress', required=True)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,217 @@
+# training_events.py - live training metrics for the /training-events Server-Sent Events stream
+#
+# One watcher thread per user follows the run being trained (the run_name of the user's
+# active training job, else the newest users/<id>/snapshots/run_*) and pushes what changed to
+# every connected stream, so several open tabs share one watcher. Directories are only listed
+# again when their mtime changes and the event file is only read when it grew (through the
+# incremental reader in scripts/tfevents.py).
+#
+# Stream events:
+#   snapshot - {'run', 'scalars', 'progress'}: everything so far, sent first on each connection
+#   scalars  - {tag: [points]}: points appended to the event file
+#   epoch    - {'epoch'}: a new step (epoch) has appeared in the event file
+#   progress - the training job's progress (stage, epoch, epochs, eta_seconds, ...)
+#   done     - {'status'}: the run is over (the stream ends after it)
+
+import os
+import json
+import time
+import queue
+import threading
+from scripts.tfevents import read_scalars
+from scripts.training_jobs import active_training_job
+
+# How often a watcher checks the run for changes
+POLL_SECONDS = float(os.environ.get('CAT_EVENTS_POLL_SECONDS', 1.0))
+# Comment line sent on idle streams, so closed connections are noticed
+KEEPALIVE_SECONDS = 15
+
+_lock = threading.Lock()
+_watchers = {}   # user_id -> _RunWatcher
+
+
+def _newest(entries):
+    return max(entries, key=lambda e: e.stat().st_mtime_ns).path if entries else None
+
+
+class _RunWatcher:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.snapshot_dir = os.path.join('users', user_id, 'snapshots')
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.run_dir = None
+        self.run_from_job = False
+        self.snapshots_mtime = None
+        self.newest_run = None
+        self.run_mtime = None
+        self.event_file = None
+        self.file_size = None
+        self.scalars = {}    # tag -> points sent so far
+        self.last_step = None
+        self.progress = None
+        self.status = None   # set once the run is over
+
+    def _broadcast(self, event, data):
+        for q in self.subscribers:
+            q.put((event, data))
+
+    def _mtime(self, path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _newest_run(self):
+        mtime = self._mtime(self.snapshot_dir)
+        if mtime != self.snapshots_mtime:
+            self.snapshots_mtime = mtime
+            try:
+                with os.scandir(self.snapshot_dir) as it:
+                    runs = [e for e in it if e.name.startswith('run_') and e.is_dir()]
+            except OSError:
+                runs = []
+            self.newest_run = max(runs, key=lambda e: e.name).path if runs else None
+        return self.newest_run
+
+    def _set_run(self, run_dir, from_job):
+        self.run_dir = run_dir
+        self.run_from_job = from_job
+        self.run_mtime = self.event_file = self.file_size = self.last_step = self.status = None
+        self.scalars = {}
+        self._broadcast('snapshot', self.snapshot())
+
+    def _read_events(self):
+        mtime = self._mtime(self.run_dir)
+        if mtime != self.run_mtime:
+            self.run_mtime = mtime
+            try:
+                with os.scandir(self.run_dir) as it:
+                    files = [e for e in it if e.name.startswith('events.out.tfevents.')]
+            except OSError:
+                files = []
+            newest = _newest(files)
+            if newest != self.event_file:
+                self.event_file, self.file_size = newest, None
+        if self.event_file is None:
+            return
+        try:
+            size = os.path.getsize(self.event_file)
+        except OSError:
+            return
+        if size == self.file_size:
+            return
+        self.file_size = size
+
+        new = {}
+        for tag, points in read_scalars(self.event_file).items():
+            sent = self.scalars.setdefault(tag, [])
+            if len(points) > len(sent):
+                new[tag] = points[len(sent):]
+                sent.extend(new[tag])
+        if not new:
+            return
+        self._broadcast('scalars', new)
+        step = max(p['step'] for points in new.values() for p in points)
+        if self.last_step is None or step > self.last_step:
+            self.last_step = step
+            self._broadcast('epoch', {'epoch': step})
+
+    def poll(self):
+        job = active_training_job(self.user_id)
+        run_name = job['progress'].get('run_name') if job else None
+        if job and not run_name:
+            return   # queued or preparing its dataset: the run does not exist yet
+        if run_name:
+            run_dir = os.path.join(self.snapshot_dir, run_name)
+            if run_dir != self.run_dir:
+                self._set_run(run_dir, True)
+        elif self.run_dir is None or (not self.run_from_job and self._newest_run() != self.run_dir):
+            run_dir = self._newest_run()
+            if run_dir is None:
+                return
+            self._set_run(run_dir, False)
+
+        if self.status is not None:
+            return
+        self._read_events()
+
+        if run_name:
+            progress = {k: v for k, v in job['progress'].items() if k != 'metrics'}
+            if progress != self.progress:
+                self.progress = progress
+                self._broadcast('progress', progress)
+            if progress.get('stage') == 'train':
+                return
+            status = 'trained'   # training finished, the job continues with k-fold validation
+        else:
+            status = 'finished'
+        self.status = status
+        self._broadcast('done', {'status': status})
+
+    def snapshot(self):
+        return {'run': os.path.basename(self.run_dir) if self.run_dir else None,
+                'scalars': {tag: list(points) for tag, points in self.scalars.items()},
+                'progress': self.progress}
+
+    def run(self):
+        while True:
+            time.sleep(POLL_SECONDS)
+            with _lock:
+                if not self.subscribers:
+                    _watchers.pop(self.user_id, None)
+                    return
+            self.safe_poll()
+
+    def safe_poll(self):
+        with self.lock:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"[training-events] watching the run of {self.user_id} failed: {e}")
+
+
+def subscribe(user_id):
+    """Queue of (event, data) for a new stream of user_id, starting with a snapshot."""
+    q = queue.Queue()
+    with _lock:
+        watcher = _watchers.get(user_id)
+        started = watcher is None
+        if started:
+            watcher = _watchers[user_id] = _RunWatcher(user_id)
+        with watcher.lock:
+            watcher.subscribers.append(q)
+            q.put(('snapshot', watcher.snapshot()))
+            if watcher.status is not None:
+                q.put(('done', {'status': watcher.status}))
+    if started:
+        # The first look at the run sends the subscriber a full snapshot
+        watcher.safe_poll()
+        threading.Thread(target=watcher.run, name=f'cat-events-{user_id[:8]}', daemon=True).start()
+    return q
+
+
+def unsubscribe(user_id, q):
+    with _lock:
+        watcher = _watchers.get(user_id)
+        if watcher is not None:
+            with watcher.lock:
+                if q in watcher.subscribers:
+                    watcher.subscribers.remove(q)
+
+
+def event_stream(user_id):
+    """Server-Sent Events for user_id's current run, ending after 'done'."""
+    q = subscribe(user_id)
+    try:
+        while True:
+            try:
+                event, data = q.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            if event == 'done':
+                return
+    finally:
+        unsubscribe(user_id, q)
@@ -0,0 +1,313 @@
+# training_jobs.py - scheduler for /train-saved training runs
+#
+# Training jobs wait in a queue and run in at most TRAINING_SLOTS background threads; the
+# heavy work (YOLO training, k-fold validation) runs in child processes started through
+# JobContext.run_process, each with a thread budget of TRAINING_THREADS so concurrent jobs
+# do not oversubscribe the CPU. Slots are handed out fairly across sessions (see
+# _next_job_locked), so one user queueing several runs cannot starve the others.
+#
+# Job state is written to users/<id>/training_jobs/<job_id>.json on every change. Jobs that
+# were queued or running when the service stopped are reported as 'interrupted' afterwards.
+
+import os
+import json
+import time
+import uuid
+import signal
+import threading
+import subprocess
+
+# Training runs executing at once
+TRAINING_SLOTS = int(os.environ.get('CAT_TRAINING_SLOTS', 1))
+# CPU threads given to each running job's processes
+TRAINING_THREADS = int(os.environ.get('CAT_TRAINING_THREADS', max(1, (os.cpu_count() or 1) // max(1, TRAINING_SLOTS))))
+# How often a running child process is checked for progress and cancellation
+POLL_SECONDS = 2.0
+
+ACTIVE_STATES = ('queued', 'running')
+
+_lock = threading.Condition()
+_jobs = {}        # job_id -> job dict (see submit_training_job)
+_queue = []       # queued job ids, oldest first
+_running = set()  # running job ids
+_last_started = {}  # user_id -> when a job of that user last started
+_dispatcher = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _state_path(job):
+    return os.path.join('users', job['user_id'], 'training_jobs', f"{job['id']}.json")
+
+
+def _persist(job):
+    if not os.path.isdir(os.path.join('users', job['user_id'])):
+        return   # the session was cleaned up while the job was winding down
+    path = _state_path(job)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state = {k: v for k, v in job.items() if not k.startswith('_')}
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+class JobContext:
+    """Handed to a job's run function: progress reporting, cancellation and child processes."""
+
+    def __init__(self, job):
+        self.job = job
+
+    @property
+    def cancelled(self):
+        return self.job['_cancel'].is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def set_progress(self, **progress):
+        with _lock:
+            self.job['progress'].update(progress)
+            _persist(self.job)
+
+    def thread_env(self):
+        """Environment for child processes limited to this job's thread budget."""
+        env = dict(os.environ)
+        for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+            env[var] = str(TRAINING_THREADS)
+        return env
+
+    def run_process(self, cmd, progress_path=None):
+        """Run cmd with the thread budget until it exits; progress_path (JSON written by the
+        child) is merged into the job's progress while it runs. Raises JobCancelled when the
+        job is cancelled (the process is terminated) and CalledProcessError on failure."""
+        self.check_cancelled()
+        proc = subprocess.Popen(cmd, env=self.thread_env(), start_new_session=True)
+        self.job['_process'] = proc
+        try:
+            while True:
+                try:
+                    proc.wait(timeout=POLL_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if self.cancelled:
+                    _terminate(proc)
+                    raise JobCancelled()
+                if progress_path:
+                    self._read_progress(progress_path)
+        finally:
+            self.job['_process'] = None
+        if progress_path:
+            self._read_progress(progress_path)
+        self.check_cancelled()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    def _read_progress(self, progress_path):
+        try:
+            with open(progress_path) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return
+        epoch_seconds = progress.pop('epoch_seconds', [])
+        if epoch_seconds and progress.get('epochs'):
+            remaining = progress['epochs'] - progress.get('epoch', 0)
+            progress['eta_seconds'] = round(sum(epoch_seconds) / len(epoch_seconds) * remaining)
+        self.set_progress(**progress)
+
+
+def _terminate(proc):
+    # The child runs in its own session, so its data loader workers are stopped with it
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+def _next_job_locked():
+    """Fair pick: users with fewer running jobs first, then the user who started one longest
+    ago, then queue order."""
+    if not _queue:
+        return None
+    running = {}
+    for job_id in _running:
+        user_id = _jobs[job_id]['user_id']
+        running[user_id] = running.get(user_id, 0) + 1
+
+    def rank(item):
+        index, job_id = item
+        user_id = _jobs[job_id]['user_id']
+        return running.get(user_id, 0), _last_started.get(user_id, 0.0), index
+
+    return min(enumerate(_queue), key=rank)[1]
+
+
+def _dispatch():
+    while True:
+        with _lock:
+            job_id = None
+            while job_id is None:
+                if len(_running) < TRAINING_SLOTS:
+                    job_id = _next_job_locked()
+                if job_id is None:
+                    _lock.wait()
+            _queue.remove(job_id)
+            _running.add(job_id)
+            job = _jobs[job_id]
+            job['status'] = 'running'
+            job['started'] = time.time()
+            _last_started[job['user_id']] = job['started']
+            _persist(job)
+        threading.Thread(target=_run, args=(job,), name=f'cat-train-{job_id[:8]}', daemon=True).start()
+
+
+def _run(job):
+    try:
+        result = job['_run'](JobContext(job))
+        status, error = 'done', None
+    except JobCancelled:
+        result, status, error = None, 'cancelled', None
+    except Exception as e:
+        print(f"[training] job {job['id']} failed: {e}")
+        result, status, error = None, 'failed', str(e)
+    with _lock:
+        job['result'] = result
+        job['status'] = status
+        job['error'] = error
+        job['finished'] = time.time()
+        _running.discard(job['id'])
+        _persist(job)
+        _lock.notify_all()
+
+
+def _ensure_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = threading.Thread(target=_dispatch, name='cat-train-dispatch', daemon=True)
+        _dispatcher.start()
+
+
+def submit_training_job(user_id, params, run):
+    """Queue run(ctx) as a training job of user_id and return the job id.
+
+    params (JSON-safe) is stored with the job for display; run receives a JobContext and
+    returns the JSON-safe result shown once the job is done.
+    """
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'user_id': user_id,
+        'params': params,
+        'status': 'queued',
+        'created': time.time(),
+        'started': None,
+        'finished': None,
+        'progress': {'stage': 'queued'},
+        'result': None,
+        'error': None,
+        '_run': run,
+        '_cancel': threading.Event(),
+        '_process': None,
+    }
+    with _lock:
+        _jobs[job_id] = job
+        _queue.append(job_id)
+        _persist(job)
+        _ensure_dispatcher()
+        _lock.notify_all()
+    return job_id
+
+
+def cancel_training_job(job_id, user_id):
+    """Cancel a queued or running job; returns False if it is unknown or already finished."""
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None or job['user_id'] != user_id or job['status'] not in ACTIVE_STATES:
+            return False
+        job['_cancel'].set()
+        if job['status'] == 'queued':
+            _queue.remove(job_id)
+            job['status'] = 'cancelled'
+            job['finished'] = time.time()
+            _persist(job)
+        else:
+            # The running process is terminated by the job's own thread within POLL_SECONDS
+            job['progress']['stage'] = 'cancelling'
+            _persist(job)
+        _lock.notify_all()
+    return True
+
+
+def training_job_summary(job):
+    """JSON-safe status of a job, with its place in the queue while it waits."""
+    summary = {k: v for k, v in job.items() if not k.startswith('_')}
+    summary['job_id'] = summary.pop('id')
+    summary.pop('user_id', None)
+    with _lock:
+        summary['queue_position'] = _queue.index(job['id']) + 1 if job['id'] in _queue else None
+    return summary
+
+
+def get_training_job(job_id, user_id):
+    """Return the job if it exists and belongs to user_id, else None."""
+    job = _jobs.get(job_id)
+    if job is None or job['user_id'] != user_id:
+        return None
+    return job
+
+
+def active_training_job(user_id):
+    """The user's queued or running job, if any."""
+    with _lock:
+        for job in _jobs.values():
+            if job['user_id'] == user_id and job['status'] in ACTIVE_STATES:
+                return job
+    return None
+
+
+def list_training_jobs(user_id):
+    with _lock:
+        jobs = sorted((j for j in _jobs.values() if j['user_id'] == user_id), key=lambda j: j['created'])
+    return [training_job_summary(j) for j in jobs]
+
+
+def load_training_jobs(users_dir='users'):
+    """Read the persisted jobs of every user (on startup); unfinished ones become 'interrupted'."""
+    if not os.path.isdir(users_dir):
+        return
+    for user_id in os.listdir(users_dir):
+        jobs_dir = os.path.join(users_dir, user_id, 'training_jobs')
+        if not os.path.isdir(jobs_dir):
+            continue
+        for name in os.listdir(jobs_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(jobs_dir, name)) as f:
+                    job = json.load(f)
+            except (OSError, ValueError):
+                continue
+            job.update({'_run': None, '_cancel': threading.Event(), '_process': None})
+            with _lock:
+                if job['id'] in _jobs:
+                    continue
+                _jobs[job['id']] = job
+                if job['status'] in ACTIVE_STATES:
+                    job['status'] = 'interrupted'
+                    job['finished'] = job['finished'] or time.time()
+                    _persist(job)
+
+
+def prune_training_jobs(user_id):
+    """Forget the finished jobs of user_id (its files are being deleted)."""
+    with _lock:
+        for job_id in [k for k, j in _jobs.items() if j['user_id'] == user_id and j['status'] not in ACTIVE_STATES]:
+            del _jobs[job_id]
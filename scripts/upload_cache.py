@@ -0,0 +1,136 @@
+# upload_cache.py - per-session cache of decoded uploads, their percentiles and 8-bit renditions
+#
+# One upload is used by /upload (dimensions + preview), /scale-image, the detect endpoints and
+# detect_with_tiling. Each entry keeps, for one file of one session:
+#   - the open ImageSource (decoded pixels for PNG/JPEG, memory map / tile reader for TIFF)
+#   - the normalization percentiles and the normalized 8-bit rendition, built on first use
+# Entries are checked against the file's mtime/size on every access and dropped explicitly on
+# crop and on a new upload, so a stale rendition is never served. A dropped or evicted entry
+# releases its source (closes the file, frees decoded segments); a request still reading from
+# it transparently reopens the file.
+
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from PIL import Image
+from scripts.image_source import ImageSource
+from scripts.normalization import normalized_rendition
+
+# Upper bound for decoded pixels + renditions held across all sessions
+UPLOAD_CACHE_MB = int(os.environ.get('CAT_UPLOAD_CACHE_MB', 1024))
+
+_lock = threading.Lock()
+_entries = OrderedDict()   # (user_id, abspath) -> entry dict, least recently used first
+
+
+def _file_stat(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _entry_nbytes(entry):
+    # Segment caches grow as a source is read, so this is recomputed on every check
+    nbytes = entry['source'].cached_bytes
+    if entry['normalized'] is not None:
+        nbytes += entry['normalized'].nbytes
+    return nbytes
+
+
+def _evict_locked():
+    limit = UPLOAD_CACHE_MB * 1024 * 1024
+    total = sum(_entry_nbytes(e) for e in _entries.values())
+    while total > limit and len(_entries) > 1:
+        _, entry = _entries.popitem(last=False)
+        total -= _entry_nbytes(entry)
+        entry['source'].release()
+
+
+def _get_entry(user_id, path, array=None):
+    key = (user_id, os.path.abspath(path))
+    stat = _file_stat(path)
+    if array is None:
+        with _lock:
+            entry = _entries.get(key)
+            if entry is not None and entry['stat'] == stat:
+                _entries.move_to_end(key)
+                _evict_locked()
+                return entry
+
+    # Decode outside the registry lock
+    entry = {
+        'stat': stat,
+        'source': ImageSource(path, array=array),
+        'normalized': None,
+        'percentiles': None,
+        'params': None,
+        'lock': threading.Lock(),
+    }
+    with _lock:
+        current = _entries.get(key)
+        if array is None and current is not None and current['stat'] == stat:
+            _entries.move_to_end(key)
+            entry['source'].release()
+            return current
+        if current is not None:
+            current['source'].release()
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        _evict_locked()
+    return entry
+
+
+def get_source(user_id, path):
+    """Cached ImageSource for an uploaded file (owned by the cache; do not close it)."""
+    return _get_entry(user_id, path)['source']
+
+
+def remember_array(user_id, path, array):
+    """Register pixels that were just written to path, so the next access skips decoding them."""
+    return _get_entry(user_id, path, array=array)['source']
+
+
+def _ensure_normalized(user_id, path, low_percentile, high_percentile):
+    entry = _get_entry(user_id, path)
+    with entry['lock']:
+        if entry['params'] != (low_percentile, high_percentile):
+            normalized, percentiles = normalized_rendition(path, low_percentile, high_percentile,
+                                                           source=entry['source'])
+            entry['normalized'] = normalized
+            entry['percentiles'] = percentiles
+            entry['params'] = (low_percentile, high_percentile)
+            with _lock:
+                _evict_locked()
+    return entry
+
+
+def get_normalized(user_id, path, low_percentile=1, high_percentile=99):
+    """The normalized 8-bit rendition normalize_image would produce (None for non-integer images)."""
+    return _ensure_normalized(user_id, path, low_percentile, high_percentile)['normalized']
+
+
+def get_percentiles(user_id, path, low_percentile=1, high_percentile=99):
+    """(p_low, p_high) used for the rendition, or None if the image was already 8-bit."""
+    return _ensure_normalized(user_id, path, low_percentile, high_percentile)['percentiles']
+
+
+def get_rendition(user_id, path, low_percentile=1, high_percentile=99):
+    """8-bit RGB pixels of what normalize_image(path, ...) writes (the viewer's rendition)."""
+    try:
+        normalized = get_normalized(user_id, path, low_percentile, high_percentile)
+    except Exception as e:
+        # Same fallback as normalize_image: a plain PIL conversion
+        print(f"Error normalizing image: {str(e)}")
+        normalized = None
+    if normalized is not None:
+        return normalized
+    with Image.open(path) as img:
+        return np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
+
+
+def invalidate(user_id, path=None):
+    """Drop the cached state of one file, or of every file of the session when path is None."""
+    target = os.path.abspath(path) if path is not None else None
+    with _lock:
+        for key in [k for k in _entries if k[0] == user_id and (target is None or k[1] == target)]:
+            _entries.pop(key)['source'].release()
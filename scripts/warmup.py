@@ -0,0 +1,98 @@
+# warmup.py - background start-up work and the readiness state reported by /readyz
+#
+# app.py imports no heavy library at module load: torch and ultralytics are imported on first
+# use (scripts/detect_tiles.py, scripts/model_cache.py). The warm-up thread started by app.py
+# runs the deferred start-up steps (e.g. the session cleanup scheduler) and then imports the
+# heavy libraries in the background, so the first detection does not pay for them either.
+# CAT_WARMUP=0 skips the imports (they then happen on first use).
+#
+# Model warm-up is opt-in (CAT_WARMUP_MODELS): the models are loaded into the model cache and
+# each runs one dummy batch per tile size, so weight loading, first-inference setup and the
+# allocator warm-up happen before the instance reports ready instead of on a user's click.
+
+import os
+import time
+import importlib
+import threading
+
+from scripts.model_cache import DETECT_MODELS, BATCH_MODELS
+
+WARMUP = os.environ.get('CAT_WARMUP', '1') != '0'
+# Imported by the warm-up thread, in this order
+WARMUP_MODULES = ('torch', 'ultralytics')
+# '1' for the models the detection endpoints serve, or a comma-separated list of .pt paths; empty: none
+DEFAULT_WARMUP_MODELS = tuple(dict.fromkeys([*DETECT_MODELS.values(), *BATCH_MODELS.values()]))
+_models_env = os.environ.get('CAT_WARMUP_MODELS', '')
+WARMUP_MODELS = DEFAULT_WARMUP_MODELS if _models_env == '1' else tuple(p for p in _models_env.split(',') if p)
+# Tile sizes the dummy inference runs at (default: the detection tile size)
+WARMUP_TILE_SIZES = tuple(int(s) for s in os.environ.get('CAT_WARMUP_TILE_SIZES', '').split(',') if s)
+
+_lock = threading.Lock()
+_state = {
+    'started': None,
+    'finished': None,
+    'steps': {},     # step name -> seconds taken
+    'errors': {},    # step name -> error message
+}
+
+
+def _timed(name, func):
+    t0 = time.time()
+    try:
+        func()
+    except Exception as e:
+        print(f"[warmup] {name} failed: {e}")
+        with _lock:
+            _state['errors'][name] = str(e)
+    with _lock:
+        _state['steps'][name] = round(time.time() - t0, 2)
+
+
+def warm_model(model_path, tile_sizes=None):
+    """Load model_path into the model cache and run a dummy batch at each tile size."""
+    import numpy as np
+    from scripts.tiling import TILE_SIZE
+    from scripts.model_cache import model_lock
+    from scripts.detect_tiles import DETECT_BATCH_SIZE, predict_tile_batch
+    for tile_size in tile_sizes or (TILE_SIZE,):
+        tiles = [np.zeros((tile_size, tile_size, 3), dtype=np.uint8)] * DETECT_BATCH_SIZE
+        with model_lock(model_path) as model:
+            predict_tile_batch(model, tiles, 0.5, tile_size=tile_size)
+
+
+def _run(steps):
+    for name, func in steps:
+        _timed(name, func)
+    if WARMUP:
+        for module in WARMUP_MODULES:
+            _timed(f'import {module}', lambda: importlib.import_module(module))
+    for model_path in WARMUP_MODELS:
+        _timed(f'model {model_path}', lambda: warm_model(model_path, WARMUP_TILE_SIZES))
+    with _lock:
+        _state['finished'] = time.time()
+    print(f"[warmup] done in {_state['finished'] - _state['started']:.1f}s")
+
+
+def start_warmup(steps=()):
+    """Run steps ((name, callable) pairs), the heavy imports and the model warm-up in a background thread."""
+    with _lock:
+        if _state['started'] is not None:
+            return
+        _state['started'] = time.time()
+    threading.Thread(target=_run, args=(list(steps),), name='cat-warmup', daemon=True).start()
+
+
+def readiness():
+    """JSON-safe warm-up state; 'ready' once every step has run without an error."""
+    from scripts.model_cache import cached_models
+    with _lock:
+        state = {
+            'ready': _state['finished'] is not None and not _state['errors'],
+            'warmup': WARMUP,
+            'warmup_models': list(WARMUP_MODELS),
+            'steps': dict(_state['steps']),
+            'errors': dict(_state['errors']),
+            'seconds': round((_state['finished'] or time.time()) - _state['started'], 2) if _state['started'] else None,
+        }
+    state['models'] = cached_models()
+    return state
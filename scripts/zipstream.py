@@ -0,0 +1,88 @@
+# zipstream.py - build ZIP archives as a stream of chunks for Flask responses
+
+import io
+import os
+import time
+import zipfile
+
+# Entries with these extensions are already compressed (or not worth deflating) and are stored as-is
+STORED_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg', '.webp', '.zip', '.pt')
+CHUNK_SIZE = 1024 * 1024
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable sink; zipfile then emits data descriptors instead of seeking back."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._pos
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def file_entry(path, arcname=None):
+    """Entry for a file on disk, read in CHUNK_SIZE pieces while streaming."""
+    return ('file', arcname or os.path.basename(path), path)
+
+
+def data_entry(arcname, data):
+    """Entry for in-memory text or bytes."""
+    return ('data', arcname, data.encode() if isinstance(data, str) else data)
+
+
+def _compress_type(arcname):
+    if arcname.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def stream_zip(entries):
+    """Yield the bytes of a ZIP archive built from entries (see file_entry / data_entry).
+
+    entries may be a lazy iterable: each entry is produced, written and flushed before the
+    next one is requested, so memory stays at about CHUNK_SIZE regardless of archive size
+    and the first bytes go out as soon as the first entry exists.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', allowZip64=True) as zf:
+        for kind, arcname, source in entries:
+            if kind == 'file':
+                info = zipfile.ZipInfo.from_file(source, arcname)
+            else:
+                info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                info.external_attr = 0o644 << 16
+            info.compress_type = _compress_type(arcname)
+
+            with zf.open(info, 'w', force_zip64=True) as dest:
+                if kind == 'file':
+                    with open(source, 'rb') as src:
+                        while True:
+                            chunk = src.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            data = sink.drain()
+                            if data:
+                                yield data
+                else:
+                    dest.write(source)
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data